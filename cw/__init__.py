@@ -1,16 +1,37 @@
-from collections import namedtuple, OrderedDict
+from __future__ import print_function
+from collections import namedtuple, OrderedDict, deque
 from cloud import serialization
 import bluelet
 import marshal
+import pickle
+import hashlib
 import random
+import struct
+import socket
+import errno
+import importlib
+import io
+import itertools
+import sys
 import distutils.spawn
 import cw.mp
 import cw.slurm
+import cw.store
+import cw.codec
 from contextlib import contextmanager
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
 
 
 PORT = 5494
-# Some random bytes to separate messages.
+# Relays (see `cw.master.Relay`) listen here by default, so that one can
+# share a host with the master.
+RELAY_PORT = 5495
+# How many function blobs the client, master, and workers keep around.
+FUNCTION_CACHE_SIZE = 1024
+# Some random bytes to separate messages in the legacy wire protocol.
 SENTINEL = b'\x8d\xa9 \xee\x01\xe6B\xec\xaa\n\xe1A:\x15\x8d\x1b'
 
 
@@ -18,33 +39,102 @@ def randid():
     return random.getrandbits(128)
 
 
+class LRUCache(object):
+    """A bounded mapping that evicts its least recently used entries
+    once it holds more than `size` of them.
+    """
+    def __init__(self, size=128):
+        self.size = size
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if key in self.data:
+            # Hit.
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+        return default
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.size:
+            # Eviction.
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+
+class FunctionCache(object):
+    """Function blobs by ID. Blobs referenced by unfinished tasks are
+    pinned (see `ref`); of the others, only the `size` most recently used
+    are kept.
+    """
+    def __init__(self, size=FUNCTION_CACHE_SIZE):
+        self.size = size
+        self.blobs = {}
+        self.refs = {}
+        self.unpinned = OrderedDict()  # In LRU order.
+
+    def __contains__(self, func_id):
+        return func_id in self.blobs
+
+    def get(self, func_id):
+        return self.blobs.get(func_id)
+
+    def add(self, func_id, blob):
+        if func_id not in self.blobs:
+            self.blobs[func_id] = blob
+            self.refs[func_id] = 0
+            self._release(func_id)
+
+    def ref(self, func_id):
+        self.refs[func_id] += 1
+        self.unpinned.pop(func_id, None)
+
+    def unref(self, func_id):
+        self.refs[func_id] -= 1
+        if not self.refs[func_id]:
+            self._release(func_id)
+
+    def _release(self, func_id):
+        self.unpinned[func_id] = None
+        while len(self.unpinned) > self.size:
+            old_id, _ = self.unpinned.popitem(last=False)
+            del self.blobs[old_id]
+            del self.refs[old_id]
+
+
 def lru_cache(size=128):
     """Function decorator that memoizes results in-memory.
     """
     def decorator(func):
-        cache = OrderedDict()
+        cache = LRUCache(size)
 
         def wrapper(*args, **kwargs):
             key = (args, tuple(sorted(kwargs.items())))
             if key in cache:
-                # Hit.
-                result = cache.pop(key)
-                cache[key] = result
-                return result
+                return cache.get(key)
             else:
-                # Miss.
                 result = func(*args, **kwargs)
                 cache[key] = result
-                if len(cache) > size:
-                    # Eviction.
-                    del cache[cache.iterkeys().next()]
                 return result
 
         return wrapper
     return decorator
 
 
-# User data serialization.
+# User data serialization. Every blob starts with a one-byte tag naming
+# the serializer that produced it (see `register_serializer`), so the
+# other end can pick the matching decoder. Blobs from legacy peers have
+# no tag; they are pickles, which start with a byte no tag uses.
 
 def slow_ser(obj):
     """Serialize a complex object (like a closure)."""
@@ -56,65 +146,952 @@ def slow_deser(blob):
     return serialization.deserialize(blob)
 
 
+# Buffers inside user data (like the contents of NumPy arrays) at least
+# OOB_THRESHOLD bytes long are pickled out-of-band and travel as frames
+# of their own, or as the path of a file holding them (see `cw.shm` and
+# `cw.store`). Out-of-band pickling needs pickle protocol 5.
+OOB_THRESHOLD = 64 * 1024
+OOB_AVAILABLE = pickle.HIGHEST_PROTOCOL >= 5
+
+# The serializer that clients use unless they ask for another.
+DEFAULT_SERIALIZER = 'auto'
+
+
+class Unsuitable(Exception):
+    """Raised by a serializer that cannot handle an object, to pass it
+    on to the next serializer in line.
+    """
+
+
+class Unconvertible(Exception):
+    """Raised when a blob cannot be converted for a legacy peer (see
+    `untag`).
+    """
+
+
+Serializer = namedtuple('Serializer', ['name', 'tag', 'dumps', 'loads'])
+
+SERIALIZERS = {}  # {name: Serializer}
+_serializer_tags = {}  # {tag: Serializer}
+
+
+def register_serializer(name, tag, dumps, loads):
+    """Add a serializer for user data. `dumps(obj, buffer_callback)`
+    returns bytes, passing any `pickle.PickleBuffer`s it wants to send
+    out-of-band to `buffer_callback` if that is not None (as
+    `pickle.dumps` does), or raises Unsuitable. `loads(data, buffers)`
+    reverses it. `tag` is the single byte that marks its blobs. Register
+    custom serializers on clients and workers alike.
+    """
+    assert len(tag) == 1 and tag not in (b'\x80', b'\x00')
+    serializer = Serializer(name, tag, dumps, loads)
+    SERIALIZERS[name] = serializer
+    _serializer_tags[tag] = serializer
+
+
+# The Python types that marshal round-trips exactly. (It would turn other
+# objects supporting the buffer protocol, like arrays, into bytes.)
+_ATOMIC_TYPES = frozenset([type(None), bool, int, float, complex, str,
+                           bytes])
+_SEQUENCE_TYPES = frozenset([tuple, list, set, frozenset])
+# Checking objects bigger than this for marshal costs more than it saves.
+_MARSHAL_MAX_ITEMS = 1000
+
+
+def _primitive(obj):
+    """Check whether an object consists only of primitive values and
+    containers, which marshal can serialize.
+    """
+    stack = [obj]
+    budget = _MARSHAL_MAX_ITEMS
+    while stack:
+        item = stack.pop()
+        typ = type(item)
+        if typ in _ATOMIC_TYPES:
+            budget -= 1
+        elif typ in _SEQUENCE_TYPES:
+            budget -= len(item) + 1
+            if budget >= 0:
+                stack.extend(item)
+        elif typ is dict:
+            budget -= 2 * len(item) + 1
+            if budget >= 0:
+                stack.extend(item.keys())
+                stack.extend(item.values())
+        else:
+            return False
+        if budget < 0:
+            return False
+    return True
+
+
+def _marshal_dumps(obj, buffer_callback):
+    if not _primitive(obj):
+        raise Unsuitable('not made of primitive values')
+    return marshal.dumps(obj)
+
+
+def _pickle_dumps(obj, buffer_callback):
+    try:
+        if OOB_AVAILABLE:
+            blob = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL,
+                                buffer_callback=buffer_callback)
+        else:
+            blob = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError) as exc:
+        raise Unsuitable(str(exc))  # Like a lambda or a local function.
+    if b'__main__' in blob:
+        # Functions and classes in the client's main module cannot be
+        # found by name on a worker.
+        raise Unsuitable('refers to the main module')
+    return blob
+
+
+def _pickle_loads(data, buffers):
+    if buffers:
+        return pickle.loads(data, buffers=buffers)
+    return pickle.loads(data)
+
+
+def _cloudpickle_dumps(obj, buffer_callback):
+    if OOB_AVAILABLE:
+        return cloudpickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL,
+                                 buffer_callback=buffer_callback)
+    return cloudpickle.dumps(obj)
+
+
+register_serializer('marshal', b'M', _marshal_dumps,
+                    lambda data, buffers: marshal.loads(data))
+register_serializer('pickle', b'P', _pickle_dumps, _pickle_loads)
+register_serializer('cloud', b'S', lambda obj, buffer_callback: slow_ser(obj),
+                    lambda data, buffers: slow_deser(bytes(data)))
+if cloudpickle is not None:
+    register_serializer('cloudpickle', b'C', _cloudpickle_dumps,
+                        _pickle_loads)
+
+
+def _serializers(name):
+    """Get the serializers to try in turn for a name. 'auto' uses
+    marshal for primitives, pickle for other plain data, and cloudpickle
+    (or else the `cloud` library) for closures and anything else from
+    the main module.
+    """
+    if name == 'auto':
+        return (SERIALIZERS['marshal'], SERIALIZERS['pickle'],
+                SERIALIZERS.get('cloudpickle', SERIALIZERS['cloud']))
+    return (SERIALIZERS[name],)
+
+
+def dumps(obj, serializer=DEFAULT_SERIALIZER, buffer_callback=None):
+    """Serialize an object into a tagged blob with the named serializer
+    (or 'auto').
+    """
+    candidates = _serializers(serializer)
+    for candidate in candidates:
+        try:
+            return candidate.tag + candidate.dumps(obj, buffer_callback)
+        except Unsuitable:
+            if candidate is candidates[-1]:
+                raise
+
+
+def loads(blob, buffers=()):
+    """Deserialize a blob from `dumps` (or an untagged one from a legacy
+    peer).
+    """
+    if bytes(blob[:1]) == _PLACED_BLOB:
+        return loads(buffers[-1], buffers[:-1])
+    serializer = _serializer_tags.get(bytes(blob[:1]))
+    if serializer is None:
+        return slow_deser(blob)
+    return serializer.loads(memoryview(blob)[1:], buffers)
+
+
+# Legacy peers run Python 2, whose pickle reads nothing newer than
+# protocol 2.
+LEGACY_PICKLE_PROTOCOL = 2
+
+
+def _pickle_protocol(data):
+    # Pickles of protocol 2 and up start with a PROTO opcode.
+    if bytes(data[:1]) == b'\x80':
+        return bytearray(data[1:2])[0]
+    return 0
+
+
+class _Module(object):
+    # Pickles as an import of a module.
+    def __init__(self, name):
+        self.name = name
+
+    def __reduce__(self):
+        return importlib.import_module, (self.name,)
+
+
+class _Reference(object):
+    """Stands in for a global (like a function pickled by reference)
+    from a module that is not loaded here, and pickles as a reference
+    to it again.
+    """
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def __reduce__(self):
+        head, _, last = self.name.rpartition('.')
+        if head:
+            return getattr, (_Reference(self.module, head), last)
+        return getattr, (_Module(self.module), last)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Loads a pickle without importing any module that is not loaded
+    already, such as those of the client's own code.
+    """
+    def find_class(self, module, name):
+        if module in sys.modules:
+            return pickle.Unpickler.find_class(self, module, name)
+        return _Reference(module, name)
+
+
+def _legacy_loads(data, buffers):
+    if buffers:
+        return _LegacyUnpickler(io.BytesIO(data), buffers=buffers).load()
+    return _LegacyUnpickler(io.BytesIO(data)).load()
+
+
+def untag(blob, buffers=()):
+    """Convert a blob from `dumps`, with its out-of-band buffers, for a
+    legacy peer, which expects a plain pickle of protocol 2 at most.
+    Newer pickles are loaded and pickled again, which raises
+    Unconvertible if that cannot be done here (for example, because they
+    hold instances of classes from modules that are not loaded here).
+    """
+    blob = cw.codec.expand(blob)
+    tag = bytes(blob[:1])
+    if tag == _PLACED_BLOB:
+        raise Unconvertible('is in a file')
+    if tag not in _serializer_tags:
+        return blob  # Already a plain pickle.
+    data = memoryview(blob)[1:]
+    if tag == b'M':
+        return pickle.dumps(marshal.loads(data), LEGACY_PICKLE_PROTOCOL)
+    if tag in (b'P', b'C') and \
+            (buffers or _pickle_protocol(data) > LEGACY_PICKLE_PROTOCOL):
+        if any(isinstance(buf, str) for buf in buffers):
+            raise Unconvertible('has buffers in files')
+        buffers = [cw.codec.expand(buf) for buf in buffers]
+        try:
+            obj = _legacy_loads(data, buffers)
+            if tag == b'C':
+                return cloudpickle.dumps(obj, protocol=LEGACY_PICKLE_PROTOCOL)
+            return pickle.dumps(obj, LEGACY_PICKLE_PROTOCOL)
+        except Exception as exc:
+            raise Unconvertible('cannot pickle for Python 2: {}: {}'.format(
+                type(exc).__name__, exc
+            ))
+    return bytes(data)
+
+
+def ser(obj, place=None, serializer=DEFAULT_SERIALIZER):
+    """Serialize user data (arguments or results). Return a blob and a
+    tuple of out-of-band buffers, which refer to the data inside `obj`
+    rather than copying it. `place`, if given, is called with each
+    out-of-band buffer and may return the path of a file it wrote the
+    buffer to, which then stands in for the buffer, or None. The blob
+    itself is offered to `place` too (see `place_blob`).
+    """
+    views = []
+
+    def out_of_band(buf):
+        view = buf.raw()
+        if view.nbytes < OOB_THRESHOLD:
+            return True  # Cheaper to copy it into the blob.
+        views.append(view)
+        return False
+
+    candidates = _serializers(serializer)
+    for candidate in candidates:
+        del views[:]  # Keep only the buffers of the one that succeeds.
+        try:
+            blob = candidate.tag + candidate.dumps(obj, out_of_band)
+        except Unsuitable:
+            if candidate is candidates[-1]:
+                raise
+        else:
+            break
+    buffers = []
+    for view in views:
+        path = place(view) if place else None
+        buffers.append(view if path is None else path)
+    if place:
+        return place_blob(place, blob, tuple(buffers))
+    return blob, tuple(buffers)
+
+
+# Stands in for a blob that went to a file. Neither serializer tags nor
+# pickles start with it.
+_PLACED_BLOB = b'\x00'
+
+
+def place_blob(place, blob, buffers):
+    """Offer a blob from `ser` to `place`, as `ser` does its out-of-band
+    buffers, so that large data pickled in-band can bypass the master
+    too. If `place` wrote it to a file, return a stand-in blob and the
+    buffers with that file's path appended; otherwise return the blob
+    and buffers as they are.
+    """
+    path = place(memoryview(blob))
+    if path is None:
+        return blob, buffers
+    return _PLACED_BLOB, buffers + (path,)
+
+
+def deser(blob, buffers=()):
+    """Deserialize user data from `ser`, decompressing it if necessary.
+    Files standing in for buffers are mapped in place; removing them is
+    up to whoever owns them.
+    """
+    return loads(cw.codec.expand(blob), [
+        cw.store.attach(b) if isinstance(b, str) else cw.codec.expand(b)
+        for b in buffers
+    ])
+
+
+def compress(compressor, blob, buffers):
+    """Compress the blob and out-of-band buffers from `ser` with a
+    `cw.codec.Compressor`, where that pays off. Return the new blob and
+    buffers.
+    """
+    return compressor.compress(blob), tuple(
+        b if isinstance(b, str) else compressor.compress(b) for b in buffers
+    )
+
+
+def spilled(buffers):
+    """Get the paths of the files standing in for some out-of-band
+    buffers.
+    """
+    return [b for b in buffers if isinstance(b, str)]
+
+
+def func_hash(blob):
+    """Get the content-addressed ID for a serialized function."""
+    return hashlib.sha1(blob).digest()
+
+
 @lru_cache()
 def func_ser(obj):
-    return slow_ser(obj)
+    """Serialize a function, returning its ID and blob. The result is
+    memoized so repeated submissions of one function are not
+    re-serialized or re-hashed.
+    """
+    blob = dumps(obj)
+    return func_hash(blob), blob
 
 
-@lru_cache()
 def func_deser(blob):
-    return slow_deser(blob)
+    return loads(blob)
+
+
+def session_id(cwd, syspath):
+    """Get the content-addressed ID for a session: a working directory
+    and module search path that tasks run with (see `SessionMessage`).
+    """
+    return hashlib.sha1(marshal.dumps((cwd, tuple(syspath)))).digest()
+
+
+def cached(func):
+    """Function decorator that makes jobs calling the function use a
+    result cache: the client's, or else `cw.cache.default_cache()`. A
+    call with the same function and arguments as one that has finished
+    before is not run again.
+    """
+    from cw.client import with_options
+    return with_options(func, cached=True)
 
 
 # Messages.
 
+# `client_host` is the client's host name if it can exchange data with
+# workers on that host through shared memory, and None otherwise.
+# `store` is the directory and threshold of the client's `cw.store.Store`
+# (where workers spill large results, too), or None. `cache_key`, if the
+# client caches the task's result, lets the master answer it from its
+# own cache (see `cw.cache.task_key`). `profile` asks the worker to time
+# the task (PROFILE_TIMINGS) or to profile it, too (PROFILE_CPROFILE).
+# `serializer` names the serializer for the result (see `dumps`), and
+# `compression` the codec to compress it with, if any (see `cw.codec`).
+# `speculative` allows the master to run a copy of the task if it
+# straggles, so it should only be set for tasks that are safe to run
+# twice. A task that has not finished `timeout` seconds after it was
+# dispatched is tried again elsewhere. The master prefers to send tasks
+# with the same `affinity` key (any marshallable value, like the name of
+# the data file a task reads) to the same workers. A task runs in the
+# working directory `cwd` with the directories in `syspath` on its module
+# search path, unless it names a `session` (see `SessionMessage`), in
+# which case those are None and empty.
 TaskMessage = namedtuple(
     'TaskMessage',
-    ['jobid', 'func_blob', 'args_blob', 'kwargs_blob', 'cwd', 'syspath']
+    ['jobid', 'func_id', 'args_blob', 'kwargs_blob', 'cwd', 'syspath',
+     'priority', 'args_buffers', 'kwargs_buffers', 'client_host', 'store',
+     'cache_key', 'profile', 'serializer', 'compression', 'speculative',
+     'timeout', 'affinity', 'session']
+)
+TaskMessage.__new__.__defaults__ = (0, (), (), None, None, None, None,
+                                    None, None, False, None, None, None)
+
+PROFILE_TIMINGS = 'timings'
+PROFILE_CPROFILE = 'cprofile'
+
+
+# Functions are registered once under their ID (see `func_hash`);
+# tasks only refer to them by that ID. A peer that sees an unknown ID
+# asks for the blob with a FunctionRequestMessage.
+FunctionMessage = namedtuple(
+    'FunctionMessage',
+    ['func_id', 'func_blob']
+)
+
+
+FunctionRequestMessage = namedtuple(
+    'FunctionRequestMessage',
+    ['func_id']
 )
 
 
+# For tasks that asked for them, results carry the fields of a Timings
+# as a plain tuple and, if the task was profiled, the `stats` dictionary
+# of a `cProfile.Profile`.
 ResultMessage = namedtuple(
     'ResultMessage',
-    ['jobid', 'success', 'result_blob']
+    ['jobid', 'success', 'result_blob', 'result_buffers', 'timings',
+     'profile']
 )
+ResultMessage.__new__.__defaults__ = ((), None, None)
 
 
-class WorkerRegisterMessage(object):
-    pass
+# How a worker spent its time on a task: seconds deserializing the
+# function and the arguments, running the function, and serializing its
+# result, along with the sizes of the arguments and result in bytes.
+Timings = namedtuple(
+    'Timings',
+    ['deser_func', 'deser_args', 'execute', 'ser_result', 'bytes_in',
+     'bytes_out']
+)
+
+
+# Many small tasks (or their results) can travel together in one
+# message to amortize framing and dispatch costs. Each is a tuple of
+# ordinary TaskMessages or ResultMessages.
+TaskBatchMessage = namedtuple(
+    'TaskBatchMessage',
+    ['tasks']
+)
+
+
+# A result batch also says how many of the worker's credits it returns.
+# Workers return one per message of tasks, but a relay (see
+# `cw.master.Relay`) gathers the results of several messages into one
+# batch and may send some results before the rest of their message is
+# done.
+ResultBatchMessage = namedtuple(
+    'ResultBatchMessage',
+    ['results', 'credits']
+)
+ResultBatchMessage.__new__.__defaults__ = (1,)
+
+
+def unbatch(msg):
+    """Get the messages in a batch message, or a single message alone in
+    a tuple.
+    """
+    if type(msg) in BATCH_TYPES:
+        return msg[0]
+    return (msg,)
+
+
+# A worker registers with the number of tasks it would like to have in
+# flight at once, the names of the codecs it can decompress (see
+# `cw.codec`), the interval in seconds at which it sends
+# HeartbeatMessages (or None if it does not), and the number of tasks
+# it can run at once (if that is not `credits`). A relay registers
+# again whenever its own workers come and go, to change those numbers.
+WorkerRegisterMessage = namedtuple(
+    'WorkerRegisterMessage',
+    ['credits', 'codecs', 'heartbeat', 'slots']
+)
+# Legacy workers send no fields.
+WorkerRegisterMessage.__new__.__defaults__ = (1, (), None, None)
 
 
 class WorkerDepartMessage(object):
     pass
 
 
+class HeartbeatMessage(object):
+    pass
+
+
+# Clients introduce themselves with the share of the cluster they should
+# get under fair scheduling and the codecs they can decompress.
+ClientRegisterMessage = namedtuple(
+    'ClientRegisterMessage',
+    ['weight', 'codecs']
+)
+ClientRegisterMessage.__new__.__defaults__ = ((),)
+
+
+# Anyone may ask the master for its statistics (see `cw.stats`), which
+# it sends back as a dictionary of plain values.
+class StatsRequestMessage(object):
+    pass
+
+
+StatsMessage = namedtuple(
+    'StatsMessage',
+    ['stats']
+)
+
+
+# The master tells a worker to abandon a task when another worker has
+# already finished a copy of it. The worker still answers with a
+# ResultMessage (an error, unless the task had already finished), which
+# the master discards.
+CancelMessage = namedtuple(
+    'CancelMessage',
+    ['jobid']
+)
+
+
+# The master tells a client when an attempt to run one of its tasks
+# failed because the worker was lost or the task timed out, and the task
+# is queued to be tried again. Relays send these to their upstream
+# master, which passes them on.
+RetryMessage = namedtuple(
+    'RetryMessage',
+    ['jobid', 'attempt', 'error']
+)
+
+
+# Anyone (like `cw.autoscale`) may ask the master to let some workers go,
+# by the names `cw.stats` reports for them. The master lets go of those
+# that are still connected and have no tasks in flight: it sends each a
+# WorkerDepartMessage, after which the worker leaves as if it had decided
+# to. It answers with a DrainMessage naming the workers it let go.
+DrainMessage = namedtuple(
+    'DrainMessage',
+    ['workers']
+)
+
+
+# Clients send the working directory and module search path for their
+# tasks once, as a session under its ID (see `session_id`), instead of
+# with every task. The master passes a session on to each worker before
+# the first task that needs it there. Workers keep only the sessions
+# they used last, and ask for others again with a SessionRequestMessage.
+SessionMessage = namedtuple(
+    'SessionMessage',
+    ['session_id', 'cwd', 'syspath']
+)
+
+SessionRequestMessage = namedtuple(
+    'SessionRequestMessage',
+    ['session_id']
+)
+
+
+# The master tells clients to stop sending tasks while its queue is full
+# (`paused`) and to go on once it has room again.
+FlowControlMessage = namedtuple(
+    'FlowControlMessage',
+    ['paused']
+)
+
+
+# Messages that may appear on the wire, in the order of their type codes
+# in the framed protocol. Add new types at the end so that existing codes
+# keep their meaning.
+MESSAGE_TYPES = [
+    TaskMessage,
+    ResultMessage,
+    WorkerRegisterMessage,
+    WorkerDepartMessage,
+    FunctionMessage,
+    FunctionRequestMessage,
+    TaskBatchMessage,
+    ResultBatchMessage,
+    ClientRegisterMessage,
+    StatsRequestMessage,
+    StatsMessage,
+    CancelMessage,
+    HeartbeatMessage,
+    RetryMessage,
+    DrainMessage,
+    SessionMessage,
+    FlowControlMessage,
+    SessionRequestMessage,
+]
+
+# Fields holding user data blobs, which can be large. The framed
+# protocol sends these after the rest of the message (instead of inside
+# the marshalled tuple) so they can be received without extra copies.
+BLOB_FIELDS = {
+    TaskMessage: ('args_blob', 'kwargs_blob'),
+    ResultMessage: ('result_blob',),
+    FunctionMessage: ('func_blob',),
+}
+
+# Fields holding tuples of out-of-band buffers (see `ser`). Each buffer
+# is sent like a blob, except for the paths of files standing in for
+# buffers, which stay in the marshalled fields. Blobs and buffers alike
+# may be `cw.codec.Compressed`; their codec's tag stays in the
+# marshalled fields and their data is sent as a blob.
+BUFFER_FIELDS = {
+    TaskMessage: ('args_buffers', 'kwargs_buffers'),
+    ResultMessage: ('result_buffers',),
+}
+
+# Batch message types and the type of message they contain.
+BATCH_TYPES = {
+    TaskBatchMessage: TaskMessage,
+    ResultBatchMessage: ResultMessage,
+}
+
+_type_codes = dict((typ, code) for code, typ in enumerate(MESSAGE_TYPES))
+_blob_indices = dict(
+    (typ, [typ._fields.index(f) for f in fields])
+    for typ, fields in BLOB_FIELDS.items()
+)
+_buffer_indices = dict(
+    (typ, [typ._fields.index(f) for f in fields])
+    for typ, fields in BUFFER_FIELDS.items()
+)
+
+
+# Wire protocol. Every framed message starts with a fixed-size header:
+# a magic string, the protocol version, the message type code, the
+# length of the marshalled fields, and the total length of the blobs
+# that follow them. Legacy peers instead delimit marshalled messages
+# with SENTINEL; the magic string starts with a byte that can never
+# begin one of those, so the master can tell the two apart from the
+# first bytes on a connection and answer each peer in kind. Legacy
+# peers also predate the function registry: their TaskMessages carry the
+# whole function blob in place of `func_id`, which the master translates.
+
+PROTOCOL_VERSION = 1
+PROTOCOL_FRAMED = 'framed'
+PROTOCOL_LEGACY = 'legacy'
+FRAME_MAGIC = b'\x00CW'
+HEADER = struct.Struct('!3sBBIQ')
+
+
 # Fast serialization for messages & coroutines for sending/receiving.
 
+# The number of fields legacy peers expect in each message they know.
+# Newer fields are dropped when talking to them and take their defaults
+# when hearing from them.
+_LEGACY_FIELDS = {
+    TaskMessage: 6,
+    ResultMessage: 3,
+}
+# Legacy peers run Python 2, whose marshal reads nothing newer than
+# version 2.
+_LEGACY_MARSHAL_VERSION = 2
+
+
 def _msg_ser(msg):
+    """Serialize a message in the legacy, SENTINEL-delimited format.
+    """
     typename = type(msg).__name__
     if type(msg) in (WorkerRegisterMessage, WorkerDepartMessage):
-        return typename
+        return typename.encode('ascii')
     elif isinstance(msg, (TaskMessage, ResultMessage)):
-        return marshal.dumps((typename, tuple(msg)))
+        vals = tuple(bytes(v) if isinstance(v, memoryview) else v
+                     for v in msg[:_LEGACY_FIELDS[type(msg)]])
+        return marshal.dumps((typename, vals), _LEGACY_MARSHAL_VERSION)
     else:
         assert False
 
 
 def _msg_deser(text):
-    if text in (WorkerRegisterMessage.__name__, WorkerDepartMessage.__name__):
-        typ = globals()[text]
+    """Deserialize a legacy message.
+    """
+    text = bytes(text)
+    if text in (WorkerRegisterMessage.__name__.encode('ascii'),
+                WorkerDepartMessage.__name__.encode('ascii')):
+        typ = globals()[text.decode('ascii')]
         return typ()
     else:
         typename, vals = marshal.loads(text)
+        if isinstance(typename, bytes):
+            typename = typename.decode('ascii')
         typ = globals()[typename]
         return typ(*vals)
 
 
+def _strip_blob(blob, blobs):
+    """Append a blob's data to `blobs` and get what stands in for it in
+    the marshalled fields: None, or a compressed blob's codec tag.
+    """
+    if isinstance(blob, cw.codec.Compressed):
+        blobs.append(blob.data)
+        return blob.tag
+    blobs.append(blob)
+    return None
+
+
+def _restore_blob(ref, blobs):
+    blob = next(blobs)
+    if ref is None:
+        return blob
+    return cw.codec.Compressed(ref, blob)
+
+
+def _strip_blobs(typ, msg, blobs):
+    """Get a message's fields with its blobs (and out-of-band buffers)
+    replaced by None or codec tags, appending the blobs to the list
+    `blobs`.
+    """
+    fields = list(msg)
+    for i in _blob_indices.get(typ, ()):
+        fields[i] = _strip_blob(fields[i], blobs)
+    for i in _buffer_indices.get(typ, ()):
+        refs = []
+        for buf in fields[i]:
+            if isinstance(buf, str):
+                refs.append(buf)  # A file's path.
+            else:
+                refs.append(_strip_blob(buf, blobs))
+        fields[i] = tuple(refs)
+    return tuple(fields)
+
+
+def _restore_blobs(typ, fields, blobs):
+    """Rebuild a message from fields produced by `_strip_blobs`, taking
+    its blobs from the iterator `blobs`.
+    """
+    fields = list(fields)
+    for i in _blob_indices.get(typ, ()):
+        fields[i] = _restore_blob(fields[i], blobs)
+    for i in _buffer_indices.get(typ, ()):
+        fields[i] = tuple(ref if isinstance(ref, str)
+                          else _restore_blob(ref, blobs)
+                          for ref in fields[i])
+    return typ(*fields)
+
+
+def expand_message(msg, codecs):
+    """Decompress the blobs and buffers in a message (or batch) that are
+    compressed with codecs other than those named in `codecs`.
+    """
+    def expand(buf):
+        name = cw.codec.codec_name(buf)
+        if name is None or name in codecs:
+            return buf
+        return cw.codec.expand(buf)
+
+    def expand_one(m):
+        fields = list(m)
+        for i in _blob_indices.get(type(m), ()):
+            fields[i] = expand(fields[i])
+        for i in _buffer_indices.get(type(m), ()):
+            fields[i] = tuple(expand(b) for b in fields[i])
+        return type(m)(*fields)
+
+    if type(msg) in BATCH_TYPES:
+        return type(msg)(tuple(expand_one(m) for m in msg[0]), *msg[1:])
+    return expand_one(msg)
+
+
+def _frame(msg):
+    """Serialize a message in the framed format. Return a list of
+    buffers to send in order: the header and marshalled fields, then
+    each of the message's blobs.
+    """
+    typ = type(msg)
+    blobs = []
+    if typ in BATCH_TYPES:
+        fields = (tuple(_strip_blobs(BATCH_TYPES[typ], m, blobs)
+                        for m in msg[0]),) + tuple(msg[1:])
+    elif isinstance(msg, tuple):
+        fields = _strip_blobs(typ, msg, blobs)
+    else:
+        fields = ()
+    meta = marshal.dumps((fields, tuple(len(b) for b in blobs)))
+    header = HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, _type_codes[typ],
+                         len(meta), sum(len(b) for b in blobs))
+    return [header + meta] + blobs
+
+
+def _parse_header(header):
+    """Unpack a framed message header. Return the message type code, the
+    length of the marshalled fields, and the total length of the blobs,
+    or None if the header is invalid.
+    """
+    magic, version, code, meta_len, body_len = HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version > PROTOCOL_VERSION \
+            or code >= len(MESSAGE_TYPES):
+        return None
+    return code, meta_len, body_len
+
+
+def _blob_groups(lens):
+    """Split the blobs of a framed message, given their lengths, into
+    runs to receive into one buffer apiece. Consecutive small blobs share
+    a buffer, but each large one (like an out-of-band array buffer) gets
+    its own so that it can be used in place without keeping its
+    neighbours alive. Generate (start, end) index pairs.
+    """
+    start = 0
+    while start < len(lens):
+        end = start + 1
+        if lens[start] < OOB_THRESHOLD:
+            while end < len(lens) and lens[end] < OOB_THRESHOLD:
+                end += 1
+        yield start, end
+        start = end
+
+
+def _slices(buf, lens):
+    """Split a buffer into memoryview slices of the given lengths.
+    """
+    view = memoryview(buf)
+    slices = []
+    offset = 0
+    for length in lens:
+        slices.append(view[offset:offset + length])
+        offset += length
+    return slices
+
+
+def _unframe(code, fields, blobs):
+    """Rebuild a framed message from its type code, its unmarshalled
+    fields, and the list of its blobs.
+    """
+    typ = MESSAGE_TYPES[code]
+    blobs = iter(blobs)
+    if typ in BATCH_TYPES:
+        return typ(tuple(_restore_blobs(BATCH_TYPES[typ], f, blobs)
+                         for f in fields[0]), *fields[1:])
+    else:
+        return _restore_blobs(typ, fields, blobs)
+
+
+# The most buffers to pass to a single `sendmsg` call.
+_MAX_IOV = 512
+# Reads smaller than this are buffered.
+_READAHEAD = 65536
+
+
+class _SendBuffersEvent(bluelet.WaitableEvent):
+    """A bluelet event that sends as much as it can from a deque of
+    buffers on a connection without blocking, removing whatever it sent.
+    """
+    def __init__(self, conn, bufs):
+        self.conn = conn
+        self.bufs = bufs
+
+    def waitables(self):
+        return (), (self.conn.sock,), ()
+
+    def fire(self):
+        sock = self.conn.sock
+        bufs = self.bufs
+        try:
+            while bufs:
+                # Gather the buffers into as few system calls as possible.
+                # (Many small writes would also run afoul of Nagle's
+                # algorithm.)
+                if hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(list(itertools.islice(bufs, _MAX_IOV)),
+                                        [], socket.MSG_DONTWAIT)
+                else:
+                    sent = sock.send(bufs[0], socket.MSG_DONTWAIT)
+                while bufs and sent >= len(bufs[0]):
+                    sent -= len(bufs[0])
+                    bufs.popleft()
+                if sent:
+                    bufs[0] = bufs[0][sent:]
+        except socket.error as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return True
+
+
+def _send_buffers(conn, bufs):
+    """Send several buffers on a connection, so no other coroutine can
+    interleave data between them. Large messages are sent a piece at a
+    time as the socket becomes writable: blocking until one was sent
+    could deadlock two peers that are both sending large messages.
+    """
+    outbox = getattr(conn, 'cw_outbox', None)
+    if outbox is not None:
+        # Another coroutine is sending. It will send these next.
+        outbox.extend(memoryview(b) for b in bufs)
+        return
+    conn.cw_outbox = outbox = deque(memoryview(b) for b in bufs)
+    try:
+        while outbox:
+            if not (yield _SendBuffersEvent(conn, outbox)):
+                break  # Socket closed.
+    finally:
+        conn.cw_outbox = None
+
+
+class _ReceiveIntoEvent(bluelet.WaitableEvent):
+    """A bluelet event that reads from a connection directly into a
+    writable buffer and returns the number of bytes read.
+    """
+    def __init__(self, conn, view):
+        self.conn = conn
+        self.view = view
+
+    def waitables(self):
+        return (self.conn.sock,), (), ()
+
+    def fire(self):
+        return self.conn.sock.recv_into(self.view)
+
+
+def _recv_into(conn, buf):
+    """Fill the writable buffer `buf` from a connection. Return True if
+    it was filled or a false value if the connection closed first.
+    Small reads go through a read-ahead buffer so that a burst of small
+    messages does not cost a system call apiece; large ones go straight
+    into `buf`.
+    """
+    view = memoryview(buf)
+    ahead = getattr(conn, 'cw_readahead', b'')
+    pos = 0
+    while pos < len(view):
+        if ahead:
+            count = min(len(ahead), len(view) - pos)
+            view[pos:pos + count] = ahead[:count]
+            ahead = ahead[count:]
+        elif len(view) - pos < _READAHEAD:
+            data = yield conn.recv(_READAHEAD)
+            if not data:
+                yield bluelet.end(False)  # Socket closed.
+            ahead = memoryview(data)
+            continue
+        else:
+            count = yield _ReceiveIntoEvent(conn, view[pos:])
+            if not count:
+                yield bluelet.end(False)  # Socket closed.
+        pos += count
+    conn.cw_readahead = ahead
+    yield bluelet.end(True)
+
+
 def _sendmsg(conn, obj):
-    yield conn.sendall(_msg_ser(obj) + SENTINEL)
+    if getattr(conn, 'cw_protocol', None) == PROTOCOL_LEGACY:
+        yield conn.sendall(_msg_ser(obj) + SENTINEL)
+    else:
+        yield _send_buffers(conn, _frame(obj))
 
 
-def _readmsg(conn):
+def _read_legacy(conn):
     data = yield conn.readline(SENTINEL)
     if data is None or SENTINEL not in data:
         # `data` can be None because of a questionable decision in
@@ -126,6 +1103,54 @@ def _readmsg(conn):
     yield bluelet.end(obj)
 
 
+def _readmsg(conn):
+    protocol = getattr(conn, 'cw_protocol', None)
+    if protocol == PROTOCOL_LEGACY:
+        obj = yield _read_legacy(conn)
+        yield bluelet.end(obj)
+
+    header = bytearray(HEADER.size)
+    if protocol is None:
+        # First message on this connection: detect the peer's protocol
+        # from the first few bytes.
+        magic = memoryview(header)[:len(FRAME_MAGIC)]
+        if not (yield _recv_into(conn, magic)):
+            yield bluelet.end()
+        if bytes(magic) != FRAME_MAGIC:
+            # Hand everything read so far to bluelet's line reader.
+            conn._buf = bytes(magic) + bytes(conn.cw_readahead) + conn._buf
+            conn.cw_readahead = b''
+            conn.cw_protocol = PROTOCOL_LEGACY
+            obj = yield _read_legacy(conn)
+            yield bluelet.end(obj)
+        conn.cw_protocol = PROTOCOL_FRAMED
+        rest = memoryview(header)[len(FRAME_MAGIC):]
+        if not (yield _recv_into(conn, rest)):
+            yield bluelet.end()
+    elif not (yield _recv_into(conn, header)):
+        yield bluelet.end()
+
+    parsed = _parse_header(header)
+    if parsed is None:
+        print('bad message header; closing connection')
+        yield bluelet.end()
+    code, meta_len, body_len = parsed
+
+    meta = bytearray(meta_len)
+    if not (yield _recv_into(conn, meta)):
+        yield bluelet.end()
+    fields, blob_lens = marshal.loads(bytes(meta))
+
+    # Receive the blobs straight into the buffers they will live in.
+    blobs = []
+    for start, end in _blob_groups(blob_lens):
+        buf = bytearray(sum(blob_lens[start:end]))
+        if not (yield _recv_into(conn, buf)):
+            yield bluelet.end()
+        blobs += _slices(buf, blob_lens[start:end])
+    yield bluelet.end(_unframe(code, fields, blobs))
+
+
 # Proxies for choosing between Slurm and local multiprocessing.
 
 def is_slurm_available():
@@ -0,0 +1,297 @@
+import cw
+import cw.codec
+import cw.slurm
+import asyncio
+import marshal
+from cw.client import RemoteException, _unwrap, _use_shared_memory, \
+    _timings, _Jobs
+
+
+async def _readmsg(reader):
+    """Read a framed message from an asyncio stream. Return None when
+    the connection closes.
+    """
+    try:
+        header = await reader.readexactly(cw.HEADER.size)
+        parsed = cw._parse_header(header)
+        if parsed is None:
+            print('bad message header; closing connection')
+            return None
+        code, meta_len, body_len = parsed
+        fields, blob_lens = marshal.loads(await reader.readexactly(meta_len))
+        blobs = []
+        for start, end in cw._blob_groups(blob_lens):
+            data = await reader.readexactly(sum(blob_lens[start:end]))
+            if end - start == 1 and len(data) >= cw.OOB_THRESHOLD:
+                # Large buffers should be writable, like the ones other
+                # clients receive.
+                data = bytearray(data)
+            blobs += cw._slices(data, blob_lens[start:end])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return cw._unframe(code, fields, blobs)
+
+
+class AsyncClusterClient(object):
+    """A client for asyncio programs. A single connection carries both
+    jobs and results, and it is serviced on the event loop itself: no
+    extra threads or locks are involved. Use it as an async context
+    manager::
+
+        async with AsyncClusterClient() as client:
+            future = await client.submit(func, arg)
+            print(await future)
+
+    Submitting waits while the master says its queue is full and, if
+    `max_pending` is set, while that many jobs are unfinished. Once the
+    connection closes, unfinished jobs fail and submitting raises
+    ConnectionError.
+    """
+    def __init__(self, host=None, port=cw.PORT, weight=1,
+                 shared_memory=None, store=None, cache=None,
+                 serializer=cw.DEFAULT_SERIALIZER, compression=None,
+                 max_pending=None):
+        if host is None:
+            if cw.is_slurm_available():
+                host, port = cw.slurm.master_address()
+            else:
+                host = 'localhost'
+        self.host = host
+        self.port = port
+        self.weight = weight
+        if shared_memory is None:
+            shared_memory = _use_shared_memory(host)
+        self.jobs = _Jobs(shared_memory, store, cache, serializer,
+                          compression)
+
+        # The blobs of functions the master has, pinned while their jobs
+        # are unfinished (see `Client.functions`).
+        self.functions = cw.FunctionCache()
+        self.job_functions = {}  # {jobid: func_id}
+        self.sessions = set()  # The IDs of the sessions sent.
+        self.futures = {}  # {jobid: asyncio future}
+        self.reader = self.writer = self.receiver = None
+        # Flow control: submitting waits while the master's queue is
+        # full or `max_pending` jobs are unfinished.
+        self.max_pending = max_pending
+        self.paused = False
+        self.room = None  # An asyncio Event, set when there may be room.
+        self.closed = None  # Why the connection closed, once it has.
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port
+        )
+        self.room = asyncio.Event()
+        self._send(cw.ClientRegisterMessage(self.weight,
+                                            tuple(cw.codec.CODECS)))
+        self.receiver = asyncio.ensure_future(self._receive())
+
+    async def close(self):
+        """Close the connection. Jobs that have not finished are
+        cancelled.
+        """
+        if self.closed is None:
+            self.closed = ConnectionError('client closed')
+        self.receiver.cancel()
+        self.writer.close()
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.jobs.release()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.futures:
+            await asyncio.wait(list(self.futures.values()))
+        await self.close()
+
+    def _send(self, msg):
+        # Writes are buffered synchronously, so messages never interleave.
+        self.writer.writelines(cw._frame(msg))
+
+    def _fail(self, error):
+        """Give up on the connection, failing every unfinished job (and
+        any later submission) with `error`.
+        """
+        self.closed = error
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(error)
+        self.futures.clear()
+        self.paused = False  # Let waiting submissions fail.
+        self.room.set()
+
+    def _check_open(self):
+        if self.closed is not None:
+            raise ConnectionError(
+                'connection to master closed: {}'.format(self.closed)
+            )
+
+    async def _receive(self):
+        try:
+            await self._receive_messages()
+        except Exception as exc:
+            print('error handling a message from the master:', exc)
+            self.writer.close()
+            self._fail(exc)
+
+    async def _receive_messages(self):
+        while True:
+            msg = await _readmsg(self.reader)
+            if msg is None:
+                print('server connection closed')
+                self._fail(ConnectionError('server connection closed'))
+                return
+
+            if isinstance(msg, cw.FunctionRequestMessage):
+                blob = self.functions.get(msg.func_id)
+                if blob is None:
+                    print('master requested an unknown function')
+                else:
+                    self._send(cw.FunctionMessage(msg.func_id, blob))
+                continue
+
+            if isinstance(msg, cw.RetryMessage):
+                future = self.futures.get(msg.jobid)
+                if future is not None:
+                    future.failed_attempts.append(msg.error)
+                continue
+
+            if isinstance(msg, cw.FlowControlMessage):
+                self.paused = msg.paused
+                self.room.set()
+                continue
+
+            for result in cw.unbatch(msg):
+                func_id = self.job_functions.pop(result.jobid, None)
+                if func_id is not None:
+                    self.functions.unref(func_id)
+                # The future stays listed until it is resolved, so that
+                # it fails with the rest if resolving it goes wrong.
+                future = self.futures.get(result.jobid)
+                if future is None or future.done():
+                    self.jobs.finish(result, load=False)
+                else:
+                    self._resolve(future, result)
+                self.futures.pop(result.jobid, None)
+            self.room.set()
+
+    async def _wait_for_room(self):
+        while self.paused or (self.max_pending and
+                              len(self.futures) >= self.max_pending):
+            self.room.clear()
+            await self.room.wait()
+
+    def _resolve(self, future, result):
+        future.timings = _timings(result)
+        value = self.jobs.finish(result)
+        if result.success:
+            future.set_result(value)
+        else:
+            future.set_exception(RemoteException(value))
+
+    def _prepare(self, func, func_id, options, args, kwargs):
+        """Get a future for a job and the TaskMessage to send for it, or
+        None if the cache has already answered it.
+        """
+        jobid, future = self._future()
+        msg = self.jobs.prepare(jobid, func, func_id, options, args, kwargs)
+        if isinstance(msg, cw.ResultMessage):
+            del self.futures[jobid]
+            self._resolve(future, msg)
+            return future, None
+        return future, msg
+
+    def _register(self, func, jobids):
+        func_id, func_blob = cw.func_ser(func)
+        if func_id not in self.functions:
+            self.functions.add(func_id, func_blob)
+            self._send(cw.FunctionMessage(func_id, func_blob))
+        for jobid in jobids:
+            self.functions.ref(func_id)
+            self.job_functions[jobid] = func_id
+        return func_id
+
+    def _open_sessions(self, tasks):
+        """Send the master the sessions of some tasks that it does not
+        have yet.
+        """
+        for session in set(task.session for task in tasks):
+            if session not in self.sessions:
+                self._send(self.jobs.sessions.get(session))
+                self.sessions.add(session)
+
+    def _future(self):
+        jobid = cw.randid()
+        future = asyncio.get_event_loop().create_future()
+        future.timings = None
+        future.failed_attempts = []
+        self.futures[jobid] = future
+        return jobid, future
+
+    def profile_stats(self):
+        """Get a `pstats.Stats` merging the profiles of every job with
+        the `profile` option so far, or None.
+        """
+        return self.jobs.profile
+
+    async def submit(self, func, *args, **kwargs):
+        """Send a job to the cluster. Return a future for its result
+        once the job has been handed to the connection. Like those of
+        `ClusterExecutor`, the future has `timings` and `failed_attempts`
+        attributes.
+        """
+        func, options = _unwrap(func)
+        func_id, _ = cw.func_ser(func)
+        self._check_open()
+        await self._wait_for_room()
+        self._check_open()
+        future, task = self._prepare(func, func_id, options, args, kwargs)
+        if task is not None:
+            self._register(func, (task.jobid,))
+            self._open_sessions((task,))
+            self._send(task)
+            await self.writer.drain()
+        return future
+
+    async def submit_many(self, func, calls):
+        """Send a batch of calls to one function in a single message.
+        `calls` is a sequence of (args, kwargs) pairs. Return a list of
+        futures.
+        """
+        func, options = _unwrap(func)
+        func_id, _ = cw.func_ser(func)
+        self._check_open()
+        await self._wait_for_room()
+        self._check_open()
+        tasks = []
+        futures = []
+        for args, kwargs in calls:
+            future, task = self._prepare(func, func_id, options, args,
+                                         kwargs)
+            futures.append(future)
+            if task is not None:
+                tasks.append(task)
+        if tasks:
+            self._register(func, [task.jobid for task in tasks])
+            self._open_sessions(tasks)
+            self._send(cw.TaskBatchMessage(tuple(tasks)))
+            await self.writer.drain()
+        return futures
+
+    async def as_completed(self, futures=None):
+        """Generate futures as they finish, for use with `async for`.
+        By default, this covers every job outstanding at the time of the
+        call.
+        """
+        if futures is None:
+            futures = list(self.futures.values())
+        done = asyncio.Queue()
+        for future in futures:
+            future.add_done_callback(done.put_nowait)
+        for i in range(len(futures)):
+            yield await done.get()
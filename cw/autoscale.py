@@ -0,0 +1,177 @@
+from __future__ import print_function
+import cw
+import cw.slurm
+import cw.stats
+import socket
+import time
+
+
+# How often the autoscaler looks at the master's statistics, in seconds.
+INTERVAL = 5.0
+# Queued tasks that call for one more worker.
+BACKLOG_PER_WORKER = 4
+# The most workers to start at once.
+STEP = 16
+# How long a worker must sit idle before it is let go, in seconds.
+IDLE_AFTER = 60.0
+# The least time between starting workers, and between letting them
+# go, in seconds.
+UP_COOLDOWN = 30.0
+DOWN_COOLDOWN = 60.0
+# How long started workers count as on their way, in seconds. Workers
+# that have not connected by then (say, because their job is waiting in
+# the Slurm queue) no longer count towards the limits.
+STARTUP = 300.0
+
+
+def drain(names, host=None, port=cw.PORT):
+    """Ask a master to let the named workers go (see `cw.DrainMessage`).
+    Return the names of those it let go.
+    """
+    msg = cw.stats.request(cw.DrainMessage(tuple(names)), host, port)
+    if not isinstance(msg, cw.DrainMessage):
+        raise IOError('unexpected reply from master')
+    return msg.workers
+
+
+class Autoscaler(object):
+    """Keeps the number of workers between `minimum` and `maximum` as the
+    master's queue grows and shrinks. When tasks wait in the queue, it
+    calls `launch(count)` to start a worker for every `backlog` of them
+    (up to `step` at a time, and at most every `up_cooldown` seconds).
+    When the queue is empty, it asks the master to let go of workers
+    that have had no tasks for `idle_after` seconds (at most every
+    `down_cooldown` seconds).
+    """
+    def __init__(self, launch, minimum=0, maximum=STEP, host=None,
+                 port=cw.PORT, backlog=BACKLOG_PER_WORKER, step=STEP,
+                 idle_after=IDLE_AFTER, up_cooldown=UP_COOLDOWN,
+                 down_cooldown=DOWN_COOLDOWN, startup=STARTUP):
+        self.launch = launch
+        self.minimum = minimum
+        self.maximum = maximum
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.step = step
+        self.idle_after = idle_after
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.startup = startup
+
+        self.last_up = None
+        self.last_down = None
+        # Recent launches, as [time, workers yet to connect] pairs.
+        self.launches = []
+        # When each worker's current idle spell began: {name: time}.
+        self.idle_since = {}
+        self.busy = {}  # Each worker's busy time when last seen.
+
+    def _watch_idle(self, workers, now):
+        """Update the idle spells of workers. A worker is idle if it has
+        no tasks in flight and has not been busy since the last look.
+        """
+        for name, worker in workers.items():
+            busy = worker['busy']
+            if worker['active'] or busy != self.busy.get(name, busy):
+                self.idle_since.pop(name, None)
+            else:
+                self.idle_since.setdefault(name, now)
+            self.busy[name] = busy
+        for name in list(self.busy):
+            if name not in workers:
+                del self.busy[name]
+                self.idle_since.pop(name, None)
+
+    def _pending(self, arrived, now):
+        """Count the workers launched recently that have not connected
+        yet, given the number that connected since the last look.
+        """
+        launches = []
+        for launch in self.launches:
+            if now - launch[0] >= self.startup:
+                continue
+            taken = min(arrived, launch[1])
+            launch[1] -= taken
+            arrived -= taken
+            if launch[1]:
+                launches.append(launch)
+        self.launches = launches
+        return sum(count for _, count in launches)
+
+    def _cooling(self, last, cooldown, now):
+        return last is not None and now - last < cooldown
+
+    def step_once(self):
+        """Look at the master's statistics and start or let go of workers
+        if that is called for. Return the change in the number of
+        workers (positive for launches).
+        """
+        stats = cw.stats.query(self.host, self.port)
+        now = time.time()
+        workers = stats['workers']
+        queued = stats['tasks']['queued']
+        arrived = len(set(workers) - set(self.busy))
+        self._watch_idle(workers, now)
+        current = len(workers) + self._pending(arrived, now)
+
+        # Start workers.
+        wanted = 0
+        if current < self.minimum:
+            wanted = self.minimum - current
+        elif queued and \
+                not self._cooling(self.last_up, self.up_cooldown, now):
+            wanted = min(-(-queued // self.backlog), self.step)
+        wanted = min(wanted, self.maximum - current)
+        if wanted > 0:
+            print('{} tasks queued; starting {} workers'.format(
+                queued, wanted
+            ))
+            self.launch(wanted)
+            self.last_up = now
+            self.launches.append([now, wanted])
+            return wanted
+
+        # Let idle workers go.
+        if queued or \
+                self._cooling(self.last_down, self.down_cooldown, now):
+            return 0
+        idle = sorted((since, name) for name, since in self.idle_since.items()
+                      if now - since >= self.idle_after)
+        spare = min(len(idle), current - self.minimum)
+        if spare <= 0:
+            return 0
+        drained = drain([name for _, name in idle[:spare]],
+                        self.host, self.port)
+        if drained:
+            print('letting {} idle workers go'.format(len(drained)))
+            self.last_down = now
+        for name in drained:
+            self.idle_since.pop(name, None)
+        return -len(drained)
+
+    def run(self, interval=INTERVAL):
+        """Keep scaling until interrupted. If the master cannot be
+        reached, keep trying (it may be restarting).
+        """
+        try:
+            while True:
+                try:
+                    self.step_once()
+                except (socket.error, IOError) as exc:
+                    print('could not reach master: {}'.format(exc))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def slurm_launcher(options=[], docker_image=None, docker_args="",
+                   rendezvous=cw.slurm.RENDEZVOUS):
+    """Get a `launch` function for an Autoscaler that starts workers as
+    Slurm jobs, like `cw.slurm.start` does.
+    """
+    def launch(count):
+        jobid = cw.slurm._start_workers(count, list(options), docker_image,
+                                        docker_args, rendezvous=rendezvous)
+        print('worker job', jobid, 'started')
+    return launch
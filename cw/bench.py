@@ -0,0 +1,321 @@
+from __future__ import print_function
+import cw
+import cw.mp
+import cw.client
+import argparse
+import json
+import os
+import pickle
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+DEFAULT_SIZES = (0, 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+# Throughput runs for large tasks are cut short after this many bytes.
+BYTES_PER_SIZE = 512 * 1024 * 1024
+
+
+def _consume(payload):
+    """The task for throughput and latency runs: it does no work, so only
+    the cost of getting the payload there and a result back is measured.
+    """
+    return 0
+
+
+def _array(size):
+    """Make an array of `size` bytes, like those real jobs send. Without
+    NumPy, a PickleBuffer stands in for one (with the same out-of-band
+    pickling).
+    """
+    if numpy is not None:
+        return numpy.zeros(size, dtype=numpy.uint8)
+    if cw.OOB_AVAILABLE:
+        return pickle.PickleBuffer(bytearray(size))
+    return bytearray(size)
+
+
+def _closure():
+    table = dict((i, str(i)) for i in range(100))
+
+    def lookup(key):
+        return table.get(key)
+    return lookup
+
+
+# The argument tuples for the serialization benchmarks.
+PAYLOADS = {
+    'closure': lambda: (_closure(),),
+    'array': lambda: (_array(8 * 1024 * 1024),),
+    'small_args': lambda: tuple((i, str(i), float(i)) for i in range(1000)),
+}
+
+
+def _median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+def _percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    out = {}
+    for p in points:
+        index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+        out['p{}'.format(p)] = samples[index]
+    out['max'] = samples[-1]
+    out['mean'] = sum(samples) / len(samples)
+    return out
+
+
+def _cpu_seconds(pid):
+    """Get the CPU time a process has used so far (from /proc), or None
+    if that is not available.
+    """
+    if pid is None:
+        return None
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    utime, stime = int(fields[11]), int(fields[12])
+    return float(utime + stime) / os.sysconf('SC_CLK_TCK')
+
+
+def _socket_seconds(bufs):
+    """Time sending some buffers over a local socket and receiving them
+    into a buffer on the other end.
+    """
+    total = sum(len(b) for b in bufs)
+    a, b = socket.socketpair()
+    received = bytearray(total)
+    try:
+        start = time.time()
+        sender = threading.Thread(
+            target=lambda: [a.sendall(buf) for buf in bufs]
+        )
+        sender.start()
+        view = memoryview(received)
+        pos = 0
+        while pos < total:
+            pos += b.recv_into(view[pos:])
+        sender.join()
+        return time.time() - start
+    finally:
+        a.close()
+        b.close()
+
+
+def breakdown(args, repeat=10):
+    """Break down the cost of sending a task with some arguments: user
+    data serialization (`cw.ser`, reported as `slow_ser`, which it
+    replaced), message serialization (`cw._frame`, the framed successor
+    of `_msg_ser`), the socket, and deserialization on the other end.
+    Return the median of each, in seconds, along with the message size.
+    """
+    times = {'slow_ser': [], 'msg_ser': [], 'socket': [], 'deser': []}
+    for i in range(repeat):
+        start = time.time()
+        args_blob, args_buffers = cw.ser(args)
+        kwargs_blob, kwargs_buffers = cw.ser({})
+        times['slow_ser'].append(time.time() - start)
+
+        task = cw.TaskMessage(0, b'f' * 20, args_blob, kwargs_blob,
+                              None, (), 0, args_buffers, kwargs_buffers,
+                              session=cw.session_id(os.getcwd(), sys.path))
+        start = time.time()
+        bufs = cw._frame(task)
+        times['msg_ser'].append(time.time() - start)
+
+        times['socket'].append(_socket_seconds(bufs))
+
+        start = time.time()
+        cw.deser(args_blob, args_buffers)
+        times['deser'].append(time.time() - start)
+
+    out = dict((k, _median(v)) for k, v in times.items())
+    out['bytes'] = sum(len(b) for b in bufs)
+    return out
+
+
+def bench_serialization(repeat=10):
+    return dict((name, breakdown(make(), repeat))
+                for name, make in sorted(PAYLOADS.items()))
+
+
+def bench_throughput(executor, sizes, tasks, master_pid=None):
+    """Measure tasks per second for each payload size, along with the
+    master's CPU time per task and the cost breakdown for one task.
+    """
+    results = []
+    for size in sizes:
+        payload = _array(size)
+        count = max(10, min(tasks, BYTES_PER_SIZE // max(size, 1)))
+
+        cpu_before = _cpu_seconds(master_pid)
+        start = time.time()
+        futures = [executor.submit(_consume, payload) for i in range(count)]
+        for future in futures:
+            future.result()
+        elapsed = time.time() - start
+        cpu_after = _cpu_seconds(master_pid)
+
+        result = {
+            'size': size,
+            'tasks': count,
+            'seconds': elapsed,
+            'tasks_per_sec': count / elapsed,
+            'mb_per_sec': count * size / elapsed / 1e6,
+            'master_cpu_per_task': None,
+            'breakdown': breakdown((payload,), 3),
+        }
+        if cpu_before is not None and cpu_after is not None:
+            result['master_cpu_per_task'] = (cpu_after - cpu_before) / count
+        results.append(result)
+    return results
+
+
+def bench_batched(executor, tasks, chunksize=100):
+    """Measure tasks per second for empty tasks submitted in batches.
+    """
+    start = time.time()
+    list(executor.map(_consume, [b''] * tasks, chunksize=chunksize))
+    elapsed = time.time() - start
+    return {'tasks': tasks, 'chunksize': chunksize,
+            'tasks_per_sec': tasks / elapsed}
+
+
+def bench_latency(executor, samples):
+    """Measure the round trip for one empty task at a time, in seconds.
+    """
+    times = []
+    for i in range(samples):
+        start = time.time()
+        executor.submit(_consume, b'').result()
+        times.append(time.time() - start)
+    return _percentiles(times)
+
+
+def _commit():
+    try:
+        out = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'),
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+@contextmanager
+def _stdout_to_stderr():
+    """Send everything written to stdout, including by child processes,
+    to stderr instead, keeping stdout clean for the results.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+@contextmanager
+def _nothing():
+    yield
+
+
+def run(nworkers=4, host=None, sizes=DEFAULT_SIZES, tasks=2000,
+        latency_samples=500, repeat=10):
+    """Run every benchmark and return the results as a dictionary. Unless
+    `host` names an existing master, start a local cluster with
+    `nworkers` workers for the duration.
+    """
+    results = {
+        'commit': _commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'numpy': numpy is not None,
+        'out_of_band': cw.OOB_AVAILABLE,
+        'workers': nworkers,
+    }
+    results['serialization'] = bench_serialization(repeat)
+
+    with _stdout_to_stderr():
+        if host is None:
+            cluster = cw.mp.allocate(nworkers)
+        else:
+            cluster = _nothing()
+        with cluster:
+            with cw.client.ClusterExecutor(host) as executor:
+                # Warm up.
+                list(executor.map(_consume, [b''] * nworkers * 10))
+
+                results['shared_memory'] = \
+                    executor.thread.jobs.shared_memory
+                master_pid = cw.mp.master_pid() if host is None else None
+                results['throughput'] = bench_throughput(
+                    executor, sizes, tasks, master_pid
+                )
+                results['batched'] = bench_batched(executor, tasks)
+                results['latency'] = bench_latency(executor,
+                                                   latency_samples)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='benchmark a cluster and print the results as JSON'
+    )
+    parser.add_argument(
+        '--workers', metavar='N', type=int, default=4,
+        help='workers to start (default 4)'
+    )
+    parser.add_argument(
+        '--host', default=None,
+        help='use the running master on this host instead of starting '
+             'a local cluster'
+    )
+    parser.add_argument(
+        '--tasks', metavar='N', type=int, default=2000,
+        help='tasks per throughput run (default 2000)'
+    )
+    parser.add_argument(
+        '--sizes', metavar='BYTES', type=int, nargs='+',
+        default=list(DEFAULT_SIZES),
+        help='payload sizes for throughput runs'
+    )
+    parser.add_argument(
+        '--latency-samples', metavar='N', type=int, default=500,
+        help='round trips to time (default 500)'
+    )
+    parser.add_argument(
+        '--repeat', metavar='N', type=int, default=10,
+        help='repetitions of each serialization measurement (default 10)'
+    )
+    parser.add_argument(
+        '--output', '-o', metavar='FILE', default=None,
+        help='write the results here instead of to stdout'
+    )
+    args = parser.parse_args()
+
+    results = run(args.workers, args.host, args.sizes, args.tasks,
+                  args.latency_samples, args.repeat)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,198 @@
+from __future__ import print_function
+import os
+import mmap
+import struct
+import hashlib
+import binascii
+import threading
+import types
+from collections import namedtuple, OrderedDict
+import cw
+import cw.store
+
+
+# The default size limit for a DiskCache.
+MAX_BYTES = 1024 * 1024 * 1024
+# Where `cw.cached` functions keep their results when the client was not
+# given a cache of its own.
+DEFAULT_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'cw',
+)
+
+CacheStats = namedtuple('CacheStats',
+                        ['hits', 'misses', 'bytes_saved', 'size', 'entries'])
+
+# Each entry is a file holding the number of buffers, their lengths, and
+# then the buffers: the result blob followed by its out-of-band buffers.
+_COUNT = struct.Struct('!I')
+_LENGTH = struct.Struct('!Q')
+
+
+def _hash_code(h, code):
+    # Constants include the code of nested functions, whose reprs name
+    # their addresses, and frozensets, whose order varies between runs.
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode('utf8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(h, const)
+        elif isinstance(const, frozenset):
+            h.update(repr(sorted(const, key=repr)).encode('utf8'))
+        else:
+            h.update(repr(const).encode('utf8'))
+
+
+@cw.lru_cache()
+def func_key(func_id, func):
+    """Get what stands for a function in cache keys: its ID (see
+    `cw.func_hash`) mixed with a hash of its bytecode. A function that
+    pickles by reference has a blob holding only its name, so without
+    the bytecode, editing its body would not change the keys of its
+    calls. Callables without bytecode of their own (like classes) are
+    keyed by their ID alone.
+    """
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return func_id
+    h = hashlib.sha1(func_id)
+    _hash_code(h, code)
+    return h.digest()
+
+
+def task_key(func_id, args_blob, args_buffers, kwargs_blob, kwargs_buffers):
+    """Get the cache key for a call, hashing the function's key (see
+    `func_key`) and the serialized arguments (with their out-of-band
+    buffers, which must not have been replaced by files yet).
+    Serialization is deterministic enough for this in practice, but note
+    that neither covers the modules the function calls into: clear the
+    cache when those change.
+    """
+    h = hashlib.sha1(func_id)
+    for blob, buffers in ((args_blob, args_buffers),
+                          (kwargs_blob, kwargs_buffers)):
+        h.update(_COUNT.pack(len(buffers)))
+        for buf in (blob,) + tuple(buffers):
+            h.update(_LENGTH.pack(len(buf)))
+            h.update(buf)
+    return h.digest()
+
+
+class DiskCache(object):
+    """Successful results stored in files in a directory, keyed by
+    `task_key`. Once the entries take up more than `max_bytes`, the least
+    recently used are evicted. Several clients (even on different hosts)
+    may share a directory.
+    """
+    def __init__(self, directory=DEFAULT_DIR, max_bytes=MAX_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.bytes_saved = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith(cw.store.PREFIX) and \
+                    not name.endswith('.tmp'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, name, st.st_size))
+        self.entries = OrderedDict()  # {name: size}, in LRU order.
+        for _, name, size in sorted(entries):
+            self.entries[name] = size
+        self.size = sum(self.entries.values())
+
+    def _name(self, key):
+        return cw.store.PREFIX + binascii.hexlify(key).decode('ascii')
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        """Look up a result. Return its blob and out-of-band buffers (see
+        `cw.deser`), mapped from the entry's file, or None.
+        """
+        name = self._name(key)
+        try:
+            with open(self._path(name), 'rb') as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0,
+                                            access=mmap.ACCESS_COPY))
+            os.utime(self._path(name), None)  # For other clients' LRU.
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+                self.size -= self.entries.pop(name, 0)
+            return None
+
+        count, = _COUNT.unpack_from(data)
+        offset = _COUNT.size + count * _LENGTH.size
+        bufs = []
+        for i in range(count):
+            length, = _LENGTH.unpack_from(data, _COUNT.size + i * _LENGTH.size)
+            bufs.append(data[offset:offset + length])
+            offset += length
+
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += len(data)
+            self.entries[name] = self.entries.pop(name, len(data))
+        return bufs[0], tuple(bufs[1:])
+
+    def put(self, key, blob, buffers):
+        """Store a result given its blob and out-of-band buffers.
+        """
+        name = self._name(key)
+        with self.lock:
+            if name in self.entries:
+                return
+        bufs = (blob,) + tuple(buffers)
+        header = _COUNT.pack(len(bufs)) + \
+            b''.join(_LENGTH.pack(len(b)) for b in bufs)
+        tmp = '{}.{}.tmp'.format(self._path(name), os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            for buf in bufs:
+                f.write(buf)
+        os.rename(tmp, self._path(name))
+        size = len(header) + sum(len(b) for b in bufs)
+
+        with self.lock:
+            self.entries[name] = size
+            self.size += size
+            evicted = []
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old)
+        for old in evicted:
+            cw.store.unlink(self._path(old))
+
+    def stats(self):
+        """Get the hits, misses, and bytes of results served from the
+        cache so far, along with the cache's current size and number of
+        entries.
+        """
+        with self.lock:
+            return CacheStats(self.hits, self.misses, self.bytes_saved,
+                              self.size, len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            names = list(self.entries)
+            self.entries.clear()
+            self.size = 0
+        for name in names:
+            cw.store.unlink(self._path(name))
+
+
+_default = None
+
+
+def default_cache():
+    """Get the DiskCache in DEFAULT_DIR, creating it on first use.
+    """
+    global _default
+    if _default is None:
+        _default = DiskCache()
+    return _default
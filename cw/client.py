@@ -1,29 +1,347 @@
 from __future__ import print_function
 import cw
+import cw.codec
+import cw.shm
 import cw.slurm
+import cw.store
+import cw.cache
 import bluelet
 import threading
 import concurrent.futures
 import os
 import sys
+import time
+import pstats
+import itertools
+from collections import namedtuple, deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2.
+
+
+# The most calls that ClusterExecutor.imap keeps in flight by default.
+DEFAULT_WINDOW = 1000
+
+
+# Options for the jobs that call a given function; see `with_options`.
+# With `timings`, workers report how long each phase of a job took (see
+# `cw.Timings`); with `profile`, they also run it under cProfile. With
+# `speculative`, the master may run a second copy of a job that takes
+# much longer than usual and keep whichever result comes first; only use
+# it for functions that are safe to run twice. A job that runs for more
+# than `timeout` seconds is tried again on another worker, as are jobs
+# whose workers are lost. Jobs with the same `affinity` key (say, the
+# data file they read) go to the same workers when possible.
+TaskOptions = namedtuple('TaskOptions',
+                         ['priority', 'cached', 'timings', 'profile',
+                          'speculative', 'timeout', 'affinity'])
+DEFAULT_OPTIONS = TaskOptions(priority=0, cached=False, timings=False,
+                              profile=False, speculative=False,
+                              timeout=None, affinity=None)
+
+
+class OptionsWrapper(object):
+    """A function bundled with the TaskOptions for jobs that call it.
+    """
+    def __init__(self, func, options):
+        self.func = func
+        self.options = options
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+
+def with_options(func, **options):
+    """Wrap a function so that jobs calling it are submitted with some
+    non-default TaskOptions. For example, to run some jobs before others
+    when the master uses the priority scheduler::
+
+        executor.submit(with_options(func, priority=2), arg)
+    """
+    func, base = _unwrap(func)
+    return OptionsWrapper(func, base._replace(**options))
+
+
+def _unwrap(func):
+    """Get a function and its TaskOptions from a possibly-wrapped one.
+    """
+    if isinstance(func, OptionsWrapper):
+        return func.func, func.options
+    return func, DEFAULT_OPTIONS
+
+
+def _use_shared_memory(host):
+    """Guess whether workers will be able to exchange data with a client
+    on this host through shared memory, which is to say whether the
+    whole cluster runs here (as with `cw.mp`).
+    """
+    return host in ('localhost', '127.0.0.1', '::1', cw.shm.HOST) and \
+        not cw.is_slurm_available()
+
+
+class _ProfileData(object):
+    # Profile stats from a worker, in the form `pstats.Stats` takes.
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _timings(result):
+    """Get the Timings in a ResultMessage, or None.
+    """
+    if result.timings is None:
+        return None
+    return cw.Timings(*result.timings)
+
+
+class _Jobs(object):
+    """Turns a client's jobs into TaskMessages and their ResultMessages
+    back into values. Large buffers in the arguments go into shared
+    memory, into a `cw.store.Store`, or over the connection with the rest
+    of the job (see `cw.ser`). Jobs are answered from a
+    `cw.cache.DiskCache` when possible: `cache` for every job, or the
+    default cache for jobs with the `cached` option. The profiles of
+    jobs with the `profile` option are merged in `profile`. Arguments
+    and results use the named `serializer` (see `cw.dumps`), and are
+    compressed with the `compression` codec (a name or a
+    `cw.codec.Compressor`) if there is one.
+    """
+    def __init__(self, shared_memory=False, store=None, cache=None,
+                 serializer=cw.DEFAULT_SERIALIZER, compression=None):
+        cw._serializers(serializer)  # Fail early for unknown names.
+        self.shared_memory = shared_memory
+        self.store = store
+        self.cache = cache
+        self.serializer = serializer
+        if compression is not None and \
+                not isinstance(compression, cw.codec.Compressor):
+            compression = cw.codec.Compressor(compression)
+        self.compressor = compression
+        self.files = {}  # {jobid: [path]}
+        self.cache_keys = {}  # {jobid: (cache, key)}
+        self.profile = None  # A pstats.Stats, once a profile arrives.
+        self.profile_lock = threading.Lock()
+        # The current (cwd, syspath) and its session ID, and the latest
+        # sessions, until they are sent: {session ID: SessionMessage}.
+        self.env = None
+        self.sessions = cw.LRUCache(cw.FUNCTION_CACHE_SIZE)
+
+    def session(self):
+        """Get the ID of the session for the current working directory
+        and module search path (see `cw.SessionMessage`).
+        """
+        env = (os.getcwd(), tuple(sys.path))
+        if self.env is None or env != self.env[0]:
+            session = cw.session_id(*env)
+            if session not in self.sessions:
+                self.sessions[session] = cw.SessionMessage(session, env[0],
+                                                           list(env[1]))
+            self.env = env, session
+        return self.env[1]
+
+    def place(self, view):
+        if self.shared_memory and view.nbytes >= cw.shm.THRESHOLD:
+            return cw.shm.share(view)
+        if self.store is not None:
+            return self.store.put(view)
+
+    def prepare(self, jobid, func, func_id, options, args, kwargs):
+        """Get the TaskMessage for a job calling `func` (whose ID is
+        `func_id`), or, if the cache has its result, a ResultMessage.
+        """
+        args_blob, args_buffers = cw.ser(args, serializer=self.serializer)
+        kwargs_blob, kwargs_buffers = cw.ser(kwargs,
+                                             serializer=self.serializer)
+
+        cache = self.cache
+        if cache is None and options.cached:
+            cache = cw.cache.default_cache()
+        key = None
+        if cache is not None:
+            key = cw.cache.task_key(cw.cache.func_key(func_id, func),
+                                    args_blob, args_buffers,
+                                    kwargs_blob, kwargs_buffers)
+            hit = cache.get(key)
+            if hit is not None:
+                return cw.ResultMessage(jobid, True, *hit)
+            self.cache_keys[jobid] = cache, key
+
+        args_buffers = tuple(self.place(b) or b for b in args_buffers)
+        kwargs_buffers = tuple(self.place(b) or b for b in kwargs_buffers)
+        args_blob, args_buffers = cw.place_blob(self.place, args_blob,
+                                                args_buffers)
+        kwargs_blob, kwargs_buffers = cw.place_blob(self.place, kwargs_blob,
+                                                    kwargs_buffers)
+        paths = cw.spilled(args_buffers + kwargs_buffers)
+        if paths:
+            self.files[jobid] = paths
+
+        codec = None
+        if self.compressor is not None:
+            codec = self.compressor.codec.name
+            args_blob, args_buffers = cw.compress(
+                self.compressor, args_blob, args_buffers
+            )
+            kwargs_blob, kwargs_buffers = cw.compress(
+                self.compressor, kwargs_blob, kwargs_buffers
+            )
+
+        profile = None
+        if options.profile:
+            profile = cw.PROFILE_CPROFILE
+        elif options.timings:
+            profile = cw.PROFILE_TIMINGS
+
+        return cw.TaskMessage(
+            jobid,
+            func_id, args_blob, kwargs_blob,
+            None,
+            (),
+            options.priority,
+            args_buffers, kwargs_buffers,
+            cw.shm.HOST if self.shared_memory else None,
+            (self.store.directory, self.store.threshold)
+            if self.store is not None else None,
+            key,
+            profile,
+            self.serializer,
+            codec,
+            options.speculative,
+            options.timeout,
+            options.affinity,
+            self.session(),
+        )
+
+    def finish(self, result, load=True):
+        """Get the value in a job's ResultMessage (unless `load` is off),
+        caching it if the job asked for that. Release the files holding
+        the job's arguments and result.
+        """
+        self.release(result.jobid)
+        if result.profile is not None:
+            self.add_profile(result.profile)
+        paths = cw.spilled(result.result_buffers)
+        try:
+            cached = self.cache_keys.pop(result.jobid, None)
+            if not (load or cached):
+                return None
+            blob = cw.codec.expand(result.result_blob)
+            buffers = tuple(cw.store.attach(b) if isinstance(b, str)
+                            else cw.codec.expand(b)
+                            for b in result.result_buffers)
+            if cached and result.success:
+                cache, key = cached
+                cache.put(key, blob, buffers)
+            if load:
+                return cw.deser(blob, buffers)
+        finally:
+            for path in paths:
+                cw.store.unlink(path)
+
+    def add_profile(self, stats):
+        """Merge profile stats from a worker into `profile`.
+        """
+        with self.profile_lock:
+            if self.profile is None:
+                self.profile = pstats.Stats(_ProfileData(stats))
+            else:
+                self.profile.add(_ProfileData(stats))
+
+    def release(self, jobid=None):
+        """Remove the files holding a finished job's arguments, or every
+        job's if `jobid` is None.
+        """
+        if jobid is None:
+            jobids = list(self.files)
+        else:
+            jobids = [jobid]
+        for jobid in jobids:
+            for path in self.files.pop(jobid, ()):
+                if self.store is not None and self.store.owns(path):
+                    self.store.release(path)
+                else:
+                    cw.store.unlink(path)
 
 
 class Client(object):
-    def __init__(self, host=None, port=cw.PORT):
+    """The connection to the master. Large arguments go through shared
+    memory when `shared_memory` is set; by default, that is when the
+    master runs on this host and Slurm is not in use. Otherwise, they go
+    to `store` (a `cw.store.Store`) if there is one. With a `cache` (a
+    `cw.cache.DiskCache`), calls that have run before are not run again.
+    `serializer` names the serializer for arguments and results (see
+    `cw.dumps`). With `compression` (a codec name, like 'zlib', or a
+    `cw.codec.Compressor`), large arguments and results are compressed
+    when that pays off.
+    """
+    def __init__(self, host=None, port=cw.PORT, weight=1,
+                 shared_memory=None, store=None, cache=None,
+                 serializer=cw.DEFAULT_SERIALIZER, compression=None):
         # if no host specified, then auto-detect if slurm should be used
         if host is None:
             if cw.is_slurm_available():
-                host = cw.slurm.master_host()
+                host, port = cw.slurm.master_address()
             else:
                 host = 'localhost'
         self.host = host
         self.port = port
+        self.weight = weight  # Our share under fair scheduling.
+        if shared_memory is None:
+            shared_memory = _use_shared_memory(host)
+        self.jobs = _Jobs(shared_memory, store, cache, serializer,
+                          compression)
+
+        # Blobs of the functions we have registered with the master, in
+        # case it asks for one again. It may ask while it holds a job
+        # that calls one, so those stay pinned until their jobs finish.
+        self.functions = cw.FunctionCache()
+        self.job_functions = {}  # {jobid: func_id} for unfinished jobs
+        self.functions_lock = threading.Lock()
+        self.sessions = set()  # The IDs of the sessions sent.
+        self.send_lock = threading.Lock()
 
     def connection_ready(self):
         pass
 
+    def cache_hit(self, result):
+        """Handle a ResultMessage for a job answered from the cache
+        without being sent. (Called on the sending thread.)
+        """
+        pass
+
+    def job_timings(self, jobid, timings):
+        """Handle the Timings for a job that asked for them, just before
+        its result.
+        """
+        pass
+
+    def job_retried(self, jobid, attempt, error):
+        """Handle the failure of an attempt to run a job (because its
+        worker was lost or it timed out), after which the master tries
+        it again.
+        """
+        pass
+
+    def flow_changed(self, paused):
+        """Handle the master asking us to stop sending jobs while its
+        queue is full (`paused`) or to go on.
+        """
+        pass
+
+    def profile_stats(self):
+        """Get a `pstats.Stats` merging the profiles of every job with
+        the `profile` option so far, or None.
+        """
+        return self.jobs.profile
+
     def handle_results(self, callback):
         self.conn = yield bluelet.connect(self.host, self.port)
+        yield self._send(cw.ClientRegisterMessage(
+            self.weight, tuple(cw.codec.CODECS)
+        ))
         self.connection_ready()
 
         while True:
@@ -31,56 +349,201 @@ class Client(object):
             if result is None:
                 print('server connection closed')
                 return
-            assert isinstance(result, cw.ResultMessage)
 
-            callback(result.jobid, result.success,
-                     cw.slow_deser(result.result_blob))
+            if isinstance(result, cw.FunctionRequestMessage):
+                with self.functions_lock:
+                    blob = self.functions.get(result.func_id)
+                if blob is None:
+                    print('master requested an unknown function')
+                else:
+                    yield self._send(cw.FunctionMessage(result.func_id,
+                                                        blob))
+                continue
+
+            if isinstance(result, cw.RetryMessage):
+                self.job_retried(*result)
+                continue
+
+            if isinstance(result, cw.FlowControlMessage):
+                self.flow_changed(result.paused)
+                continue
+
+            if isinstance(result, cw.ResultBatchMessage):
+                results = result.results
+            else:
+                assert isinstance(result, cw.ResultMessage)
+                results = (result,)
+            for result in results:
+                self._release(result.jobid)
+                timings = _timings(result)
+                if timings is not None:
+                    self.job_timings(result.jobid, timings)
+                callback(result.jobid, result.success,
+                         self.jobs.finish(result))
+
+    def _send(self, msg):
+        # Jobs may be sent from several threads at once, so take turns.
+        with self.send_lock:
+            yield cw._sendmsg(self.conn, msg)
+
+    def _register(self, func, jobids):
+        """Get the ID for a function, sending it to the master first if
+        necessary. Keep its blob until the jobs `jobids` finish.
+        """
+        func_id, func_blob = cw.func_ser(func)
+        with self.functions_lock:
+            known = func_id in self.functions
+            self.functions.add(func_id, func_blob)
+            for jobid in jobids:
+                self.functions.ref(func_id)
+                self.job_functions[jobid] = func_id
+        if not known:
+            yield self._send(cw.FunctionMessage(func_id, func_blob))
+        yield bluelet.end(func_id)
+
+    def _release(self, jobid):
+        """Unpin the function of a finished job."""
+        with self.functions_lock:
+            func_id = self.job_functions.pop(jobid, None)
+            if func_id is not None:
+                self.functions.unref(func_id)
+
+    def _open_sessions(self, tasks):
+        """Send the master the sessions of some tasks that it does not
+        have yet.
+        """
+        for session in set(task.session for task in tasks):
+            if session not in self.sessions:
+                yield self._send(self.jobs.sessions.get(session))
+                self.sessions.add(session)
 
     def send_job(self, jobid, func, *args, **kwargs):
-        task = cw.TaskMessage(
-            jobid,
-            cw.func_ser(func), cw.slow_ser(args), cw.slow_ser(kwargs),
-            os.getcwd(),
-            sys.path,
-        )
-        yield cw._sendmsg(self.conn, task)
+        func, options = _unwrap(func)
+        func_id, _ = cw.func_ser(func)
+        msg = self.jobs.prepare(jobid, func, func_id, options, args, kwargs)
+        if isinstance(msg, cw.ResultMessage):
+            self.cache_hit(msg)
+            return
+        yield self._register(func, (jobid,))
+        yield self._open_sessions((msg,))
+        yield self._send(msg)
+
+    def send_jobs(self, func, jobs):
+        """Send many jobs for the same function in a single batch. `jobs`
+        is a sequence of (jobid, args, kwargs) tuples.
+        """
+        func, options = _unwrap(func)
+        func_id, _ = cw.func_ser(func)
+        tasks = []
+        for jobid, args, kwargs in jobs:
+            msg = self.jobs.prepare(jobid, func, func_id, options, args,
+                                    kwargs)
+            if isinstance(msg, cw.ResultMessage):
+                self.cache_hit(msg)
+            else:
+                tasks.append(msg)
+        if not tasks:
+            return
+        yield self._register(func, [task.jobid for task in tasks])
+        yield self._open_sessions(tasks)
+        yield self._send(cw.TaskBatchMessage(tuple(tasks)))
 
 
 class BaseClientThread(threading.Thread, Client):
-    def __init__(self, callback, host=None, port=cw.PORT):
+    """Runs a Client on a thread of its own. Results go to
+    `callback(jobid, success, result)`; for jobs that ask for timings,
+    `timing_callback(jobid, timings)` is called first. Failed attempts
+    to run jobs that will be tried again go to
+    `retry_callback(jobid, attempt, error)`.
+
+    Sending jobs blocks while the master says its queue is full, and,
+    if `max_pending` is set, while that many jobs are unfinished.
+    (Jobs sent from the callbacks, which run on this thread, never
+    wait.)
+    """
+    def __init__(self, callback, host=None, port=cw.PORT, weight=1,
+                 shared_memory=None, store=None, cache=None,
+                 timing_callback=None, serializer=cw.DEFAULT_SERIALIZER,
+                 compression=None, retry_callback=None, max_pending=None):
         threading.Thread.__init__(self)
-        Client.__init__(self, host, port)
+        Client.__init__(self, host, port, weight, shared_memory, store,
+                        cache, serializer, compression)
         self.callback = callback
+        self.timing_callback = timing_callback
+        self.retry_callback = retry_callback
         self.daemon = True
 
         self.ready_condition = threading.Condition()
         self.ready = False
 
-        self.shutdown = False
-        self.shutdown_lock = threading.Lock()
+        # Flow control: the number of jobs sent but not finished, and
+        # whether the master has asked us to pause.
+        self.max_pending = max_pending
+        self.flow_condition = threading.Condition()
+        self.pending = 0
+        self.paused = False
+
+        # A pipe that `stop` writes to in order to wake up this thread.
+        wakeup_r, self.wakeup_w = os.pipe()
+        self.wakeup = os.fdopen(wakeup_r, 'rb', 0)
 
     def connection_ready(self):
         with self.ready_condition:
             self.ready = True
             self.ready_condition.notify_all()
 
+    def cache_hit(self, result):
+        self._finished(result.jobid, True, self.jobs.finish(result))
+
+    def _finished(self, jobid, success, result):
+        with self.flow_condition:
+            self.pending -= 1
+            self.flow_condition.notify_all()
+        self.callback(jobid, success, result)
+
+    def flow_changed(self, paused):
+        with self.flow_condition:
+            self.paused = paused
+            self.flow_condition.notify_all()
+
+    def _wait_for_room(self, count):
+        """Wait until jobs may be sent, and count `count` more as
+        pending.
+        """
+        with self.ready_condition:
+            while not self.ready:
+                self.ready_condition.wait()
+        with self.flow_condition:
+            if threading.current_thread() is not self:
+                while self.paused or (self.max_pending and
+                                      self.pending >= self.max_pending):
+                    self.flow_condition.wait()
+            self.pending += count
+
+    def job_timings(self, jobid, timings):
+        if self.timing_callback is not None:
+            self.timing_callback(jobid, timings)
+
+    def job_retried(self, jobid, attempt, error):
+        if self.retry_callback is not None:
+            self.retry_callback(jobid, attempt, error)
+
     def main_coro(self):
-        handler = self.handle_results(self.callback)
+        handler = self.handle_results(self._finished)
         yield bluelet.spawn(handler)
 
-        # Poll for thread shutdown.
-        while True:
-            yield bluelet.sleep(1)
-            with self.shutdown_lock:
-                if self.shutdown:
-                    break
+        # Wait for thread shutdown.
+        yield bluelet.read(self.wakeup, 1)
 
-        # Halt the handler thread.
+        # Halt the handler thread, but not while it is still registering:
+        # bluelet cannot kill a coroutine in the middle of a send.
+        while not self.ready:
+            yield bluelet.sleep(0.01)
         yield bluelet.kill(handler)
+        self.jobs.release()
 
     def stop(self):
-        with self.shutdown_lock:
-            self.shutdown = True
+        os.write(self.wakeup_w, b'.')
 
     def run(self):
         # Receive on the socket in this thread.
@@ -88,11 +551,14 @@ class BaseClientThread(threading.Thread, Client):
 
     def start_job(self, jobid, func, *args, **kwargs):
         # Synchronously send on the socket in the *calling* thread.
-        with self.ready_condition:
-            while not self.ready:
-                self.ready_condition.wait()
+        self._wait_for_room(1)
         bluelet.run(self.send_job(jobid, func, *args, **kwargs))
 
+    def start_jobs(self, func, jobs):
+        # Like `start_job`, but for a batch.
+        self._wait_for_room(len(jobs))
+        bluelet.run(self.send_jobs(func, jobs))
+
 
 class RemoteException(Exception):
     def __init__(self, error):
@@ -106,8 +572,15 @@ class ClientThread(BaseClientThread):
     """A slightly nicer ClientThread that generates job IDs for you and
     raises exceptions when things go wrong on the remote side.
     """
-    def __init__(self, callback, host=None, port=cw.PORT):
-        super(ClientThread, self).__init__(self._completion, host, port)
+    def __init__(self, callback, host=None, port=cw.PORT, weight=1,
+                 shared_memory=None, store=None, cache=None,
+                 timing_callback=None, serializer=cw.DEFAULT_SERIALIZER,
+                 compression=None, retry_callback=None, max_pending=None):
+        super(ClientThread, self).__init__(self._completion, host, port,
+                                           weight, shared_memory, store,
+                                           cache, timing_callback,
+                                           serializer, compression,
+                                           retry_callback, max_pending)
         self.app_callback = callback
 
         self.active_jobs = 0
@@ -119,6 +592,17 @@ class ClientThread(BaseClientThread):
             self.active_jobs += 1
         self.start_job(jobid, func, *args, **kwargs)
 
+    def submit_many(self, func, jobs):
+        """Submit many jobs that call the same function in one batch.
+        `jobs` is a sequence of (jobid, args, kwargs) tuples. This is
+        much cheaper than calling `submit` for each when the jobs are
+        small.
+        """
+        jobs = list(jobs)
+        with self.jobs_cond:
+            self.active_jobs += len(jobs)
+        self.start_jobs(func, jobs)
+
     def _completion(self, jobid, success, result):
         with self.jobs_cond:
             if success:
@@ -155,8 +639,23 @@ class ClientThread(BaseClientThread):
 
 
 class ClusterExecutor(concurrent.futures.Executor):
-    def __init__(self, host=None, port=cw.PORT):
-        self.thread = BaseClientThread(self._completion, host, port)
+    """An Executor for the cluster. The futures it returns have a
+    `timings` attribute, which holds the job's Timings once it finishes
+    if it asked for them (see `with_options`), and None otherwise, and a
+    `failed_attempts` attribute, a list of the errors from attempts to
+    run the job that were lost or timed out. Submitting blocks while
+    the master's queue is full or `max_pending` jobs are unfinished (see
+    `BaseClientThread`).
+    """
+    def __init__(self, host=None, port=cw.PORT, weight=1,
+                 shared_memory=None, store=None, cache=None,
+                 serializer=cw.DEFAULT_SERIALIZER, compression=None,
+                 max_pending=None):
+        self.thread = BaseClientThread(self._completion, host, port, weight,
+                                       shared_memory, store, cache,
+                                       self._timings, serializer,
+                                       compression, self._retried,
+                                       max_pending)
         self.thread.start()
 
         self.futures = {}
@@ -175,8 +674,32 @@ class ClusterExecutor(concurrent.futures.Executor):
         else:
             future.set_exception(RemoteException(result))
 
-    def submit(self, func, *args, **kwargs):
+    def _timings(self, jobid, timings):
+        with self.jobs_lock:
+            future = self.futures.get(jobid)
+        if future is not None:
+            future.timings = timings
+
+    def _retried(self, jobid, attempt, error):
+        with self.jobs_lock:
+            future = self.futures.get(jobid)
+        if future is not None:
+            future.failed_attempts.append(error)
+
+    def _future(self):
         future = concurrent.futures.Future()
+        future.timings = None
+        future.failed_attempts = []
+        return future
+
+    def profile_stats(self):
+        """Get a `pstats.Stats` merging the profiles of every job with
+        the `profile` option so far, or None.
+        """
+        return self.thread.profile_stats()
+
+    def submit(self, func, *args, **kwargs):
+        future = self._future()
 
         jobid = cw.randid()
         with self.jobs_lock:
@@ -185,6 +708,108 @@ class ClusterExecutor(concurrent.futures.Executor):
 
         return future
 
+    def submit_many(self, func, calls):
+        """Submit a batch of calls to the same function in one message.
+        `calls` is a sequence of (args, kwargs) pairs. Return a list of
+        futures, one per call.
+        """
+        jobs = []
+        futures = []
+        with self.jobs_lock:
+            for args, kwargs in calls:
+                future = self._future()
+                jobid = cw.randid()
+                self.futures[jobid] = future
+                jobs.append((jobid, args, kwargs))
+                futures.append(future)
+        self.thread.start_jobs(func, jobs)
+        return futures
+
+    def map(self, fn, *iterables, **kwargs):
+        """Like `Executor.map`, but with a `chunksize` keyword
+        argument: when it is more than one, calls are submitted in
+        batches of that size.
+        """
+        # Keyword-only arguments would keep this module from loading on
+        # Python 2, so reject unknown ones by hand.
+        timeout = kwargs.pop('timeout', None)
+        chunksize = kwargs.pop('chunksize', 1)
+        if kwargs:
+            raise TypeError(
+                "map() got an unexpected keyword argument '{}'".format(
+                    sorted(kwargs)[0]
+                )
+            )
+        if chunksize <= 1:
+            return super(ClusterExecutor, self).map(fn, *iterables,
+                                                    timeout=timeout)
+
+        if timeout is not None:
+            end_time = timeout + time.time()
+        futures = []
+        calls = zip(*iterables)
+        while True:
+            chunk = [(args, {}) for args in itertools.islice(calls, chunksize)]
+            if not chunk:
+                break
+            futures += self.submit_many(fn, chunk)
+
+        def result_iterator():
+            for future in futures:
+                if timeout is None:
+                    yield future.result()
+                else:
+                    yield future.result(end_time - time.time())
+        return result_iterator()
+
+    def _submit_chunk(self, fn, chunk):
+        # Submit calls to fn for some single arguments; return futures.
+        if len(chunk) == 1:
+            return [self.submit(fn, chunk[0])]
+        return self.submit_many(fn, [((item,), {}) for item in chunk])
+
+    def imap(self, fn, iterable, window=DEFAULT_WINDOW, chunksize=1):
+        """Lazily map a function over an iterable, generating results in
+        order. Unlike `map`, this never has more than `window` calls in
+        flight (or waiting in a small reorder buffer), so it can
+        consume huge or unbounded inputs in bounded memory. With a
+        `chunksize` above one, calls are submitted in batches.
+        """
+        items = iter(iterable)
+        pending = deque()
+        while True:
+            while len(pending) < window:
+                chunk = list(itertools.islice(items, chunksize))
+                if not chunk:
+                    break
+                pending.extend(self._submit_chunk(fn, chunk))
+            if not pending:
+                return
+            yield pending.popleft().result()
+
+    def imap_unordered(self, fn, iterable, window=DEFAULT_WINDOW,
+                       chunksize=1):
+        """Like `imap`, but generate results in the order they finish.
+        """
+        items = iter(iterable)
+        done = queue.Queue()
+        in_flight = 0
+        exhausted = False
+        while True:
+            while not exhausted and in_flight < window:
+                chunk = list(itertools.islice(items, chunksize))
+                if not chunk:
+                    exhausted = True
+                    break
+                for future in self._submit_chunk(fn, chunk):
+                    future.add_done_callback(done.put)
+                    in_flight += 1
+            if not in_flight:
+                return
+            future = done.get()
+            in_flight -= 1
+            yield future.result()
+
     def shutdown(self, wait=True):
         if wait:
             with self.jobs_lock:
@@ -198,7 +823,7 @@ class ClusterExecutor(concurrent.futures.Executor):
 class SlurmExecutor(ClusterExecutor):
 
     def __init__(self):
-        super(SlurmExecutor, self).__init__(cw.slurm.master_host())
+        super(SlurmExecutor, self).__init__(*cw.slurm.master_address())
 
 
 def test():
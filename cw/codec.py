@@ -0,0 +1,155 @@
+from __future__ import print_function
+import time
+import zlib
+from collections import namedtuple
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# Buffers smaller than this are never compressed.
+THRESHOLD = 16 * 1024
+# The link speed, in bytes per second, that compression should keep up
+# with by default (a saturated gigabit link).
+BANDWIDTH = 125 * 1000 * 1000
+# Buffers whose sample shrinks to more than this fraction of its size
+# are sent as they are.
+SKIP_RATIO = 0.9
+# The size of each of the three pieces of a buffer that are compressed
+# to check whether it is worth compressing the rest.
+SAMPLE_SIZE = 16 * 1024
+# Compression rates are averaged over this many buffers before the
+# level changes.
+ADAPT_AFTER = 4
+
+
+Codec = namedtuple('Codec', ['name', 'tag', 'compress', 'decompress',
+                             'min_level', 'max_level'])
+
+CODECS = {}  # {name: Codec}
+_codec_tags = {}  # {tag: Codec}
+
+
+def register_codec(name, tag, compress, decompress, min_level, max_level):
+    """Add a compression codec. `compress(data, level)` and
+    `decompress(data)` take and return bytes-like objects; levels run
+    from `min_level` (fastest) to `max_level` (smallest). `tag` is the
+    byte that identifies the codec on the wire. Peers announce the codecs
+    they have when they connect, and the master decompresses data for
+    peers that lack its codec.
+    """
+    codec = Codec(name, tag, compress, decompress, min_level, max_level)
+    CODECS[name] = codec
+    _codec_tags[tag] = codec
+
+
+register_codec('zlib', b'z', zlib.compress, zlib.decompress, 1, 9)
+if lzma is not None:
+    register_codec('lzma', b'x',
+                   lambda data, level: lzma.compress(data, preset=level),
+                   lzma.decompress, 0, 9)
+
+
+# A compressed blob or out-of-band buffer, which stands in for the
+# original in a message and travels as `data`.
+Compressed = namedtuple('Compressed', ['tag', 'data'])
+
+
+def codec_name(buf):
+    """Get the name of the codec that compressed a buffer, or None if it
+    is not compressed.
+    """
+    if isinstance(buf, Compressed):
+        return _codec_tags[buf.tag].name
+    return None
+
+
+def expand(buf):
+    """Decompress a buffer if it is compressed. The result is writable,
+    like the buffers that arrive uncompressed.
+    """
+    if not isinstance(buf, Compressed):
+        return buf
+    return bytearray(_codec_tags[buf.tag].decompress(buf.data))
+
+
+def wire_size(buf):
+    """Get the number of bytes a buffer takes up in a message.
+    """
+    if isinstance(buf, Compressed):
+        buf = buf.data
+    return memoryview(buf).nbytes
+
+
+def copy(buf):
+    """Copy a buffer (compressed or not) into memory of its own.
+    """
+    if isinstance(buf, Compressed):
+        return Compressed(buf.tag, bytes(buf.data))
+    return bytes(buf)
+
+
+class Compressor(object):
+    """Compresses large buffers with one codec. A buffer is only
+    compressed if a sample of it compresses well. The level adapts to
+    the measured compression rate: it rises while compression runs at
+    more than twice `bandwidth` (so smaller messages are nearly free)
+    and falls when compression cannot keep up with the link.
+    """
+    def __init__(self, codec, threshold=THRESHOLD, bandwidth=BANDWIDTH):
+        self.codec = CODECS[codec]
+        self.threshold = threshold
+        self.bandwidth = bandwidth
+        self.level = self.codec.min_level
+        self._reset()
+
+    def _reset(self):
+        self.rate = 0.0
+        self.samples = 0
+
+    def _compressible(self, view):
+        """Check whether a buffer is likely to compress well, from
+        pieces at its start, middle, and end.
+        """
+        if len(view) <= 3 * SAMPLE_SIZE:
+            return True  # Just try the whole thing.
+        middle = (len(view) - SAMPLE_SIZE) // 2
+        sample = b''.join([view[:SAMPLE_SIZE],
+                           view[middle:middle + SAMPLE_SIZE],
+                           view[-SAMPLE_SIZE:]])
+        compressed = self.codec.compress(sample, self.codec.min_level)
+        return len(compressed) <= SKIP_RATIO * len(sample)
+
+    def _adapt(self, rate):
+        self.rate = (self.rate * self.samples + rate) / (self.samples + 1)
+        self.samples += 1
+        if self.samples < ADAPT_AFTER:
+            return
+        if self.rate > 2 * self.bandwidth and \
+                self.level < self.codec.max_level:
+            self.level += 1
+            self._reset()
+        elif self.rate < self.bandwidth and \
+                self.level > self.codec.min_level:
+            self.level -= 1
+            self._reset()
+
+    def compress(self, buf):
+        """Compress a buffer if that is worthwhile. Return a Compressed
+        or the buffer itself.
+        """
+        view = memoryview(buf)
+        if view.nbytes < self.threshold:
+            return buf
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast('B')
+        if not self._compressible(view):
+            return buf
+
+        start = time.time()
+        data = self.codec.compress(view, self.level)
+        self._adapt(len(view) / max(time.time() - start, 1e-6))
+        if len(data) > SKIP_RATIO * len(view):
+            return buf
+        return Compressed(self.codec.tag, data)
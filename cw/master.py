@@ -1,17 +1,824 @@
 from __future__ import print_function
 import cw
+import cw.codec
+import cw.sched
+import cw.slurm
+import cw.stats
+import cw.store
+import argparse
 import bluelet
+import itertools
+import pickle
+import socket
+import time
+from collections import OrderedDict, deque
+
+
+# How much memory the master's result cache may use by default.
+CACHE_BYTES = 64 * 1024 * 1024
+# By default, a speculative task is a straggler once it has run this
+# many times as long as the median for its function.
+SPECULATE_AFTER = 3.0
+# How often the master looks for stragglers, in seconds.
+SPECULATE_INTERVAL = 1.0
+# The master keeps this many recent run times for each function, and
+# needs at least MIN_RUNTIMES of them to judge its tasks.
+RUNTIMES = 100
+MIN_RUNTIMES = 5
+# How many times a task is tried again after its worker is lost or it
+# times out, by default.
+RETRIES = 3
+# A worker is given up for lost after missing this many heartbeats.
+HEARTBEAT_MISSES = 3
+# How often the master checks for lost workers and timed-out tasks, in
+# seconds.
+WATCH_INTERVAL = 1.0
+# How long a task with an affinity key waits, by default, for one of the
+# workers that recently ran its key before it goes to any worker.
+AFFINITY_DELAY = 0.5
+# The master remembers the workers that ran the most recently used
+# AFFINITY_KEYS keys (and functions), and up to AFFINITY_WORKERS of them
+# per key.
+AFFINITY_KEYS = 4096
+AFFINITY_WORKERS = 4
+# At most this many tasks wait for their workers at once; beyond that,
+# tasks go to any worker straight away.
+MAX_DEFERRED = 256
+# A relay holds results for this long, in seconds, so that it can send
+# those that finish around the same time upstream in one batch.
+RELAY_FLUSH = 0.002
+# How often a relay tells its upstream master that it is alive, in
+# seconds.
+RELAY_HEARTBEAT = 5.0
+# Past this much memory for queued tasks, the master spills newly queued
+# tasks to disk by default (see `cw.sched.SpillingScheduler`).
+SPILL_AFTER = 1024 * 1024 * 1024
+
+
+class ResultCache(object):
+    """Successful results of tasks that clients want cached, by cache
+    key (see `cw.cache.task_key`). Once they take up more than
+    `max_bytes`, the least recently used are evicted.
+    """
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.results = OrderedDict()  # {key: (ResultMessage, size)}
+
+    def get(self, key):
+        if key not in self.results:
+            return None
+        result, size = self.results.pop(key)
+        self.results[key] = result, size
+        return result
+
+    def add(self, key, result):
+        # Results in files may be gone by the time anyone asks again.
+        if key in self.results or not result.success or \
+                cw.spilled(result.result_buffers):
+            return
+        # Copy the result so that it does not keep the rest of the buffer
+        # it arrived in alive.
+        # Timings and profiles describe only the run that produced it.
+        result = result._replace(
+            result_blob=cw.codec.copy(result.result_blob),
+            result_buffers=tuple(cw.codec.copy(b)
+                                 for b in result.result_buffers),
+            timings=None, profile=None,
+        )
+        size = cw.codec.wire_size(result.result_blob) + \
+            sum(cw.codec.wire_size(b) for b in result.result_buffers)
+        if size > self.max_bytes:
+            return
+        self.results[key] = result, size
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, old_size) = self.results.popitem(last=False)
+            self.size -= old_size
+
+
+class Runtimes(object):
+    """Recent run times (from dispatch to result) of tasks by function
+    ID, for the functions used most recently.
+    """
+    def __init__(self, size=cw.FUNCTION_CACHE_SIZE, samples=RUNTIMES):
+        self.samples = samples
+        self.times = cw.LRUCache(size)  # {func_id: deque of seconds}
+
+    def add(self, func_id, seconds):
+        times = self.times.get(func_id)
+        if times is None:
+            times = deque(maxlen=self.samples)
+            self.times[func_id] = times
+        times.append(seconds)
+
+    def median(self, func_id):
+        """Get the median run time for a function, or None if too few of
+        its tasks have finished to tell.
+        """
+        times = self.times.get(func_id)
+        if times is None or len(times) < MIN_RUNTIMES:
+            return None
+        return sorted(times)[len(times) // 2]
+
+
+class Affinity(object):
+    """The workers that most recently ran tasks with each affinity key
+    or, for tasks without one, each function. These workers are likely
+    to have the task's data in their page cache or its function already
+    deserialized.
+    """
+    def __init__(self, size=AFFINITY_KEYS, per_key=AFFINITY_WORKERS):
+        self.per_key = per_key
+        self.recent = cw.LRUCache(size)  # {key: [worker], latest last}
+
+    @staticmethod
+    def key(task):
+        if task.affinity is not None:
+            return 'key', task.affinity
+        return 'func', task.func_id
+
+    def add(self, key, worker):
+        workers = self.recent.get(key)
+        if workers is None:
+            workers = []
+            self.recent[key] = workers
+        elif worker in workers:
+            workers.remove(worker)
+        workers.append(worker)
+        del workers[:-self.per_key]
+
+    def workers(self, key):
+        """Get the workers that recently ran a key, latest first.
+        """
+        return reversed(self.recent.get(key, ()))
 
 
 class Master(object):
-    def __init__(self):
-        self.queued_tasks = []  # (TaskMessage, client connection) pairs
-        self.idle_workers = []  # connections
-        self.active_tasks = {}  # {jobid: client connection}
+    # Whether tasks that run past their timeouts are tried again.
+    enforce_timeouts = True
+
+    def __init__(self, scheduler=None, cache_bytes=CACHE_BYTES,
+                 metrics_file=None,
+                 metrics_interval=cw.stats.METRICS_INTERVAL,
+                 speculate_after=SPECULATE_AFTER, retries=RETRIES,
+                 affinity_delay=AFFINITY_DELAY, port=cw.PORT,
+                 rendezvous=None, token=None, spill_after=SPILL_AFTER,
+                 spill_dir=None, max_queued=None):
+        self.port = port
+        # Where to announce the master's address once it is listening
+        # (see `cw.slurm.write_rendezvous`), and the token for this run.
+        self.rendezvous = rendezvous
+        self.token = token or '{:032x}'.format(cw.randid())
+        # Queued (TaskMessage or TaskBatchMessage, client connection)
+        # pairs. See `cw.sched`.
+        if scheduler is None:
+            scheduler = cw.sched.FIFOScheduler()
+        self.queued_tasks = scheduler
+        # Queued messages waiting for a worker that recently ran their
+        # affinity key: (message, client, key, time deferred) tuples.
+        self.deferred = deque()
+        self.affinity = Affinity()
+        self.affinity_delay = affinity_delay
+        self.redispatching = False  # A _redispatch coroutine is waiting.
+        self.workers = {}  # {worker connection: free credits}
+        # Workers with credits, and those of them with a free slot, in
+        # turn order. (Ordered dicts with None values serve as ordered
+        # sets, so a worker can be found and moved in constant time.)
+        self.ready_workers = OrderedDict()
+        self.free_workers = OrderedDict()
+        # {jobid: (TaskMessage, client connection, worker connection,
+        # dispatch time, number of tasks dispatched together)}
+        self.active_tasks = {}
+        # The number of failed attempts at tasks that have had any, and
+        # the worker of the last one: {jobid: (count, worker
+        # connection)}. After `retries` of them, a task fails.
+        self.attempts = {}
+        self.retries = retries
+        # Speculative copies of straggling tasks:
+        # {jobid: (worker connection, dispatch time)}
+        self.copies = {}
+        self.runtimes = Runtimes()
+        # Tasks that allow it get a copy once they have run this many
+        # times as long as the median for their function (or never, if
+        # this is None).
+        self.speculate_after = speculate_after
         self.connections = set()  # all connections (client + worker)
+        self.functions = cw.FunctionCache()
+        self.awaiting_functions = {}  # {func_id: [(message, client)]}
+        # The sessions of connected clients: {session ID: SessionMessage}.
+        self.sessions = {}
+        self.awaiting_sessions = {}  # {session ID: set of workers}
+        self.results = ResultCache(cache_bytes)
+        self.stats = cw.stats.MasterStats()
+        # Where to write the statistics for Prometheus periodically.
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        # Queued tasks past `spill_after` bytes go to files in
+        # `spill_dir` (unless it is None).
+        if spill_after:
+            self.queued_tasks = cw.sched.SpillingScheduler(
+                self.queued_tasks, spill_after, spill_dir, self.stats
+            )
+        # Clients are told to stop sending tasks while at least
+        # `max_queued` are queued (if it is not None), and to go on once
+        # half that many are left.
+        self.max_queued = max_queued
+        self.paused = False
+        self.clients = set()  # Clients that understand flow control.
 
     def _show_workers(self):
-        print('workers:', len(self.idle_workers) + len(self.active_tasks))
+        print('workers:', len(self.workers))
+
+    def _answer_cached(self, msg):
+        """Split the tasks in a message into those whose results are in
+        the cache and the rest. Return a message with the results for the
+        former and one with the latter, either of which may be None.
+        """
+        hits = []
+        misses = []
+        for task in cw.unbatch(msg):
+            result = None
+            if task.cache_key is not None:
+                result = self.results.get(task.cache_key)
+            if result is None:
+                misses.append(task)
+            else:
+                hits.append(result._replace(jobid=task.jobid))
+        if not hits:
+            return None, msg
+        if not misses:
+            msg = None
+        elif len(misses) == 1:
+            msg = misses[0]
+        else:
+            msg = cw.TaskBatchMessage(tuple(misses))
+        if len(hits) == 1:
+            return hits[0], msg
+        return cw.ResultBatchMessage(tuple(hits)), msg
+
+    def _add_tasks(self, msg, client):
+        """Queue a TaskMessage or TaskBatchMessage, answering the tasks
+        that it can from the result cache. If the master is missing the
+        function for any of its tasks, ask the client for it and hold the
+        message until it arrives.
+        """
+        hits, msg = self._answer_cached(msg)
+        if hits is not None:
+            self.stats.answered(len(cw.unbatch(hits)))
+            yield self._send_results(client, hits)
+        if msg is None:
+            return
+
+        tasks = cw.unbatch(msg)
+        for task in tasks:
+            if task.func_id not in self.functions:
+                waiting = self.awaiting_functions.setdefault(task.func_id,
+                                                             [])
+                waiting.append((msg, client))
+                if len(waiting) == 1:
+                    yield cw._sendmsg(
+                        client, cw.FunctionRequestMessage(task.func_id)
+                    )
+                return
+
+        for task in tasks:
+            self.functions.ref(task.func_id)
+        self.stats.queued(tasks, client)
+        self.queued_tasks.push(msg, client)
+
+    def _add_function(self, func_id, blob):
+        """Store a function blob that was requested from a client and
+        queue the tasks that were waiting for it.
+        """
+        self.functions.add(func_id, blob)
+        for waiting, client in self.awaiting_functions.pop(func_id, []):
+            yield self._add_tasks(waiting, client)
+
+    def _drop_waiting(self, client):
+        """Forget the messages from a client that is gone that were
+        waiting for their functions. Ask the next waiting client for
+        each function that this one had been asked for.
+        """
+        for func_id, waiting in list(self.awaiting_functions.items()):
+            asked = waiting[0][1]
+            waiting[:] = [entry for entry in waiting if entry[1] is not client]
+            if not waiting:
+                del self.awaiting_functions[func_id]
+            elif asked is client:
+                yield cw._sendmsg(waiting[0][1],
+                                  cw.FunctionRequestMessage(func_id))
+
+    def _add_session(self, msg):
+        """Store a SessionMessage and pass it on to the workers that
+        asked for it.
+        """
+        self.sessions[msg.session_id] = msg
+        for worker in self.awaiting_sessions.pop(msg.session_id, ()):
+            if worker in self.workers:
+                worker.cw_sessions.add(msg.session_id)
+                yield cw._sendmsg(worker, msg)
+
+    def _request_session(self, session_id):
+        """Get a session that a worker asked for and this master does
+        not have. A master keeps the sessions of its clients until they
+        leave, so nobody wants the results of the tasks that need it. The
+        worker gets it only if a client sends it again.
+        """
+        return bluelet.null()
+
+    def _drop_sessions(self, conn):
+        """Forget the sessions of a client that is gone, unless other
+        clients use them too, and the sessions a worker that is gone was
+        waiting for.
+        """
+        for session, waiting in list(self.awaiting_sessions.items()):
+            waiting.discard(conn)
+            if not waiting:
+                del self.awaiting_sessions[session]
+        if conn not in self.clients:
+            return
+        in_use = set()
+        for client in self.clients:
+            if client is not conn:
+                in_use.update(client.cw_sessions)
+        for session in conn.cw_sessions - in_use:
+            self.sessions.pop(session, None)
+            for worker in self.workers:
+                worker.cw_sessions.discard(session)
+
+    def _has_free_slot(self, worker):
+        free = self.workers.get(worker, 0)
+        return free > 0 and worker.cw_credits - free < worker.cw_slots
+
+    def _warm_worker(self, key, avoid=None):
+        """Find a worker with a free slot (other than `avoid`) that
+        recently ran an affinity key, or return None.
+        """
+        for worker in self.affinity.workers(key):
+            if worker in self.free_workers and worker is not avoid:
+                return worker
+        return None
+
+    def _any_worker(self, avoid=None):
+        """Get the first ready worker with a free slot or, failing that,
+        the first ready worker. Pass over `avoid` (the worker that last
+        failed a task) unless it is the only ready worker.
+        """
+        for line in (self.free_workers, self.ready_workers):
+            for worker in itertools.islice(line, 2):
+                if worker is not avoid:
+                    return worker
+        return avoid
+
+    def _failed_on(self, msg):
+        """Get the worker that last failed a queued task, or None.
+        """
+        return self.attempts.get(cw.unbatch(msg)[0].jobid, (0, None))[1]
+
+    def _defer(self, msg, client, key):
+        """Hold a queued message back for a worker that recently ran its
+        affinity key, if there is one worth waiting for. Return whether
+        it was deferred.
+        """
+        if not self.affinity_delay or len(self.deferred) >= MAX_DEFERRED:
+            return False
+        if not any(w in self.workers for w in self.affinity.workers(key)):
+            return False  # Nobody has it warm.
+        self.deferred.append((msg, client, key, time.time()))
+        return True
+
+    def _next_work(self):
+        """Choose the next message to dispatch and a ready worker for it.
+        A message goes to a worker that recently ran its affinity key (or
+        function) if one is ready. Messages with an explicit key may wait
+        up to `affinity_delay` for such a worker while later ones go
+        ahead. Return a (message, client, worker) tuple, or None if
+        nothing can be dispatched.
+        """
+        now = time.time()
+        for index, (msg, client, key, since) in enumerate(self.deferred):
+            worker = self._warm_worker(key)
+            if worker is not None or now - since >= self.affinity_delay:
+                del self.deferred[index]
+                self.stats.placed(worker is not None)
+                worker = worker or self._any_worker(self._failed_on(msg))
+                return self._split(msg, client, worker), client, worker
+
+        while self.queued_tasks:
+            msg, client = self.queued_tasks.pop()
+            task = cw.unbatch(msg)[0]
+            key = Affinity.key(task)
+            failed = self._failed_on(msg)
+            worker = self._warm_worker(key, failed)
+            if task.affinity is not None:
+                if worker is None and self._defer(msg, client, key):
+                    continue
+                self.stats.placed(worker is not None)
+            worker = worker or self._any_worker(failed)
+            return self._split(msg, client, worker), client, worker
+        return None
+
+    def _split(self, msg, client, worker):
+        """Get the part of a queued message to send to a worker. A batch
+        is split when that lets more ready workers share it, and the rest
+        goes back to the front of the queue.
+        """
+        if isinstance(msg, cw.TaskBatchMessage):
+            if worker.cw_protocol == cw.PROTOCOL_LEGACY:
+                share = len(msg.tasks)  # Legacy workers take one task.
+            else:
+                share = len(self.ready_workers) - len(self.queued_tasks)
+            if share > 1 and len(msg.tasks) > 1:
+                count = -(-len(msg.tasks) // share)  # Ceiling division.
+                rest = cw.TaskBatchMessage(msg.tasks[count:])
+                msg = cw.TaskBatchMessage(msg.tasks[:count])
+                if rest.tasks:
+                    self.queued_tasks.push_front(rest, client)
+            if len(msg.tasks) == 1:
+                msg = msg.tasks[0]
+        return msg
+
+    def _line_up(self, worker, to_back=False):
+        """Update a worker's places in the lines of ready workers and of
+        those with a free slot after its credits change. A worker that
+        joins a line, or that is sent `to_back`, goes to the back of it.
+        """
+        for line, belongs in ((self.ready_workers,
+                               self.workers.get(worker, 0) > 0),
+                              (self.free_workers,
+                               self._has_free_slot(worker))):
+            if not belongs:
+                line.pop(worker, None)
+            elif to_back or worker not in line:
+                line.pop(worker, None)
+                line[worker] = None
+
+    def _take_credit(self, worker):
+        """Use one of a ready worker's credits and move it to the back of
+        the line.
+        """
+        self.workers[worker] -= 1
+        self._line_up(worker, to_back=True)
+
+    def _add_credit(self, worker, count=1):
+        """Return credits to a worker, making it ready for more work. A
+        negative `count` takes credits away (when a relay loses some of
+        its workers), which can leave it with fewer than none free.
+        """
+        if worker in self.workers:
+            self.workers[worker] += count
+            self._line_up(worker)
+
+    def _finish_task(self, result, worker):
+        """Forget about a task completed by a worker, caching its result
+        if the client asked for that. Return its client connection and a
+        list of the other workers running the task (a speculative copy
+        or a newer attempt), which should abandon it.
+        """
+        task, client, original, started, share = \
+            self.active_tasks.pop(result.jobid)
+        self.attempts.pop(result.jobid, None)
+        self.functions.unref(task.func_id)
+        self.stats.finished(result, client, worker)
+        if task.cache_key is not None:
+            self.results.add(task.cache_key, result)
+
+        # The result may also come from a copy or from an earlier attempt
+        # that timed out.
+        running = [(original, started)]
+        if result.jobid in self.copies:
+            running.append(self.copies.pop(result.jobid))
+            self.functions.unref(task.func_id)
+        losers = []
+        for other, other_started in running:
+            if other is not worker:
+                losers.append(other)
+            elif share == 1 and result.success:
+                # Batches do not count towards run times.
+                self.runtimes.add(task.func_id,
+                                  time.time() - other_started)
+        return client, losers
+
+    def _discard_result(self, result, worker):
+        """Drop a result for a task that is no longer active because a
+        copy of it finished first (or because it was given up on).
+        """
+        self.stats.abandoned(worker)
+        for path in cw.spilled(result.result_buffers):
+            cw.store.unlink(path)  # If we can reach it.
+
+    def _idle_worker(self, busy):
+        """Find a worker (other than `busy`) that has no tasks in flight
+        and understands CancelMessages, or return None.
+        """
+        for worker in self.free_workers:
+            if worker is not busy and \
+                    worker.cw_protocol != cw.PROTOCOL_LEGACY and \
+                    self.workers[worker] == worker.cw_credits:
+                return worker
+        return None
+
+    def _drainable(self, names):
+        """Get the workers among those named (as `cw.stats` names them)
+        that can be let go now: those with no tasks in flight (including
+        copies) that understand WorkerDepartMessages.
+        """
+        names = set(names)
+        copying = set(worker for worker, _ in self.copies.values())
+        return [worker for worker in self.workers
+                if cw.stats._name(worker) in names and
+                worker.cw_protocol != cw.PROTOCOL_LEGACY and
+                self.workers[worker] == worker.cw_credits and
+                worker not in copying]
+
+    def _next_copy(self):
+        """Choose a straggling task to copy and an idle worker for the
+        copy, and record it as dispatched. Return the (worker, task)
+        pair, or None if there is no work for a copy.
+        """
+        if self.queued_tasks or self.deferred:
+            return None  # Workers have better things to do.
+        now = time.time()
+        for jobid, (task, client, worker, started, share) in \
+                self.active_tasks.items():
+            if not task.speculative or share > 1 or \
+                    jobid in self.copies or client not in self.connections:
+                continue
+            median = self.runtimes.median(task.func_id)
+            if median is None or \
+                    now - started <= self.speculate_after * median:
+                continue
+            copy_worker = self._idle_worker(worker)
+            if copy_worker is None:
+                return None
+            self._take_credit(copy_worker)
+            self.copies[jobid] = copy_worker, now
+            self.functions.ref(task.func_id)
+            self.stats.speculated_on(copy_worker)
+            return copy_worker, task
+        return None
+
+    def _dispatch(self):
+        """Dispatch as many waiting tasks as we can.
+        """
+        while self.ready_workers:
+            choice = self._next_work()
+            if choice is None:
+                break
+            work, client, worker = choice
+            if client in self.connections:
+                self._take_credit(worker)
+                tasks = cw.unbatch(work)
+                now = time.time()
+                for task in tasks:
+                    self.active_tasks[task.jobid] = (task, client, worker,
+                                                     now, len(tasks))
+                self.affinity.add(Affinity.key(tasks[0]), worker)
+                if tasks[0].affinity is not None:
+                    self.affinity.add(('func', tasks[0].func_id), worker)
+                self.stats.dispatched_to(tasks, client, worker)
+                yield self._send_tasks(worker, work)
+            else:
+                tasks = cw.unbatch(work)
+                for task in tasks:
+                    self.functions.unref(task.func_id)
+                    self.attempts.pop(task.jobid, None)
+                self.stats.dropped(tasks, client)
+
+        if self.deferred and not self.redispatching:
+            self.redispatching = True
+            yield bluelet.spawn(self._redispatch())
+
+    def _redispatch(self):
+        """Dispatch again whenever the oldest deferred message has waited
+        long enough to go to any worker. (While no worker is ready, the
+        next result triggers a dispatch anyway.)
+        """
+        while self.deferred and self.ready_workers:
+            since = self.deferred[0][3]
+            yield bluelet.sleep(max(since + self.affinity_delay -
+                                    time.time(), 0))
+            yield self._dispatch()
+        self.redispatching = False
+
+    def _retry(self, jobid, error):
+        """Give up on the current attempt at an active task and queue it
+        again, ahead of other tasks, telling the client why. If it has
+        already been tried `retries` times (or its client is gone), fail
+        it instead. A result from the failed attempt is still welcome if
+        it arrives while the task is active again.
+        """
+        task, client, worker, started, share = self.active_tasks.pop(jobid)
+        if jobid in self.copies:
+            del self.copies[jobid]
+            self.functions.unref(task.func_id)
+        attempts = self.attempts.pop(jobid, (0, None))[0] + 1
+
+        if attempts <= self.retries and client in self.connections:
+            self.attempts[jobid] = attempts, worker
+            self.stats.requeued(task, client)
+            self.queued_tasks.push_front(task, client)
+            if client.cw_protocol != cw.PROTOCOL_LEGACY:
+                yield cw._sendmsg(client,
+                                  cw.RetryMessage(jobid, attempts, error))
+            return
+
+        self.functions.unref(task.func_id)
+        result = cw.ResultMessage(jobid, False, *cw.ser(
+            'gave up after {} failed attempts; the last: {}'.format(
+                attempts, error
+            )
+        ))
+        # The worker's count of tasks in flight drops if it answers.
+        self.stats.finished(result, client, None)
+        if client in self.connections:
+            yield self._send_results(client, result)
+
+    def _lose_worker(self, worker, reason):
+        """Stop using a worker that departed, disconnected, or stopped
+        sending heartbeats, and try the tasks it was running again.
+        """
+        if worker not in self.workers:
+            return
+        del self.workers[worker]
+        self._line_up(worker)
+        self.stats.forget(worker)
+        self._show_workers()
+
+        for jobid, (copy_worker, _) in list(self.copies.items()):
+            if copy_worker is worker:
+                del self.copies[jobid]
+                self.functions.unref(self.active_tasks[jobid][0].func_id)
+        orphans = []
+        for jobid, entry in self.active_tasks.items():
+            if entry[2] is not worker:
+                continue
+            if jobid in self.copies:
+                # Let the copy carry on in its place.
+                copy_worker, copy_started = self.copies.pop(jobid)
+                self.functions.unref(entry[0].func_id)
+                self.active_tasks[jobid] = entry[:2] + (copy_worker,
+                                                        copy_started, 1)
+            else:
+                orphans.append(jobid)
+        error = 'worker {} {}'.format(cw.stats._name(worker), reason)
+        for jobid in orphans:
+            yield self._retry(jobid, error)
+
+    def watch(self):
+        """Periodically give up on workers that have missed too many
+        heartbeats and on tasks that have run past their timeouts.
+        """
+        while True:
+            yield bluelet.sleep(WATCH_INTERVAL)
+            now = time.time()
+            for worker in list(self.workers):
+                heartbeat = worker.cw_heartbeat
+                if heartbeat and \
+                        now - worker.cw_seen > HEARTBEAT_MISSES * heartbeat:
+                    yield self._lose_worker(worker, 'stopped responding')
+                    try:
+                        # Its coroutine sees the connection close.
+                        worker.sock.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+
+            expired = []
+            for jobid, (task, client, worker, started, share) in \
+                    self.active_tasks.items():
+                if jobid in self.copies:
+                    started = self.copies[jobid][1]
+                if task.timeout and self.enforce_timeouts and \
+                        now - started > task.timeout * share:
+                    expired.append((jobid, worker, task.timeout))
+            for jobid, worker, timeout in expired:
+                if jobid in self.active_tasks:  # Not finished meanwhile.
+                    yield self._retry(jobid, 'timed out after {}s on '
+                                      'worker {}'.format(
+                                          timeout, cw.stats._name(worker)
+                                      ))
+            yield self._dispatch()
+
+    def speculate(self):
+        """Periodically copy straggling tasks (those that are allowed to
+        run twice) to idle workers. Whichever copy finishes first wins.
+        """
+        while True:
+            yield bluelet.sleep(SPECULATE_INTERVAL)
+            while self.ready_workers:
+                copy = self._next_copy()
+                if copy is None:
+                    break
+                worker, task = copy
+                yield self._send_tasks(worker, task)
+
+    def _from_legacy(self, task):
+        """Convert a TaskMessage from a legacy client, which carries the
+        function blob itself, to one that refers to the function by ID.
+        """
+        func_blob = bytes(task.func_id)
+        func_id = cw.func_hash(func_blob)
+        self.functions.add(func_id, func_blob)
+        return task._replace(func_id=func_id)
+
+    def _for_peer(self, msg, peer):
+        """Prepare a message for a peer, decompressing whatever it lacks
+        the codec for.
+        """
+        return cw.expand_message(msg, getattr(peer, 'cw_codecs', ()))
+
+    def _to_legacy(self, task):
+        """Convert a TaskMessage for a legacy worker, which expects the
+        function blob itself, untagged blobs (with no out-of-band
+        buffers), and no sessions. Raise cw.Unconvertible if the task
+        cannot be converted.
+        """
+        if task.session is not None:
+            session = self.sessions.get(task.session)
+            if session is None:
+                raise cw.Unconvertible('its session is gone')
+            task = task._replace(cwd=session.cwd, syspath=session.syspath)
+        return task._replace(
+            func_id=cw.untag(self.functions.get(task.func_id)),
+            args_blob=cw.untag(task.args_blob, task.args_buffers),
+            kwargs_blob=cw.untag(task.kwargs_blob, task.kwargs_buffers),
+            args_buffers=(),
+            kwargs_buffers=(),
+        )
+
+    def _refuse_task(self, worker, task, error):
+        """Fail a task that was dispatched to a legacy worker but cannot
+        be converted for it.
+        """
+        self._add_credit(worker)
+        result = cw.ResultMessage(task.jobid, False, *cw.ser(
+            'cannot run on legacy worker {}: {}'.format(
+                cw.stats._name(worker), error
+            )
+        ))
+        client, _ = self._finish_task(result, worker)
+        if client in self.connections:
+            yield self._send_results(client, result)
+
+    def _send_tasks(self, worker, msg):
+        """Send a TaskMessage or TaskBatchMessage to a worker, preceded by
+        the sessions it refers to that the worker has not seen yet.
+        """
+        if worker.cw_protocol == cw.PROTOCOL_LEGACY:
+            # Legacy workers take one task at a time (see `_split`).
+            try:
+                msg = self._to_legacy(msg)
+            except cw.Unconvertible as exc:
+                yield self._refuse_task(worker, msg, exc)
+                return
+        else:
+            for task in cw.unbatch(msg):
+                if task.session is not None and \
+                        task.session not in worker.cw_sessions:
+                    session = self.sessions.get(task.session)
+                    if session is not None:  # Else the worker asks.
+                        worker.cw_sessions.add(task.session)
+                        yield cw._sendmsg(worker, session)
+        yield cw._sendmsg(worker, self._for_peer(msg, worker))
+
+    def _result_to_legacy(self, result):
+        """Convert a ResultMessage for a legacy client. A result that
+        cannot be converted becomes an error.
+        """
+        try:
+            blob = cw.untag(result.result_blob, result.result_buffers)
+        except cw.Unconvertible as exc:
+            blob = pickle.dumps('cannot send result to legacy client: '
+                                '{}'.format(exc), cw.LEGACY_PICKLE_PROTOCOL)
+            return cw.ResultMessage(result.jobid, False, blob)
+        return result._replace(result_blob=blob, result_buffers=())
+
+    def _send_results(self, client, msg):
+        """Send a ResultMessage or ResultBatchMessage to a client.
+        """
+        if client.cw_protocol == cw.PROTOCOL_LEGACY:
+            # Legacy clients know nothing of batches.
+            for result in cw.unbatch(msg):
+                yield cw._sendmsg(client, self._result_to_legacy(result))
+            return
+        yield cw._sendmsg(client, self._for_peer(msg, client))
+
+    def _flow_control(self):
+        """Tell clients to pause or go on if the queue has filled up or
+        emptied enough since the last time.
+        """
+        if self.max_queued is None:
+            return
+        backlog = self.stats.backlog()
+        if not self.paused and backlog >= self.max_queued:
+            self.paused = True
+        elif self.paused and backlog <= self.max_queued // 2:
+            self.paused = False
+        else:
+            return
+        for client in list(self.clients):
+            yield cw._sendmsg(client, cw.FlowControlMessage(self.paused))
 
     def communicate(self, conn):
         self.connections.add(conn)
@@ -21,37 +828,457 @@ class Master(object):
             msg = yield cw._readmsg(conn)
             if msg is None:
                 break
+            conn.cw_seen = time.time()
 
-            if isinstance(msg, cw.TaskMessage):
-                self.queued_tasks.append((msg, conn))
-            elif isinstance(msg, cw.ResultMessage):
-                client = self.active_tasks.pop(msg.jobid)
-                self.idle_workers.append(conn)
-                if client in self.connections:
-                    # Ensure client has not disappeared.
-                    yield cw._sendmsg(client, msg)
+            if isinstance(msg, (cw.TaskMessage, cw.TaskBatchMessage)):
+                if conn.cw_protocol == cw.PROTOCOL_LEGACY:
+                    msg = self._from_legacy(msg)
+                yield self._add_tasks(msg, conn)
+            elif isinstance(msg, cw.FunctionMessage):
+                yield self._add_function(msg.func_id, msg.func_blob)
+            elif isinstance(msg, cw.SessionMessage):
+                conn.cw_sessions.add(msg.session_id)
+                yield self._add_session(msg)
+            elif isinstance(msg, cw.SessionRequestMessage):
+                # A worker dropped a session that it needs again.
+                session = self.sessions.get(msg.session_id)
+                if session is not None:
+                    conn.cw_sessions.add(msg.session_id)
+                    yield cw._sendmsg(conn, session)
+                else:
+                    waiting = self.awaiting_sessions.setdefault(
+                        msg.session_id, set()
+                    )
+                    if not waiting:
+                        yield self._request_session(msg.session_id)
+                    waiting.add(conn)
+            elif isinstance(msg, cw.FunctionRequestMessage):
+                blob = self.functions.get(msg.func_id)
+                if blob is not None:
+                    yield cw._sendmsg(conn,
+                                      cw.FunctionMessage(msg.func_id, blob))
+            elif isinstance(msg, cw.StatsRequestMessage):
+                yield cw._sendmsg(conn, cw.StatsMessage(self.stats.snapshot()))
+            elif isinstance(msg, (cw.ResultMessage, cw.ResultBatchMessage)):
+                if isinstance(msg, cw.ResultBatchMessage):
+                    self._add_credit(conn, msg.credits)
+                else:
+                    self._add_credit(conn)
+                results = cw.unbatch(msg)
+                # A relay's batches can hold results for several clients.
+                finished = OrderedDict()  # {client: [ResultMessage]}
+                for result in results:
+                    if result.jobid not in self.active_tasks:
+                        # Another worker finished it first.
+                        self._discard_result(result, conn)
+                        continue
+                    client, losers = self._finish_task(result, conn)
+                    finished.setdefault(client, []).append(result)
+                    for loser in losers:
+                        if loser in self.workers and \
+                                loser.cw_protocol != cw.PROTOCOL_LEGACY:
+                            yield cw._sendmsg(
+                                loser, cw.CancelMessage(result.jobid)
+                            )
+                for client, client_results in finished.items():
+                    if client not in self.connections:
+                        continue  # The client has disappeared.
+                    if len(client_results) == len(results):
+                        out = msg
+                    elif len(client_results) == 1:
+                        out = client_results[0]
+                    else:
+                        out = cw.ResultBatchMessage(tuple(client_results))
+                    yield self._send_results(client, out)
+            elif isinstance(msg, cw.ClientRegisterMessage):
+                self.queued_tasks.set_weight(conn, msg.weight)
+                conn.cw_codecs = frozenset(msg.codecs)
+                self.clients.add(conn)
+                conn.cw_sessions = set()  # The session IDs received.
+                if self.paused:
+                    yield cw._sendmsg(conn, cw.FlowControlMessage(True))
             elif isinstance(msg, cw.WorkerRegisterMessage):
-                self.idle_workers.append(conn)
-                self._show_workers()
+                # Relays register again when their workers change.
+                added = msg.credits
+                if conn in self.workers:
+                    added -= conn.cw_credits
+                else:
+                    self.workers[conn] = 0
+                    conn.cw_sessions = set()  # The session IDs sent.
+                    self.stats.add_worker(conn)
+                    self._show_workers()
+                conn.cw_credits = msg.credits
+                conn.cw_slots = msg.slots or msg.credits
+                conn.cw_heartbeat = msg.heartbeat
+                conn.cw_codecs = frozenset(msg.codecs)
+                self._add_credit(conn, added)
             elif isinstance(msg, cw.WorkerDepartMessage):
-                self.idle_workers.remove(conn)
-                self._show_workers()
+                yield self._lose_worker(conn, 'departed')
+            elif isinstance(msg, cw.HeartbeatMessage):
+                pass
+            elif isinstance(msg, cw.RetryMessage):
+                # A relay is trying one of our tasks again.
+                entry = self.active_tasks.get(msg.jobid)
+                if entry is not None and entry[1] in self.connections and \
+                        entry[1].cw_protocol != cw.PROTOCOL_LEGACY:
+                    yield cw._sendmsg(entry[1], msg)
+            elif isinstance(msg, cw.DrainMessage):
+                drained = self._drainable(msg.workers)
+                for worker in drained:
+                    yield self._lose_worker(worker, 'drained')
+                    yield cw._sendmsg(worker, cw.WorkerDepartMessage())
+                yield cw._sendmsg(conn, cw.DrainMessage(
+                    tuple(cw.stats._name(worker) for worker in drained)
+                ))
             else:
                 assert False
 
-            # Dispatch as many waiting tasks as we can.
-            while self.queued_tasks and self.idle_workers:
-                task_message, client = self.queued_tasks.pop(0)
-                if client in self.connections:
-                    worker = self.idle_workers.pop(0)
-                    self.active_tasks[task_message.jobid] = client
-                    yield cw._sendmsg(worker, task_message)
+            yield self._dispatch()
+            yield self._flow_control()
 
         self.connections.remove(conn)
+        self._drop_sessions(conn)
+        self.clients.discard(conn)
+        self.stats.forget(conn)
+        self.queued_tasks.forget(conn)
+        yield self._drop_waiting(conn)
+        yield self._lose_worker(conn, 'disconnected')
+        yield self._dispatch()
+        yield self._flow_control()
+
+    def write_metrics(self):
+        """Rewrite the metrics file every `metrics_interval` seconds.
+        """
+        while True:
+            cw.stats.write_metrics(self.metrics_file, self.stats.snapshot())
+            yield bluelet.sleep(self.metrics_interval)
+
+    def announce(self):
+        """Write the rendezvous file as soon as the server is listening.
+        """
+        # bluelet opens the listening socket when the server coroutine
+        # starts, so wait until it takes connections.
+        while True:
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                break
+            except socket.error:
+                yield bluelet.sleep(0.05)
+        cw.slurm.write_rendezvous(self.rendezvous, socket.gethostname(),
+                                  self.port, self.token)
+
+    def serve(self):
+        if self.rendezvous:
+            yield bluelet.spawn(self.announce())
+        if self.metrics_file:
+            yield bluelet.spawn(self.write_metrics())
+        if self.speculate_after is not None:
+            yield bluelet.spawn(self.speculate())
+        yield bluelet.spawn(self.watch())
+        yield bluelet.server('', self.port, self.communicate)
 
     def run(self):
-        bluelet.run(bluelet.server('', cw.PORT, self.communicate))
+        bluelet.run(self.serve())
+
+
+class Relay(Master):
+    """A master for the workers on one node (or rack) of a big cluster.
+    It connects to the real master as a single worker with all of their
+    slots, so the upstream master keeps one connection per relay instead
+    of one per worker. Each function blob crosses the network once per
+    relay, and results that finish together go upstream in one batch.
+
+    The upstream connection plays the part of the client here: its tasks
+    are queued and dispatched to local workers as usual, and tasks on
+    local workers that are lost are tried again without the upstream
+    master's help. Speculation, timeouts, and result caching are left to
+    the upstream master.
+    """
+    enforce_timeouts = False
+
+    def __init__(self, upstream, upstream_port=cw.PORT, port=cw.RELAY_PORT,
+                 retries=RETRIES, affinity_delay=AFFINITY_DELAY,
+                 heartbeat=RELAY_HEARTBEAT, metrics_file=None,
+                 metrics_interval=cw.stats.METRICS_INTERVAL):
+        # A result cache would answer some of the tasks in a message from
+        # upstream separately from the rest, so there is none.
+        # Nor does it spill tasks: the upstream master sends no more than
+        # its workers can take.
+        Master.__init__(self, cache_bytes=0, metrics_file=metrics_file,
+                        metrics_interval=metrics_interval,
+                        speculate_after=None, retries=retries,
+                        affinity_delay=affinity_delay, port=port,
+                        spill_after=None)
+        self.upstream_host = upstream
+        self.upstream_port = upstream_port
+        self.heartbeat = heartbeat
+        self.upstream = None  # The connection to the upstream master.
+        # The number of unfinished tasks in each message from upstream,
+        # shared by its tasks: {jobid: [count]}. The message's credit
+        # goes back upstream when its count reaches zero.
+        self.unfinished = {}
+        self.outbox = []  # Results waiting to go upstream.
+        self.owed = 0  # Credits to send back with them.
+        self.flushing = False  # A _flush coroutine is waiting.
+        self.advertised = None  # The (credits, slots) registered upstream.
+        # There is no telling when the clients of sessions from upstream
+        # leave, so only the most recent are kept. Upstream sends the
+        # others again when asked.
+        self.sessions = cw.LRUCache(cw.FUNCTION_CACHE_SIZE)
+
+    def _done(self, count):
+        """Count one task of a message from upstream as finished.
+        """
+        count[0] -= 1
+        if not count[0]:
+            self.owed += 1
+
+    def _track(self, msg):
+        """Start counting the tasks in a message from upstream. Return
+        the part of it to queue, or None if that is nothing. The upstream
+        master sends a task again when it times out, possibly to the
+        same relay. If it is running here, it goes back to the front of
+        the queue (a result from the first attempt is still welcome), and
+        if it is queued here, it stays there. Either way, it now counts
+        towards the new message instead of the old one.
+        """
+        tasks = cw.unbatch(msg)
+        count = [len(tasks)]
+        fresh = []
+        for task in tasks:
+            earlier = self.unfinished.get(task.jobid)
+            if earlier is None:
+                fresh.append(task)
+            else:
+                self._done(earlier)
+                entry = self.active_tasks.pop(task.jobid, None)
+                if entry is not None:
+                    self.stats.requeued(task, self.upstream)
+                    self.queued_tasks.push_front(entry[0], self.upstream)
+            self.unfinished[task.jobid] = count
+        if len(fresh) == len(tasks):
+            return msg
+        elif not fresh:
+            return None
+        elif len(fresh) == 1:
+            return fresh[0]
+        return cw.TaskBatchMessage(tuple(fresh))
+
+    def _send_results(self, client, msg):
+        """Queue results to go upstream in the next batch.
+        """
+        if client is not self.upstream:
+            yield Master._send_results(self, client, msg)
+            return
+        for result in cw.unbatch(msg):
+            self._done(self.unfinished.pop(result.jobid))
+            self.outbox.append(result)
+        yield self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self.flushing:
+            self.flushing = True
+            yield bluelet.spawn(self._flush())
+
+    def _flush(self):
+        """Send the results gathered over the last RELAY_FLUSH seconds
+        upstream, along with the credits they return.
+        """
+        yield bluelet.sleep(RELAY_FLUSH)
+        results, self.outbox = self.outbox, []
+        credits, self.owed = self.owed, 0
+        self.flushing = False
+        if len(results) == 1 and credits == 1:
+            msg = results[0]
+        else:
+            msg = cw.ResultBatchMessage(tuple(results), credits)
+        yield cw._sendmsg(self.upstream, msg)
+
+    def _cancel(self, jobid):
+        """Pass a CancelMessage from upstream on to the local worker
+        running the task, if it has been dispatched.
+        """
+        entry = self.active_tasks.get(jobid)
+        if entry is not None and entry[2] in self.workers and \
+                entry[2].cw_protocol != cw.PROTOCOL_LEGACY:
+            yield cw._sendmsg(entry[2], cw.CancelMessage(jobid))
+
+    def _request_session(self, session_id):
+        """Ask upstream for a session that a local worker needs again.
+        """
+        yield cw._sendmsg(self.upstream, cw.SessionRequestMessage(session_id))
+
+    def _advertise(self):
+        """Register upstream again if local workers have come or gone
+        since the last time, so that the upstream master sends as many
+        tasks as they can take.
+        """
+        slots = sum(w.cw_slots for w in self.workers)
+        # Ask for a task per slot beyond what the workers would keep in
+        # flight themselves, to make up for the extra hop.
+        capacity = (sum(w.cw_credits for w in self.workers) + slots, slots)
+        if self.upstream is not None and capacity != self.advertised:
+            self.advertised = capacity
+            credits, slots = capacity
+            yield cw._sendmsg(self.upstream, cw.WorkerRegisterMessage(
+                credits, tuple(cw.codec.CODECS), self.heartbeat or None,
+                slots
+            ))
+
+    def _dispatch(self):
+        yield self._advertise()
+        yield Master._dispatch(self)
+
+    def send_heartbeats(self):
+        while True:
+            yield bluelet.sleep(self.heartbeat)
+            yield cw._sendmsg(self.upstream, cw.HeartbeatMessage())
+
+    def relay(self):
+        """Connect to the upstream master and take tasks from it until it
+        goes away, which ends the relay.
+        """
+        conn = yield bluelet.connect(self.upstream_host, self.upstream_port)
+        conn.cw_protocol = cw.PROTOCOL_FRAMED
+        conn.cw_codecs = frozenset(cw.codec.CODECS)
+        self.upstream = conn
+        self.connections.add(conn)
+        yield self._advertise()
+        if self.heartbeat:
+            yield bluelet.spawn(self.send_heartbeats())
+
+        while True:
+            msg = yield cw._readmsg(conn)
+            if msg is None:
+                break
+
+            if isinstance(msg, (cw.TaskMessage, cw.TaskBatchMessage)):
+                msg = self._track(msg)
+                if msg is not None:
+                    yield self._add_tasks(msg, conn)
+                if self.owed:
+                    yield self._schedule_flush()
+            elif isinstance(msg, cw.FunctionMessage):
+                yield self._add_function(msg.func_id, msg.func_blob)
+            elif isinstance(msg, cw.SessionMessage):
+                yield self._add_session(msg)
+            elif isinstance(msg, cw.CancelMessage):
+                yield self._cancel(msg.jobid)
+            elif isinstance(msg, cw.WorkerDepartMessage):
+                # The upstream master has let this relay go (it was idle),
+                # so its workers go too.
+                for worker in list(self.workers):
+                    if worker.cw_protocol != cw.PROTOCOL_LEGACY:
+                        yield cw._sendmsg(worker, cw.WorkerDepartMessage())
+                print('released by upstream master')
+                raise SystemExit(0)
+            else:
+                assert False
+
+            yield self._dispatch()
+
+        print('upstream master disconnected')
+        raise SystemExit(1)
+
+    def serve(self):
+        yield bluelet.spawn(self.relay())
+        yield Master.serve(self)
 
 
 if __name__ == '__main__':
-    Master().run()
+    parser = argparse.ArgumentParser(description='run the cluster master')
+    parser.add_argument(
+        '--port', metavar='N', type=int, default=None,
+        help='port to listen on (default {}, or {} for a relay)'.format(
+            cw.PORT, cw.RELAY_PORT
+        )
+    )
+    parser.add_argument(
+        '--rendezvous', metavar='PATH', default=None,
+        help='write the master\'s address to this file once it is '
+             'listening, for workers and clients to find'
+    )
+    parser.add_argument(
+        '--token', default=None,
+        help='identify this run in the rendezvous file (default random)'
+    )
+    parser.add_argument(
+        '--relay', metavar='HOST[:PORT]', default=None,
+        help='serve the workers on this node as a relay for the master '
+             'on HOST'
+    )
+    parser.add_argument(
+        '--scheduler', choices=sorted(cw.sched.SCHEDULERS), default='fifo',
+        help='policy for choosing among queued tasks (default fifo)'
+    )
+    parser.add_argument(
+        '--cache-size', metavar='MB', type=int,
+        default=CACHE_BYTES // (1024 * 1024),
+        help='memory for cached results (default {})'.format(
+            CACHE_BYTES // (1024 * 1024)
+        )
+    )
+    parser.add_argument(
+        '--metrics-file', metavar='PATH', default=None,
+        help='periodically write statistics here for Prometheus'
+    )
+    parser.add_argument(
+        '--metrics-interval', metavar='SECONDS', type=float,
+        default=cw.stats.METRICS_INTERVAL,
+        help='how often to write the metrics file (default {})'.format(
+            cw.stats.METRICS_INTERVAL
+        )
+    )
+    parser.add_argument(
+        '--speculate-after', metavar='MULTIPLE', type=float,
+        default=SPECULATE_AFTER,
+        help='copy speculative tasks that have run this many times as '
+             'long as usual (default {}; 0 to disable)'.format(
+                 SPECULATE_AFTER
+             )
+    )
+    parser.add_argument(
+        '--retries', metavar='N', type=int, default=RETRIES,
+        help='times to try a task again after its worker is lost or it '
+             'times out (default {})'.format(RETRIES)
+    )
+    parser.add_argument(
+        '--affinity-delay', metavar='SECONDS', type=float,
+        default=AFFINITY_DELAY,
+        help='how long tasks with affinity keys wait for a worker that '
+             'has run their key (default {})'.format(AFFINITY_DELAY)
+    )
+    parser.add_argument(
+        '--spill-after', metavar='MB', type=int,
+        default=SPILL_AFTER // (1024 * 1024),
+        help='memory for queued tasks before more go to disk (default {}; '
+             '0 to keep them all in memory)'.format(
+                 SPILL_AFTER // (1024 * 1024)
+             )
+    )
+    parser.add_argument(
+        '--spill-dir', metavar='PATH', default=None,
+        help='where to spill queued tasks (default the temporary '
+             'directory)'
+    )
+    parser.add_argument(
+        '--max-queued', metavar='N', type=int, default=None,
+        help='tell clients to pause while this many tasks are queued'
+    )
+    args = parser.parse_args()
+
+    if args.relay:
+        host, _, port = args.relay.partition(':')
+        Relay(host, int(port or cw.PORT), args.port or cw.RELAY_PORT,
+              args.retries, args.affinity_delay,
+              metrics_file=args.metrics_file,
+              metrics_interval=args.metrics_interval).run()
+    else:
+        Master(cw.sched.SCHEDULERS[args.scheduler](),
+               args.cache_size * 1024 * 1024,
+               args.metrics_file, args.metrics_interval,
+               args.speculate_after or None, args.retries,
+               args.affinity_delay, args.port or cw.PORT,
+               args.rendezvous, args.token,
+               args.spill_after * 1024 * 1024, args.spill_dir,
+               args.max_queued).run()
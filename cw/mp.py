@@ -1,70 +1,213 @@
 from __future__ import print_function
+import getpass
+import os
+import signal
 import subprocess
 import sys
+import tempfile
 import time
 from contextlib import contextmanager
 
 
-def ps():
-    """Get a list of running processes owned by the current user. Generate
-    a list of (pid, args) pairs.
+# How long `start` waits for the master to listen and for the workers
+# to register with it, in seconds, by default.
+START_TIMEOUT = 60.0
+# How often `start` checks on them, in seconds.
+POLL_INTERVAL = 0.05
+# Where `start` records the processes it launches, so that `stop` can
+# find them from any process: one "ROLE PID" line for each.
+PIDFILE = os.path.join(tempfile.gettempdir(),
+                       'cw-mp-{}.pids'.format(getpass.getuser()))
+# The module each role runs.
+MODULES = {'master': 'cw.master', 'workers': 'cw.worker'}
+# How long `stop` waits for the processes to exit, in seconds.
+STOP_TIMEOUT = 10.0
+
+# The processes started from this process by `start`, which `stop` can
+# also wait for.
+_started = {'master': [], 'workers': []}
+
+
+def _cmdline(pid):
+    """Get the arguments of the running process `pid`, or None if there
+    is no such process (or it has exited but not been reaped).
+    """
+    if os.path.isdir('/proc'):
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+                args = f.read().decode('utf-8', 'replace').split('\0')
+        except (IOError, OSError):
+            return None
+        return args[:-1] or None
+    # No procfs (on macOS, say), so ask `ps`, which fails when it finds
+    # nothing.
+    output, _ = subprocess.Popen(
+        ['ps', '-p', str(pid), '-o', 'args='], stdout=subprocess.PIPE
+    ).communicate()
+    return output.decode('utf-8', 'replace').split() or None
+
+
+def _is_ours(role, pid):
+    """Check that `pid` is still a process running the module for
+    `role`, rather than one that got the number after ours exited.
     """
-    output = subprocess.check_output(
-        ['ps', '-a', '-o', 'pid args']
+    args = _cmdline(pid)
+    module = MODULES[role]
+    return args is not None and any(
+        args[i:i + 2] == ['-m', module] for i in range(len(args))
     )
-    lines = output.strip().split('\n')
-    for row in lines[1:]:  # Skip header row.
-        pid, args = row.split(None, 1)
-        yield int(pid), args
 
 
-def pids_for(argpat):
-    """Generate the pids of processes whose arguments contain a given
-    string (case-insensitive).
+def _read_pids():
+    """Get the (role, pid) pairs in the pidfile.
+    """
+    try:
+        with open(PIDFILE) as f:
+            lines = f.read().split('\n')
+    except IOError:
+        return []
+    return [(role, int(pid))
+            for role, pid in (line.split() for line in lines if line)]
+
+
+def _write_pids(entries):
+    if not entries:
+        if os.path.exists(PIDFILE):
+            os.remove(PIDFILE)
+        return
+    with open(PIDFILE, 'w') as f:
+        for role, pid in entries:
+            f.write('{} {}\n'.format(role, pid))
+
+
+def _launch(role, args=()):
+    """Start the module for `role` with `args` and record it. Forget
+    any recorded processes that have since exited.
+    """
+    proc = subprocess.Popen([sys.executable, '-m', MODULES[role]] +
+                            list(args))
+    _started[role].append(proc)
+    _write_pids([(r, pid) for r, pid in _read_pids() if _is_ours(r, pid)] +
+                [(role, proc.pid)])
+    return proc
+
+
+def _registered():
+    """Get the number of workers registered with the local master.
     """
-    for pid, args in ps():
-        if argpat.lower() in args.lower():
-            yield pid
+    # Imported here because `cw` imports this module before `cw.stats`
+    # can be loaded.
+    import cw.stats
+    return len(cw.stats.query(timeout=1)['workers'])
 
 
-def kill(pids):
-    """Kill processes by pid."""
-    subprocess.check_call(['kill'] + [str(p) for p in pids])
+def _wait_for(ready, proc, timeout, what):
+    """Poll `ready()` until it returns true, treating socket errors as a
+    no. Fail if the process `proc` exits or `timeout` seconds pass first.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if ready():
+                return
+        except (IOError, OSError):
+            pass  # Not listening yet.
+        if proc.poll() is not None:
+            raise RuntimeError('process {} exited while waiting for '
+                               '{}'.format(proc.pid, what))
+        if time.time() > deadline:
+            raise RuntimeError('timed out waiting for {}'.format(what))
+        time.sleep(POLL_INTERVAL)
 
 
-def start(nworkers, master=True, workers=True):
+def start(nworkers, master=True, workers=True, preload=(), wait=True,
+          timeout=START_TIMEOUT):
+    """Start a master and `nworkers` workers on this machine. The
+    workers are forked from one process, which imports `cw` and the
+    modules named in `preload` once for all of them. Unless `wait` is
+    false, return only once the master is listening and has all the
+    workers registered (including any that were there before).
+    """
     if master:
         print('starting master')
-        proc = subprocess.Popen([sys.executable, '-m', 'cw.master'])
+        proc = _launch('master')
         print('master pid is {}'.format(proc.pid))
-        time.sleep(1)
+        if wait:
+            _wait_for(lambda: _registered() is not None, proc, timeout,
+                      'the master to listen')
 
     if workers:
         print('starting {} workers'.format(nworkers))
-        for i in range(nworkers):
-            subprocess.Popen([sys.executable, '-m', 'cw.worker'])
+        expected = nworkers
+        if wait and not master:
+            expected += _registered()
+        args = ['--count', str(nworkers)]
+        for name in preload:
+            args += ['--preload', name]
+        proc = _launch('workers', args)
+        if wait:
+            _wait_for(lambda: _registered() >= expected, proc, timeout,
+                      '{} workers to register'.format(expected))
         print('workers started')
 
 
+def master_pid():
+    """Get the pid of the master started by `start`, or None.
+    """
+    for proc in _started['master']:
+        if proc.poll() is None:
+            return proc.pid
+
+
+def _stop_role(role, timeout=STOP_TIMEOUT):
+    """Terminate the processes recorded under `role`, wherever they were
+    started, and wait up to `timeout` seconds for them to exit. Skip
+    recorded pids that now belong to some other process. Once they are
+    gone, drop them from the pidfile.
+    """
+    entries = _read_pids()
+    pids = set(pid for r, pid in entries if r == role and _is_ours(r, pid))
+    pids.update(proc.pid for proc in _started[role] if proc.poll() is None)
+    if pids:
+        print('stopping {} ({} processes)'.format(role, len(pids)))
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass  # Already gone.
+    for proc in _started[role]:
+        proc.wait()
+    del _started[role][:]
+
+    # Those started elsewhere are not our children, so watch for them
+    # to go away.
+    deadline = time.time() + timeout
+    left = set(pid for pid in pids if _is_ours(role, pid))
+    while left and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        left = set(pid for pid in left if _is_ours(role, pid))
+    if left:
+        print('{} still running: {}'.format(
+            role, ' '.join(str(pid) for pid in sorted(left))
+        ))
+    _write_pids([(r, pid) for r, pid in _read_pids()
+                 if r != role or pid in left])
+
+
 def stop(master=True, workers=True):
     if workers:
-        worker_pids = list(pids_for('python -m cw.worker'))
-        if worker_pids:
-            print('killing {} workers'.format(len(worker_pids)))
-            kill(worker_pids)
-
+        _stop_role('workers')
     if master:
-        master_pids = list(pids_for('python -m cw.master'))
-        if master_pids:
-            print('killing {} master'.format(len(master_pids)))
-            kill(master_pids)
+        _stop_role('master')
 
 
 @contextmanager
-def allocate(nworkers, master=True, workers=True):
+def allocate(nworkers, master=True, workers=True, preload=()):
     """A context manager that starts and stops an allocation consisting
     of a master and workers in local processes.
     """
-    start(nworkers, master, workers)
-    yield
-    stop(master, workers)
+    start(nworkers, master, workers, preload)
+    try:
+        yield
+    finally:
+        stop(master, workers)
@@ -0,0 +1,340 @@
+from __future__ import print_function
+import cw
+import cw.codec
+import heapq
+import itertools
+import marshal
+import os
+import struct
+import tempfile
+import time
+from collections import deque, OrderedDict
+
+
+# The memory a queued task takes up besides its blobs and buffers,
+# roughly.
+TASK_OVERHEAD = 1024
+# Precedes each message in a spill file: the arrival time of its tasks.
+_SPILL_RECORD = struct.Struct('!d')
+# Once this much of a client's spill file has been read back, its new
+# messages go to a fresh file, so the disk the old one takes up is freed
+# when the rest of it has been read.
+SPILL_ROTATE = 64 * 1024 * 1024
+
+
+class Scheduler(object):
+    """The interface for the master's task queue policies. A scheduler
+    holds (message, client connection) entries, where each message is a
+    TaskMessage or TaskBatchMessage, and decides which to dispatch next.
+    Operations should not get slower as the queue gets longer.
+    """
+    def push(self, msg, client):
+        """Add an entry to the queue."""
+        raise NotImplementedError()
+
+    def push_front(self, msg, client):
+        """Add an entry that should be dispatched before its peers (for
+        example, the remainder of a split batch).
+        """
+        raise NotImplementedError()
+
+    def pop(self):
+        """Remove and return the next (message, client) entry."""
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def set_weight(self, client, weight):
+        """Set the share of the cluster that a client should get, for
+        policies that care.
+        """
+        pass
+
+    def forget(self, client):
+        """Drop what the policy knows about a client whose connection is
+        gone. Its entries may still be queued (the master skips them).
+        """
+        pass
+
+
+class FIFOScheduler(Scheduler):
+    """First come, first served across all clients.
+    """
+    def __init__(self):
+        self.queue = deque()
+
+    def push(self, msg, client):
+        self.queue.append((msg, client))
+
+    def push_front(self, msg, client):
+        self.queue.appendleft((msg, client))
+
+    def pop(self):
+        return self.queue.popleft()
+
+    def __len__(self):
+        return len(self.queue)
+
+
+class FairScheduler(Scheduler):
+    """Weighted round-robin between clients: each client with queued work
+    gets to dispatch `weight` entries (1 by default) in turn, and is
+    served FIFO within its own queue.
+    """
+    def __init__(self):
+        self.queues = {}  # {client: deque of entries}
+        self.turns = deque()  # clients with queued work, in turn order
+        self.weights = {}
+        self.left = 0  # Entries left in the current client's turn.
+        self.count = 0
+
+    def _queue(self, client):
+        if client not in self.queues:
+            self.queues[client] = deque()
+            self.turns.append(client)
+            if len(self.turns) == 1:
+                self.left = self.weights.get(client, 1)
+        return self.queues[client]
+
+    def push(self, msg, client):
+        self._queue(client).append((msg, client))
+        self.count += 1
+
+    def push_front(self, msg, client):
+        self._queue(client).appendleft((msg, client))
+        self.count += 1
+
+    def pop(self):
+        client = self.turns[0]
+        queue = self.queues[client]
+        entry = queue.popleft()
+        self.count -= 1
+        self.left -= 1
+
+        if not queue:
+            del self.queues[client]
+            self.turns.popleft()
+        elif self.left <= 0:
+            self.turns.rotate(-1)
+        else:
+            return entry
+
+        # Start the next client's turn.
+        if self.turns:
+            self.left = self.weights.get(self.turns[0], 1)
+        return entry
+
+    def __len__(self):
+        return self.count
+
+    def set_weight(self, client, weight):
+        self.weights[client] = max(int(weight), 1)
+
+    def forget(self, client):
+        self.weights.pop(client, None)
+
+
+class PriorityScheduler(Scheduler):
+    """Highest task priority first; FIFO among equal priorities. A batch
+    has the priority of its first task.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.front_counter = itertools.count(-1, -1)
+
+    def _priority(self, msg):
+        return cw.unbatch(msg)[0].priority
+
+    def push(self, msg, client):
+        heapq.heappush(self.heap, (-self._priority(msg), next(self.counter),
+                                   msg, client))
+
+    def push_front(self, msg, client):
+        heapq.heappush(self.heap, (-self._priority(msg),
+                                   next(self.front_counter), msg, client))
+
+    def pop(self):
+        _, _, msg, client = heapq.heappop(self.heap)
+        return msg, client
+
+    def __len__(self):
+        return len(self.heap)
+
+
+def queued_size(msg):
+    """Estimate the memory a queued TaskMessage or TaskBatchMessage takes
+    up in the master.
+    """
+    size = 0
+    for task in cw.unbatch(msg):
+        size += TASK_OVERHEAD + cw.codec.wire_size(task.args_blob) + \
+            cw.codec.wire_size(task.kwargs_blob)
+        for buf in task.args_buffers + task.kwargs_buffers:
+            if not isinstance(buf, str):  # Not a file's path.
+                size += cw.codec.wire_size(buf)
+    return size
+
+
+class SpillFile(object):
+    """An append-only file of queued messages, read back in order. The
+    file is unlinked as soon as it is opened, so it goes away when it is
+    closed (or the master exits).
+    """
+    def __init__(self, directory=None):
+        fd, path = tempfile.mkstemp(prefix='cw-spill-', dir=directory)
+        self.writer = os.fdopen(fd, 'wb')
+        self.reader = open(path, 'rb')
+        os.unlink(path)
+        self.count = 0  # Messages not read back yet.
+        self.consumed = 0  # Bytes read back.
+        self.unflushed = False
+
+    def append(self, msg, arrived):
+        self.writer.write(_SPILL_RECORD.pack(arrived))
+        for buf in cw._frame(msg):
+            self.writer.write(buf)
+        self.count += 1
+        self.unflushed = True
+
+    def pop(self):
+        """Read the oldest message back. Return it with its arrival
+        time.
+        """
+        if self.unflushed:
+            self.writer.flush()
+            self.unflushed = False
+        arrived, = _SPILL_RECORD.unpack(self.reader.read(_SPILL_RECORD.size))
+        code, meta_len, body_len = \
+            cw._parse_header(self.reader.read(cw.HEADER.size))
+        fields, blob_lens = marshal.loads(self.reader.read(meta_len))
+        body = bytearray(body_len)
+        self.reader.readinto(body)
+        self.count -= 1
+        self.consumed += _SPILL_RECORD.size + cw.HEADER.size + meta_len + \
+            body_len
+        return cw._unframe(code, fields, cw._slices(body, blob_lens)), arrived
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+
+
+class SpillingScheduler(Scheduler):
+    """Keeps the messages queued in another scheduler within about
+    `max_bytes` of memory (see `queued_size`). Past that, each client's
+    new messages are appended to a `SpillFile` of its own in `directory`
+    and read back in order, with clients taking turns, as the queue in
+    memory drains. So the policy only sees the messages in memory (a
+    spilled task's priority, say, counts once it is read back). Entries
+    pushed to the front always stay in memory. Once `rotate_after` bytes
+    of a client's file have been read back, its new messages start a
+    fresh file, so a backlog that never empties does not keep growing on
+    disk. `stats`, if given, is the master's `cw.stats.MasterStats`,
+    which stops tracking spilled tasks one by one.
+    """
+    def __init__(self, scheduler, max_bytes, directory=None, stats=None,
+                 rotate_after=SPILL_ROTATE):
+        self.scheduler = scheduler
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.stats = stats
+        self.rotate_after = rotate_after
+        self.bytes = 0  # The size of the messages in memory.
+        # {client: deque of SpillFiles, oldest first}, in turn order.
+        self.files = OrderedDict()
+        self.spilled = 0  # Messages on disk.
+
+    def push(self, msg, client):
+        size = queued_size(msg)
+        if client not in self.files and \
+                (not self.scheduler or self.bytes + size <= self.max_bytes):
+            self.scheduler.push(msg, client)
+            self.bytes += size
+            return
+
+        spills = self.files.get(client)
+        if spills is None:
+            spills = self.files[client] = deque([SpillFile(self.directory)])
+        elif spills[-1].consumed >= self.rotate_after:
+            spills.append(SpillFile(self.directory))
+        arrived = time.time()
+        if self.stats is not None:
+            arrived = self.stats.spilled_to_disk(cw.unbatch(msg))
+        spills[-1].append(msg, arrived)
+        self.spilled += 1
+
+    def push_front(self, msg, client):
+        self.scheduler.push_front(msg, client)
+        self.bytes += queued_size(msg)
+
+    def pop(self):
+        self._load()
+        msg, client = self.scheduler.pop()
+        self.bytes -= queued_size(msg)
+        self._load()
+        return msg, client
+
+    def _load(self):
+        """Read spilled messages back while there is room in memory (or
+        nothing left there).
+        """
+        while self.files and \
+                (not self.scheduler or self.bytes < self.max_bytes):
+            client, spills = self.files.popitem(last=False)
+            msg, arrived = spills[0].pop()
+            self.spilled -= 1
+            if not spills[0].count:
+                spills.popleft().close()
+            if spills:
+                self.files[client] = spills  # Back of the line.
+            if self.stats is not None:
+                self.stats.loaded(cw.unbatch(msg), arrived)
+            self.scheduler.push(msg, client)
+            self.bytes += queued_size(msg)
+
+    def __len__(self):
+        return len(self.scheduler) + self.spilled
+
+    def set_weight(self, client, weight):
+        self.scheduler.set_weight(client, weight)
+
+    def forget(self, client):
+        self.scheduler.forget(client)
+
+
+SCHEDULERS = {
+    'fifo': FIFOScheduler,
+    'fair': FairScheduler,
+    'priority': PriorityScheduler,
+}
+
+
+def bench(depths=(1000, 10000, 100000, 1000000), ops=100000):
+    """Measure the cost of a dispatch (a pop and a push) for each policy
+    at several queue depths. The cost should not grow with the depth.
+    """
+    task = cw.TaskMessage(0, b'', b'', b'', '', [])
+    clients = [object() for i in range(16)]
+
+    print('{:<10}{:>10}{:>14}'.format('policy', 'depth', 'ns/dispatch'))
+    for name in sorted(SCHEDULERS):
+        for depth in depths:
+            sched = SCHEDULERS[name]()
+            for i in range(depth):
+                sched.push(task, clients[i % len(clients)])
+
+            start = time.time()
+            for i in range(ops):
+                msg, client = sched.pop()
+                sched.push(msg, client)
+            elapsed = time.time() - start
+
+            print('{:<10}{:>10}{:>14.0f}'.format(
+                name, depth, elapsed / ops * 1e9
+            ))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,26 @@
+from __future__ import print_function
+import os
+import socket
+import tempfile
+import cw.store
+
+
+# Where shared-memory segments live. On Linux, /dev/shm is a RAM-backed
+# filesystem (it is what `multiprocessing.shared_memory` uses, too), so
+# the files that `cw.store` writes and maps there are shared memory.
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+# Out-of-band buffers at least this large go through shared memory when
+# both ends are on the same host.
+THRESHOLD = 1024 * 1024
+
+# The host name that peers compare to decide whether they can exchange
+# data through shared memory.
+HOST = socket.gethostname()
+
+
+def share(buf):
+    """Copy a buffer into a new shared-memory segment and return its
+    path. Whoever receives the path is responsible for unlinking it (see
+    `cw.store.unlink`).
+    """
+    return cw.store.spill(SHM_DIR, buf)
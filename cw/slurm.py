@@ -1,6 +1,9 @@
 from __future__ import print_function
+import cw
+import json
 import re
 import os
+import socket
 import tempfile
 import subprocess
 import sys
@@ -11,6 +14,16 @@ from contextlib import contextmanager
 
 JOB_MASTER = 'cmaster'
 JOB_WORKERS = 'cworkers'
+# How long workers wait for their node's relay to start, in seconds.
+RELAY_WAIT = 30.0
+# The file where the master announces its address (see
+# `write_rendezvous`) by default. It must be on a filesystem that every
+# node shares, like home directories usually are.
+RENDEZVOUS = os.path.join(os.path.expanduser('~'), '.cw-master')
+# How long `start` waits for the master to announce itself, in seconds.
+RENDEZVOUS_WAIT = 120.0
+# How often to look for the rendezvous file while waiting, in seconds.
+RENDEZVOUS_POLL = 0.5
 
 
 def _jobinfo():
@@ -19,7 +32,7 @@ def _jobinfo():
     """
     joblist = subprocess.check_output(
         ['squeue', '-o', '%i %j %u %N', '-h']
-    ).strip()
+    ).decode('utf-8').strip()
     if not joblist:
         return
     for line in joblist.split('\n'):
@@ -27,7 +40,7 @@ def _jobinfo():
         yield int(jobid), name, user, nodelist
 
 
-def master_host():
+def _squeue_master_host():
     cur_user = getpass.getuser()
     for jobid, name, user, nodelist in _jobinfo():
         if name == JOB_MASTER and user == cur_user:
@@ -36,15 +49,65 @@ def master_host():
     assert False, 'no master job found'
 
 
+def write_rendezvous(path, host, port, token):
+    """Announce a master in a rendezvous file: a JSON object with its
+    host, its port, and a token that identifies this run of it. The file
+    is written under another name and renamed into place, so readers
+    never see part of it.
+    """
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'w') as f:
+        json.dump({'host': host, 'port': port, 'token': token}, f)
+    os.rename(temp, path)
+
+
+def read_rendezvous(path=RENDEZVOUS, wait=0, token=None):
+    """Get the (host, port, token) announced in a rendezvous file. If
+    the file is missing (or is for a run other than `token`, if that is
+    given), keep looking for up to `wait` seconds, then return None.
+    This polls rather than using inotify, which does not see changes
+    made on other nodes to a network filesystem.
+    """
+    deadline = time.time() + wait
+    while True:
+        try:
+            with open(path) as f:
+                info = json.load(f)
+            if token is None or info['token'] == token:
+                return info['host'], info['port'], info['token']
+        except (IOError, OSError, ValueError, KeyError):
+            pass  # Not there (or not valid) yet.
+        if time.time() >= deadline:
+            return None
+        time.sleep(RENDEZVOUS_POLL)
+
+
+def master_address(rendezvous=RENDEZVOUS, wait=0):
+    """Find the running master's host and port. They come from the
+    rendezvous file if there is one, waiting up to `wait` seconds for it
+    to appear. Otherwise, look for the master's job with `squeue`, which
+    is slower and puts load on the Slurm controller.
+    """
+    found = read_rendezvous(rendezvous, wait)
+    if found is not None:
+        return found[0], found[1]
+    return _squeue_master_host(), cw.PORT
+
+
+def master_host(rendezvous=RENDEZVOUS, wait=0):
+    return master_address(rendezvous, wait)[0]
+
+
 def _sbatch(job):
     """Submits a Slurm job represented as a sbatch script string. Returns
     the job ID.
     """
-    jobfile = tempfile.NamedTemporaryFile(delete=False)
+    jobfile = tempfile.NamedTemporaryFile('w', delete=False)
     jobfile.write(job)
     jobfile.close()
     try:
-        out = subprocess.check_output(['sbatch', jobfile.name])
+        out = subprocess.check_output(['sbatch', jobfile.name]) \
+            .decode('utf-8')
     finally:
         os.unlink(jobfile.name)
 
@@ -75,80 +138,143 @@ def _scancel(jobid, signal='INT'):
     )
 
 
+def _get_jobids(jobname):
+    """Given a job name, return the IDs of the jobs belonging to this user
+    matching that name.
+    """
+    cur_user = getpass.getuser()
+    return [jobid for jobid, name, user, nodelist in _jobinfo()
+            if name == jobname and user == cur_user]
+
+
 def _get_jobid(jobname):
     """Given a job name, return the ID of a job belonging to this user
     matching that name or None if not found.
     """
-    cur_user = getpass.getuser()
-    for jobid, name, user, nodelist in _jobinfo():
-        if name == jobname and user == cur_user:
-            return jobid
+    jobids = _get_jobids(jobname)
+    return jobids[0] if jobids else None
 
 
-def _start_workers(num=2, options=[], docker_image=None, docker_args=""):
+def node_relay(master, port=None):
+    """Get the host and port of the relay for `master` on this node
+    (see `cw.master.Relay`). The first task of the job step on each node
+    starts the relay; the others wait until it is listening.
+    """
+    if os.environ.get('SLURM_LOCALID', '0') == '0':
+        subprocess.Popen([
+            sys.executable, '-m', 'cw.master',
+            '--relay', '{}:{}'.format(master, port or cw.PORT),
+        ])
+    deadline = time.time() + RELAY_WAIT
+    while True:
+        try:
+            socket.create_connection(('localhost', cw.RELAY_PORT)).close()
+            return 'localhost', cw.RELAY_PORT
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def _start_workers(num=2, options=[], docker_image=None, docker_args="",
+                   relays=False, rendezvous=RENDEZVOUS):
+    relay_flag = ' --relay' if relays else ''
     if docker_image:
-        command = "docker run -i --rm --net=host {} {} -m cw.worker {}".format(
-            docker_args, docker_image, master_host()
-        )
+        if relays:
+            docker_args = (docker_args or '') + ' -e SLURM_LOCALID'
+        host, port = master_address(rendezvous)
+        command = "docker run -i --rm --net=host {} {} -m cw.worker{} " \
+            "--port {} {}".format(docker_args, docker_image, relay_flag,
+                                  port, host)
     else:
-        command = "{} -m cw.worker --slurm".format(sys.executable)
+        command = "{} -m cw.worker --slurm{}".format(
+            sys.executable, relay_flag
+        )
+        if rendezvous != RENDEZVOUS:
+            command += ' --rendezvous {}'.format(rendezvous)
     options = ['--ntasks={}'.format(num)] + options
     return _startjob(command, JOB_WORKERS, options)
 
 
-def _start_master(options=[]):
-    """Start a job for the master process. Return the Slurm job ID.
+def _start_master(options=[], rendezvous=RENDEZVOUS, token=None):
+    """Start a job for the master process, which announces itself in
+    the file `rendezvous` with `token`. Return the Slurm job ID.
     """
-    command = "{} -m cw.master".format(sys.executable)
+    command = "{} -m cw.master --rendezvous {} --token {}".format(
+        sys.executable, rendezvous, token
+    )
     return _startjob(command, JOB_MASTER, options)
 
 
+def _remove_rendezvous(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # Not there.
+
+
 def start(nworkers, master=True, workers=True, master_options=[],
-          worker_options=[], docker_image=None, docker_args=""):
+          worker_options=[], docker_image=None, docker_args="",
+          relays=False, rendezvous=RENDEZVOUS):
     """Start up a cluster of workers using Slurm. Note that only one
     cluster should be in operation at a given time (only one 'cmaster').
-    If no docker_image is specified, docker will not be used.
+    If no docker_image is specified, docker will not be used. With
+    `relays`, the workers on each node connect through a relay there
+    instead of straight to the master, which helps with many nodes.
+    The master announces its address in the file `rendezvous`, and this
+    waits for that before starting the workers.
     """
     # Master.
     if master:
         print('starting master')
-        jobid = _start_master(master_options)
+        # Nobody should find the last master's address in the meantime.
+        _remove_rendezvous(rendezvous)
+        token = '{:032x}'.format(cw.randid())
+        jobid = _start_master(master_options, rendezvous, token)
         print('master job', jobid, 'started')
-        time.sleep(5)
-        print('master running on', master_host())
+        found = read_rendezvous(rendezvous, RENDEZVOUS_WAIT, token)
+        if found is None:
+            raise RuntimeError('master did not start within {}s'.format(
+                RENDEZVOUS_WAIT
+            ))
+        print('master running on {}:{}'.format(found[0], found[1]))
 
     # Workers.
     if workers:
         print('starting {} workers'.format(nworkers))
         jobid = _start_workers(nworkers, worker_options,
-                               docker_image, docker_args)
+                               docker_image, docker_args, relays,
+                               rendezvous)
         print('worker job', jobid, 'started')
 
 
-def stop(master=True, workers=True):
+def stop(master=True, workers=True, rendezvous=RENDEZVOUS):
     """Stop the running of a cluster (shut down cmaster and all cworkers).
     """
-    # Workers.
-    worker_jobid = _get_jobid(JOB_WORKERS)
-    if worker_jobid:
+    # Workers (in several jobs, if `cw.autoscale` started some).
+    worker_jobids = _get_jobids(JOB_WORKERS) if workers else []
+    if worker_jobids:
         print('stopping workers')
-        _scancel(worker_jobid)
+        for jobid in worker_jobids:
+            _scancel(jobid)
         time.sleep(5)
 
     # Master.
-    master_jobid = _get_jobid(JOB_MASTER)
+    master_jobid = _get_jobid(JOB_MASTER) if master else None
     if master_jobid:
         print('stopping master')
         _scancel(master_jobid)
+        _remove_rendezvous(rendezvous)
 
 
 @contextmanager
 def allocate(nworkers, master=True, workers=True, master_options=[],
-             worker_options=[], docker_image=None, docker_args=""):
+             worker_options=[], docker_image=None, docker_args="",
+             relays=False, rendezvous=RENDEZVOUS):
     """A context manager that starts and stops an allocation consisting
     of a master and workers as Slurm jobs.
     """
     start(nworkers, master, workers, master_options, worker_options,
-          docker_image, docker_args)
+          docker_image, docker_args, relays, rendezvous)
     yield
-    stop(master, workers)
+    stop(master, workers, rendezvous)
@@ -0,0 +1,536 @@
+from __future__ import print_function
+import cw
+import argparse
+import json
+import marshal
+import os
+import socket
+import time
+
+
+# Upper bounds, in seconds, of the buckets for the master's latency
+# histograms. Times above the last bound fall in a final, unbounded
+# bucket.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0, 3600.0)
+# How often the master rewrites its metrics file by default, in seconds.
+METRICS_INTERVAL = 10
+
+
+class Histogram(object):
+    """Counts of observed times in the buckets given by BUCKETS, along
+    with their sum.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.sum,
+                'count': self.count}
+
+
+def quantile(hist, q):
+    """Estimate a quantile of the times in a histogram snapshot: the
+    upper bound of the bucket it falls in. Return None for an empty
+    histogram and infinity if it falls past the last bound.
+    """
+    if not hist['count']:
+        return None
+    seen = 0
+    for index, count in enumerate(hist['counts']):
+        seen += count
+        if seen >= q * hist['count']:
+            break
+    if index < len(BUCKETS):
+        return BUCKETS[index]
+    return float('inf')
+
+
+def _name(conn):
+    """Get a printable name for a client or worker connection.
+    """
+    addr = getattr(conn, 'addr', None)
+    if isinstance(addr, tuple) and len(addr) >= 2:
+        return '{}:{}'.format(addr[0], addr[1])
+    return str(id(conn))
+
+
+class MasterStats(object):
+    """Counters and latency histograms that the master keeps about the
+    tasks it handles. For each task, it measures the time spent in the
+    queue (from its arrival to its dispatch), in execution (from its
+    dispatch to the arrival of its result, so including the trips to and
+    from the worker), and in total.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.received = 0
+        self.dispatched = 0
+        self.completed = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.speculated = 0
+        self.retried = 0
+        # Tasks with affinity keys sent to a worker that had recently run
+        # the same key, and those sent elsewhere.
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        self.queue_time = Histogram()
+        self.execution_time = Histogram()
+        self.total_time = Histogram()
+        self.enqueued = {}  # {jobid: arrival time}
+        # Queued tasks spilled to disk, which are not in `enqueued` (see
+        # `cw.sched.SpillingScheduler`).
+        self.spilled = 0
+        self.running = {}  # {jobid: (arrival time, dispatch time)}
+        self.clients = {}  # {connection: {counter name: value}}
+        self.workers = {}  # {connection: {counter name: value}}
+
+    def _client(self, conn):
+        if conn not in self.clients:
+            self.clients[conn] = {'backlog': 0, 'active': 0,
+                                  'completed': 0}
+        return self.clients[conn]
+
+    def add_worker(self, conn):
+        # `busy` is the time the worker has had any tasks in flight,
+        # and `busy_since` when its current busy spell began.
+        self.workers[conn] = {'active': 0, 'completed': 0, 'failed': 0,
+                              'busy': 0.0, 'busy_since': None,
+                              'since': time.time()}
+
+    def forget(self, conn):
+        """Stop reporting on a client or worker that has gone away.
+        """
+        self.clients.pop(conn, None)
+        self.workers.pop(conn, None)
+
+    def answered(self, count):
+        """Count tasks answered from the master's result cache.
+        """
+        self.received += count
+        self.cache_hits += count
+
+    def queued(self, tasks, client):
+        now = time.time()
+        self.received += len(tasks)
+        self._client(client)['backlog'] += len(tasks)
+        for task in tasks:
+            self.enqueued[task.jobid] = now
+
+    def backlog(self):
+        """Count the queued tasks, including those spilled to disk.
+        """
+        return len(self.enqueued) + self.spilled
+
+    def spilled_to_disk(self, tasks):
+        """Stop tracking queued tasks one by one while they are spilled
+        to disk. Return the arrival time to store with them.
+        """
+        now = time.time()
+        arrived = now
+        for task in tasks:
+            arrived = min(arrived, self.enqueued.pop(task.jobid, now))
+        self.spilled += len(tasks)
+        return arrived
+
+    def loaded(self, tasks, arrived):
+        """Track queued tasks read back from disk again.
+        """
+        self.spilled -= len(tasks)
+        for task in tasks:
+            self.enqueued[task.jobid] = arrived
+
+    def dropped(self, tasks, client):
+        """Forget queued tasks whose client disconnected.
+        """
+        for task in tasks:
+            self.enqueued.pop(task.jobid, None)
+        if client in self.clients:
+            self.clients[client]['backlog'] -= len(tasks)
+
+    def dispatched_to(self, tasks, client, worker):
+        now = time.time()
+        self.dispatched += len(tasks)
+        for task in tasks:
+            arrived = self.enqueued.pop(task.jobid, now)
+            self.queue_time.observe(now - arrived)
+            self.running[task.jobid] = (arrived, now)
+        stats = self._client(client)
+        stats['backlog'] -= len(tasks)
+        stats['active'] += len(tasks)
+        self._worker_started(worker, len(tasks), now)
+
+    def _worker_started(self, worker, count, now):
+        if worker in self.workers:
+            stats = self.workers[worker]
+            if not stats['active']:
+                stats['busy_since'] = now
+            stats['active'] += count
+
+    def _worker_stopped(self, worker, now):
+        """Count a task that is no longer in flight on a worker, and get
+        the worker's counters (or None if it is gone).
+        """
+        if worker not in self.workers:
+            return None
+        stats = self.workers[worker]
+        stats['active'] -= 1
+        if not stats['active']:
+            stats['busy'] += now - stats['busy_since']
+            stats['busy_since'] = None
+        return stats
+
+    def placed(self, warm):
+        """Count a task with an affinity key dispatched to a worker that
+        recently ran its key (if `warm`) or to another worker.
+        """
+        if warm:
+            self.affinity_hits += 1
+        else:
+            self.affinity_misses += 1
+
+    def requeued(self, task, client):
+        """Count a task that goes back in the queue because its worker
+        was lost or it timed out. (The worker's count of tasks in flight
+        drops if its result ever arrives.)
+        """
+        now = time.time()
+        self.retried += 1
+        arrived, _ = self.running.pop(task.jobid, (now, now))
+        self.enqueued[task.jobid] = arrived
+        if client in self.clients:
+            self.clients[client]['active'] -= 1
+            self.clients[client]['backlog'] += 1
+
+    def speculated_on(self, worker):
+        """Count a copy of a straggling task sent to a worker.
+        """
+        self.speculated += 1
+        self._worker_started(worker, 1, time.time())
+
+    def abandoned(self, worker):
+        """Count the result of a task that a worker lost the race for
+        (see `speculated_on`), which the master discards.
+        """
+        self._worker_stopped(worker, time.time())
+
+    def finished(self, result, client, worker):
+        now = time.time()
+        self.completed += 1
+        if not result.success:
+            self.failed += 1
+        arrived, dispatched = self.running.pop(result.jobid, (now, now))
+        self.execution_time.observe(now - dispatched)
+        self.total_time.observe(now - arrived)
+        if client in self.clients:
+            self.clients[client]['active'] -= 1
+            self.clients[client]['completed'] += 1
+        stats = self._worker_stopped(worker, now)
+        if stats is not None:
+            stats['completed'] += 1
+            if not result.success:
+                stats['failed'] += 1
+
+    def snapshot(self):
+        """Get the current statistics as a dictionary of plain values
+        (which can be marshalled or written as JSON).
+        """
+        now = time.time()
+        workers = {}
+        for conn, stats in self.workers.items():
+            stats = dict(stats)
+            stats['connected'] = now - stats.pop('since')
+            busy_since = stats.pop('busy_since')
+            if busy_since is not None:
+                stats['busy'] += now - busy_since
+            workers[_name(conn)] = stats
+        return {
+            'time': now,
+            'uptime': now - self.start,
+            'tasks': {
+                'received': self.received,
+                'dispatched': self.dispatched,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cache_hits': self.cache_hits,
+                'speculated': self.speculated,
+                'retried': self.retried,
+                'affinity_hits': self.affinity_hits,
+                'affinity_misses': self.affinity_misses,
+                'queued': self.backlog(),
+                'spilled': self.spilled,
+                'active': len(self.running),
+            },
+            'clients': dict((_name(conn), dict(stats))
+                            for conn, stats in self.clients.items()),
+            'workers': workers,
+            'latency': {
+                'queue': self.queue_time.snapshot(),
+                'execution': self.execution_time.snapshot(),
+                'total': self.total_time.snapshot(),
+            },
+            'buckets': list(BUCKETS),
+        }
+
+
+def request(msg, host=None, port=cw.PORT, timeout=10):
+    """Send a master one message over a short-lived connection of its
+    own and return its reply (which carries no blobs). This can be
+    called from anywhere, including a client program.
+    """
+    sock = socket.create_connection((host or 'localhost', port), timeout)
+    try:
+        sock.sendall(b''.join(cw._frame(msg)))
+        header = _recv_exactly(sock, cw.HEADER.size)
+        parsed = cw._parse_header(header)
+        if parsed is None:
+            raise IOError('bad message header from master')
+        code, meta_len, body_len = parsed
+        fields, _ = marshal.loads(_recv_exactly(sock, meta_len))
+        _recv_exactly(sock, body_len)
+    finally:
+        sock.close()
+    return cw._unframe(code, fields, [])
+
+
+def query(host=None, port=cw.PORT, timeout=10):
+    """Ask a master for its statistics (see `MasterStats.snapshot`).
+    """
+    msg = request(cw.StatsRequestMessage(), host, port, timeout)
+    if not isinstance(msg, cw.StatsMessage):
+        raise IOError('unexpected reply from master')
+    return msg.stats
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise IOError('master closed the connection')
+        data += chunk
+    return bytes(data)
+
+
+def _labels(**labels):
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    ) + '}'
+
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+def prometheus(stats):
+    """Format statistics in the Prometheus text exposition format.
+    """
+    lines = []
+
+    def metric(name, kind, helptext, samples):
+        lines.append('# HELP cw_{} {}'.format(name, helptext))
+        lines.append('# TYPE cw_{} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('cw_{}{}{} {}'.format(name, suffix, labels, value))
+
+    tasks = stats['tasks']
+    metric('uptime_seconds', 'gauge', 'Time since the master started.',
+           [('', '', stats['uptime'])])
+    for key, helptext in (
+            ('received', 'Tasks received from clients.'),
+            ('dispatched', 'Tasks sent to workers.'),
+            ('completed', 'Tasks whose results came back.'),
+            ('failed', 'Tasks that raised an exception.'),
+            ('cache_hits', 'Tasks answered from the result cache.'),
+            ('speculated', 'Copies of straggling tasks started.'),
+            ('retried', 'Tasks queued again after a failed attempt.'),
+            ('affinity_hits', 'Tasks sent to a worker that recently ran '
+                              'their affinity key.'),
+            ('affinity_misses', 'Tasks with affinity keys sent to other '
+                                'workers.')):
+        metric('tasks_{}_total'.format(key), 'counter', helptext,
+               [('', '', tasks[key])])
+    metric('tasks_queued', 'gauge', 'Tasks waiting for a worker.',
+           [('', '', tasks['queued'])])
+    metric('tasks_spilled', 'gauge',
+           'Queued tasks kept on disk instead of in memory.',
+           [('', '', tasks.get('spilled', 0))])  # Older masters lack it.
+    metric('tasks_active', 'gauge', 'Tasks running on workers.',
+           [('', '', tasks['active'])])
+    metric('workers', 'gauge', 'Connected workers.',
+           [('', '', len(stats['workers']))])
+
+    clients = sorted(stats['clients'].items())
+    metric('client_backlog', 'gauge', 'Queued tasks per client.',
+           [('', _labels(client=c), s['backlog']) for c, s in clients])
+    metric('client_tasks_completed_total', 'counter',
+           'Completed tasks per client.',
+           [('', _labels(client=c), s['completed']) for c, s in clients])
+
+    workers = sorted(stats['workers'].items())
+    metric('worker_tasks_active', 'gauge', 'Tasks in flight per worker.',
+           [('', _labels(worker=w), s['active']) for w, s in workers])
+    metric('worker_tasks_completed_total', 'counter',
+           'Completed tasks per worker.',
+           [('', _labels(worker=w), s['completed']) for w, s in workers])
+    metric('worker_tasks_failed_total', 'counter',
+           'Failed tasks per worker.',
+           [('', _labels(worker=w), s['failed']) for w, s in workers])
+    metric('worker_busy_seconds_total', 'counter',
+           'Time each worker had tasks in flight.',
+           [('', _labels(worker=w), s['busy']) for w, s in workers])
+
+    bounds = list(stats['buckets']) + [float('inf')]
+    for key, helptext in (
+            ('queue', 'Time from arrival to dispatch.'),
+            ('execution', 'Time from dispatch to result.'),
+            ('total', 'Time from arrival to result.')):
+        hist = stats['latency'][key]
+        samples = []
+        cumulative = 0
+        for bound, count in zip(bounds, hist['counts']):
+            cumulative += count
+            samples.append(('_bucket', _labels(le=_bound(bound)),
+                            cumulative))
+        samples.append(('_sum', '', hist['sum']))
+        samples.append(('_count', '', hist['count']))
+        metric('task_{}_seconds'.format(key), 'histogram', helptext,
+               samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, stats):
+    """Write statistics to a file in the Prometheus format, replacing it
+    atomically (as node_exporter's textfile collector expects).
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(prometheus(stats))
+    os.rename(tmp, path)
+
+
+def _seconds(value):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return 'inf'
+    return '{:.3g}s'.format(value)
+
+
+def show(stats, previous=None):
+    """Print a summary of a master's statistics. Rates are averaged since
+    `previous`, an earlier snapshot, if given, and otherwise since the
+    master started.
+    """
+    tasks = stats['tasks']
+    if previous is None:
+        elapsed = stats['uptime']
+        before = dict((k, 0) for k in tasks)
+    else:
+        elapsed = stats['time'] - previous['time']
+        before = previous['tasks']
+    elapsed = max(elapsed, 1e-9)
+
+    print('uptime {:.0f}s, {} workers, {} clients'.format(
+        stats['uptime'], len(stats['workers']), len(stats['clients'])
+    ))
+    print('tasks: {} queued ({} on disk), {} active, {} completed '
+          '({} failed, {} cache hits, {} speculated, {} retried)'.format(
+              tasks['queued'], tasks.get('spilled', 0), tasks['active'],
+              tasks['completed'], tasks['failed'], tasks['cache_hits'],
+              # Older masters lack these.
+              tasks.get('speculated', 0), tasks.get('retried', 0),
+          ))
+    print('rates: {:.1f} received/s, {:.1f} dispatched/s, '
+          '{:.1f} completed/s'.format(
+              (tasks['received'] - before['received']) / elapsed,
+              (tasks['dispatched'] - before['dispatched']) / elapsed,
+              (tasks['completed'] - before['completed']) / elapsed,
+          ))
+
+    print('{:<12}{:>10}{:>10}{:>10}{:>10}'.format(
+        'latency', 'mean', 'p50', 'p90', 'p99'
+    ))
+    for key in ('queue', 'execution', 'total'):
+        hist = stats['latency'][key]
+        mean = hist['sum'] / hist['count'] if hist['count'] else None
+        print('{:<12}{:>10}{:>10}{:>10}{:>10}'.format(
+            key, _seconds(mean), _seconds(quantile(hist, 0.5)),
+            _seconds(quantile(hist, 0.9)), _seconds(quantile(hist, 0.99)),
+        ))
+
+    if stats['clients']:
+        print('{:<24}{:>10}{:>10}{:>10}'.format(
+            'client', 'backlog', 'active', 'done'
+        ))
+        for name, client in sorted(stats['clients'].items()):
+            print('{:<24}{:>10}{:>10}{:>10}'.format(
+                name, client['backlog'], client['active'],
+                client['completed'],
+            ))
+
+    if stats['workers']:
+        print('{:<24}{:>10}{:>10}{:>10}{:>10}'.format(
+            'worker', 'active', 'done', 'tasks/s', 'busy'
+        ))
+        for name, worker in sorted(stats['workers'].items()):
+            print('{:<24}{:>10}{:>10}{:>10.1f}{:>9.0f}%'.format(
+                name, worker['active'], worker['completed'],
+                worker['completed'] / max(worker['connected'], 1e-9),
+                100.0 * worker['busy'] / max(worker['connected'], 1e-9),
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="show a running master's statistics"
+    )
+    parser.add_argument(
+        'host', nargs='?', default=None,
+        help='the master\'s host (default localhost)'
+    )
+    parser.add_argument(
+        '--port', type=int, default=cw.PORT,
+        help='the master\'s port (default {})'.format(cw.PORT)
+    )
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print the raw statistics as JSON'
+    )
+    parser.add_argument(
+        '--prometheus', action='store_true',
+        help='print the statistics in the Prometheus text format'
+    )
+    parser.add_argument(
+        '--watch', metavar='SECONDS', type=float, default=None,
+        help='keep querying at this interval, showing recent rates'
+    )
+    args = parser.parse_args()
+
+    previous = None
+    while True:
+        stats = query(args.host, args.port)
+        if args.json:
+            print(json.dumps(stats, indent=2, sort_keys=True))
+        elif args.prometheus:
+            print(prometheus(stats), end='')
+        else:
+            show(stats, previous)
+        if args.watch is None:
+            break
+        previous = stats
+        time.sleep(args.watch)
+        print()
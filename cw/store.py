@@ -0,0 +1,114 @@
+from __future__ import print_function
+import os
+import mmap
+import random
+import hashlib
+import threading
+
+
+# Every file the store writes has a name starting with this, and no other
+# file is ever unlinked on a peer's say-so.
+PREFIX = 'cw-'
+# Out-of-band buffers at least this large are spilled to a store by
+# default.
+THRESHOLD = 4 * 1024 * 1024
+
+
+def _write(path, buf):
+    # Write to a temporary name first so that a file under its final name
+    # is always complete.
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(buf)
+    os.rename(tmp, path)
+
+
+def spill(directory, buf):
+    """Write a buffer to a new file in a directory and return its path.
+    Whoever receives the path is responsible for `unlink`ing it.
+    """
+    name = '{}{}-{:x}'.format(PREFIX, os.getpid(), random.getrandbits(64))
+    path = os.path.join(os.path.abspath(directory), name)
+    _write(path, buf)
+    return path
+
+
+def attach(path):
+    """Map a file written by the store and return a writable memoryview
+    of it. Its contents are paged in as they are used, and writes stay
+    private to this process (the mapping is copy-on-write).
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return memoryview(bytearray())
+        return memoryview(mmap.mmap(f.fileno(), size,
+                                    access=mmap.ACCESS_COPY))
+
+
+def unlink(path):
+    """Remove a file written by the store. Existing mappings remain
+    valid.
+    """
+    if not os.path.basename(path).startswith(PREFIX):
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class Store(object):
+    """A content-addressed store for a client's large arguments in a
+    directory on a filesystem that the workers share, which keeps bulk
+    data out of the master. Each distinct buffer is written once no
+    matter how many jobs use it, and removed when the last of those jobs
+    finishes. Results take the same route back (see `spill`).
+    """
+    def __init__(self, directory, threshold=THRESHOLD):
+        self.directory = os.path.abspath(directory)
+        self.threshold = threshold
+        # Names are only shared within one store, so no other client
+        # can remove a file we still need.
+        self.prefix = '{}{:x}-'.format(PREFIX, random.getrandbits(32))
+        self.refs = {}  # {path: number of unfinished jobs using it}
+        self.lock = threading.Lock()
+
+    def put(self, buf):
+        """Store a buffer if it is large enough, taking a reference to
+        it. Return its path, or None if it should be sent as usual.
+        """
+        view = memoryview(buf)
+        if view.nbytes < self.threshold:
+            return None
+        digest = hashlib.sha1(view).hexdigest()
+        path = os.path.join(self.directory, self.prefix + digest)
+        with self.lock:
+            if path not in self.refs:
+                _write(path, view)
+            self.refs[path] = self.refs.get(path, 0) + 1
+        return path
+
+    def owns(self, path):
+        return path in self.refs
+
+    def release(self, path):
+        """Drop a reference taken by `put`, removing the file once no
+        unfinished job uses it.
+        """
+        with self.lock:
+            count = self.refs.pop(path) - 1
+            if count:
+                self.refs[path] = count
+                return
+        unlink(path)
+
+    def clear(self):
+        """Remove every file, whether or not jobs still use it.
+        """
+        with self.lock:
+            paths = list(self.refs)
+            self.refs.clear()
+        for path in paths:
+            unlink(path)
@@ -1,11 +1,32 @@
 from __future__ import print_function
 import cw
+import cw.codec
+import cw.shm
 import cw.slurm
+import cw.store
 import bluelet
+import concurrent.futures
+import argparse
+import cProfile
+import errno
+import functools
+import importlib
+import multiprocessing
+import signal
 import traceback
 import sys
 import os
-from contextlib import contextmanager
+import time
+from collections import deque
+
+
+# How many tasks a worker asks the master to keep in flight beyond the
+# number it can run at once.
+PREFETCH = 1
+# How often a worker tells the master it is still alive, in seconds.
+HEARTBEAT = 5.0
+# The error that abandoned tasks report (see `cw.CancelMessage`).
+CANCELLED = 'task cancelled: another worker finished it first'
 
 
 def format_remote_exc():
@@ -14,27 +35,32 @@ def format_remote_exc():
     return ''.join(traceback.format_exception(typ, value, tb))
 
 
-@contextmanager
-def chdir(d):
-    """Enter a directory for the duration of the context manager.
+def _env_key(task):
+    """Get a key for the environment a task runs in: its session ID, or
+    its working directory and search path if it has no session.
     """
-    olddir = os.getcwd()
-    os.chdir(d)
-    yield
-    os.chdir(olddir)
+    if task.session is not None:
+        return task.session
+    return (task.cwd, tuple(task.syspath))
 
 
-@contextmanager
-def extend_path(dirs):
-    """Extend sys.path with some new directories (at the front of the
-    list) for the duration of the context manager.
+class _Environment(object):
+    """The working directory and module search path that tasks in this
+    process run with. Switching is only safe when no task is running.
     """
-    old_syspath = list(sys.path)
-    for entry in dirs:
-        if entry not in sys.path:
-            sys.path.insert(0, entry)
-    yield
-    sys.path = old_syspath
+    def __init__(self):
+        self.key = None  # See `_env_key`.
+        self.base_syspath = list(sys.path)
+
+    def switch(self, key, cwd, syspath):
+        """Enter a working directory and extend the search path with
+        some directories, unless we are already there.
+        """
+        if key != self.key:
+            os.chdir(cwd)
+            extra = [e for e in syspath if e not in self.base_syspath]
+            sys.path = extra + self.base_syspath
+            self.key = key
 
 
 def amend_path():
@@ -44,66 +70,586 @@ def amend_path():
     # be ['cw']. Then, after cwd'ing to run a job, it will no longer be
     # possible to find that path. Absolute-ifying the package path makes
     # it relocatable.
-    cw.__path__ = map(os.path.abspath, cw.__path__)
+    cw.__path__ = list(map(os.path.abspath, cw.__path__))
+
+
+def _nbytes(blob, buffers):
+    """Get the size of some serialized user data as sent, including
+    buffers in files.
+    """
+    return cw.codec.wire_size(blob) + sum(
+        os.path.getsize(b) if isinstance(b, str) else cw.codec.wire_size(b)
+        for b in buffers
+    )
+
+
+# The Compressors for results, by codec name, shared by all the tasks
+# in this process so that each adapts its level to all of them.
+_compressors = {}
+
+
+def _compressor(codec):
+    if codec not in _compressors:
+        _compressors[codec] = cw.codec.Compressor(codec)
+    return _compressors[codec]
+
+
+def _result_message(task, success, value, timings=None, profiler=None):
+    """Serialize the value a task returned (or its error). Large buffers
+    go back the way the client can take them: through shared memory if
+    it is on this host, or else through its store if it has one. If the
+    task asked for them, `timings` (see `_deserialize`) and the stats
+    from `profiler` go along.
+    """
+    def place(view):
+        if task.client_host == cw.shm.HOST and \
+                view.nbytes >= cw.shm.THRESHOLD:
+            return cw.shm.share(view)
+        if task.store is not None and view.nbytes >= task.store[1]:
+            return cw.store.spill(task.store[0], view)
+
+    # Use the client's serializer, unless it is one we do not have.
+    serializer = task.serializer
+    if serializer not in cw.SERIALIZERS:
+        serializer = cw.DEFAULT_SERIALIZER
+
+    start = time.time()
+    blob, buffers = cw.ser(value, place, serializer)
+    if task.compression in cw.codec.CODECS:
+        blob, buffers = cw.compress(_compressor(task.compression), blob,
+                                    buffers)
+    result = cw.ResultMessage(task.jobid, success, blob, buffers)
+    if timings is not None:
+        timings['ser_result'] = time.time() - start
+        timings['bytes_out'] = _nbytes(blob, buffers)
+        result = result._replace(timings=tuple(
+            timings.get(field, 0) for field in cw.Timings._fields
+        ))
+    if profiler is not None:
+        profiler.create_stats()
+        result = result._replace(profile=profiler.stats)
+    return result
+
+
+def _deserialize(task, load_func):
+    """Deserialize a task's function (with `load_func`, which returns
+    it) and its arguments. Return the function, the arguments, and, if
+    the task asked for timings, a dictionary of them (see `cw.Timings`)
+    for `_execute` to fill in; otherwise None.
+    """
+    if not task.profile:
+        return (load_func(), cw.deser(task.args_blob, task.args_buffers),
+                cw.deser(task.kwargs_blob, task.kwargs_buffers), None)
+
+    start = time.time()
+    func = load_func()
+    loaded = time.time()
+    args = cw.deser(task.args_blob, task.args_buffers)
+    kwargs = cw.deser(task.kwargs_blob, task.kwargs_buffers)
+    timings = {
+        'deser_func': loaded - start,
+        'deser_args': time.time() - loaded,
+        'bytes_in': _nbytes(task.args_blob, task.args_buffers) +
+        _nbytes(task.kwargs_blob, task.kwargs_buffers),
+    }
+    return func, args, kwargs, timings
+
+
+def _execute(task, func, args, kwargs, timings):
+    """Run a deserialized task, under cProfile if it asked for that, and
+    return a ResultMessage.
+    """
+    start = time.time()
+    profiler = None
+    if task.profile == cw.PROFILE_CPROFILE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None  # Another profiler is running.
+    try:
+        try:
+            res = func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    except BaseException:
+        # Everything, SystemExit included: a task that exits fails, and
+        # the worker goes on.
+        success, value = False, format_remote_exc()
+    else:
+        success, value = True, res
+    if timings is not None:
+        timings['execute'] = time.time() - start
+    return _result_message(task, success, value, timings, profiler)
+
+
+def _copy_buffer(buf):
+    # Memoryviews cannot be pickled to and from pool processes.
+    if isinstance(buf, str):
+        return buf
+    if isinstance(buf, cw.codec.Compressed):
+        return cw.codec.copy(buf)
+    return bytearray(buf)
+
+
+def _copy_buffers(buffers):
+    return tuple(_copy_buffer(b) for b in buffers)
+
+
+def _portable(task):
+    """Copy a task's received buffers so it can be sent to a pool
+    process.
+    """
+    return task._replace(args_blob=cw.codec.copy(task.args_blob),
+                         kwargs_blob=cw.codec.copy(task.kwargs_blob),
+                         args_buffers=_copy_buffers(task.args_buffers),
+                         kwargs_buffers=_copy_buffers(task.kwargs_buffers))
+
+
+# Deserialized functions in a process-pool slot (see `run_serialized`).
+_process_functions = cw.LRUCache(cw.FUNCTION_CACHE_SIZE)
+# The environment of a process-pool slot, once it has run a task.
+_process_env = None
+
+
+def _call_serialized(task, func_blob):
+    def load_func():
+        func = _process_functions.get(task.func_id)
+        if func is None:
+            func = cw.func_deser(func_blob)
+            _process_functions[task.func_id] = func
+        return func
+
+    try:
+        func, args, kwargs, timings = _deserialize(task, load_func)
+    except BaseException:
+        # Loading a function can import a script that exits (say, one
+        # that parses its arguments at the top level).
+        return _result_message(task, False, format_remote_exc())
+    return _execute(task, func, args, kwargs, timings)
+
+
+def run_serialized(calls, env):
+    """Run tasks in a pool process. `calls` is a list of (TaskMessage,
+    function blob) pairs, and `env` the (key, cwd, syspath) to run them
+    in; return a tuple of ResultMessages.
+    """
+    global _process_env
+    if _process_env is None:
+        _process_env = _Environment()
+    _process_env.switch(*env)
+    results = (_call_serialized(task, blob) for task, blob in calls)
+    return tuple(r._replace(result_buffers=_copy_buffers(r.result_buffers))
+                 for r in results)
+
+
+def _terminate(signum, frame):
+    """Take a worker's pool processes down with it when it is terminated.
+    Otherwise they would wait for tasks forever.
+    """
+    for child in multiprocessing.active_children():
+        child.terminate()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
 
 
 class Worker(object):
-    def __init__(self, host='localhost', port=cw.PORT):
+    """Runs tasks from the master in `slots` background threads (or, if
+    `processes` is set, pool processes), multiplexing all of them over
+    one connection. The worker advertises `credits` to the master, which
+    keeps up to that many tasks in flight here (by default, one more
+    than the number of slots); the next tasks are deserialized on the
+    main thread while the current ones run. Every `heartbeat` seconds,
+    the worker tells the master that it is still alive.
+    """
+    def __init__(self, host='localhost', port=cw.PORT, credits=None,
+                 slots=1, processes=False, heartbeat=HEARTBEAT):
         self.host = host
         self.port = port
+        self.heartbeat = heartbeat
+        self.slots = slots
+        self.credits = credits or slots + PREFETCH
+        self.processes = processes
+        self.functions = cw.LRUCache(cw.FUNCTION_CACHE_SIZE)
+        self.func_blobs = cw.LRUCache(cw.FUNCTION_CACHE_SIZE)
+        self.awaiting_functions = set()
+        # The IDs of tasks to abandon (see `cw.CancelMessage`).
+        self.cancelled = cw.LRUCache(cw.FUNCTION_CACHE_SIZE)
 
-    def communicate(self):
-        conn = yield bluelet.connect(self.host, self.port)
+        self.backlog = deque()  # Received messages not yet started.
+        self.running = 0
+        self.sessions = cw.LRUCache(cw.FUNCTION_CACHE_SIZE)
+        self.awaiting_sessions = set()
+        self.env = _Environment()
+
+        # Finished results and a pipe to wake up the main thread when
+        # one is ready.
+        if processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(slots)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(slots)
+        self.results = deque()
+        wakeup_r, self.wakeup_w = os.pipe()
+        self.wakeup = os.fdopen(wakeup_r, 'rb', 0)
+
+    def _env(self, task):
+        """Get the (key, cwd, syspath) environment a task runs in.
+        """
+        if task.session is not None:
+            session = self.sessions.get(task.session)
+            return task.session, session.cwd, session.syspath
+        return _env_key(task), task.cwd, task.syspath
+
+    def _load_function(self, func_id):
+        func = self.functions.get(func_id)
+        if func is None:
+            func = cw.func_deser(self.func_blobs.get(func_id))
+            self.functions[func_id] = func
+        return func
 
-        yield cw._sendmsg(conn, cw.WorkerRegisterMessage())
+    def _prepare(self, task):
+        """Deserialize a task. Return either a (task, func, args, kwargs,
+        timings) tuple or a failed ResultMessage.
+        """
+        try:
+            return (task,) + _deserialize(
+                task, functools.partial(self._load_function, task.func_id)
+            )
+        except BaseException:  # See `_call_serialized`.
+            return _result_message(task, False, format_remote_exc())
+
+    def _call(self, call):
+        """Run a prepared task and return a ResultMessage. (Called on the
+        execution thread.)
+        """
+        if isinstance(call, cw.ResultMessage):
+            return call  # Failed to deserialize.
+        task = call[0]
+        if task.jobid in self.cancelled:
+            return _result_message(task, False, CANCELLED)
+        return _execute(*call)
+
+    def _run(self, calls, batch):
+        """Run prepared tasks in order and hand back their results.
+        (Called on the execution thread.)
+        """
+        self._finish(tuple(self._call(call) for call in calls), batch)
 
-        connected = True
+    def _process_done(self, tasks, batch, future):
+        """Hand back the results from a pool process.
+        """
         try:
-            while True:
-                # Get a task from the master.
-                msg = yield cw._readmsg(conn)
-                if msg is None:
-                    print('connection to master closed')
-                    connected = False
-                    break
-                assert isinstance(msg, cw.TaskMessage)
+            results = future.result()
+        except Exception as exc:
+            # The pool process died.
+            error = 'worker process failed: {}'.format(exc)
+            results = tuple(_result_message(task, False, error)
+                            for task in tasks)
+        self._finish(results, batch)
+
+    def _finish(self, results, batch):
+        """Queue results to be sent and wake up the main thread.
+        """
+        if batch:
+            self.results.append(cw.ResultBatchMessage(results))
+        else:
+            self.results.append(results[0])
+        os.write(self.wakeup_w, b'.')
+
+    def _missing_function(self, msg):
+        """Get the ID of a function needed by a TaskMessage or
+        TaskBatchMessage that this worker does not have, or None.
+        """
+        for task in cw.unbatch(msg):
+            if task.func_id not in self.func_blobs and \
+                    (self.processes or task.func_id not in self.functions):
+                return task.func_id
 
+    def _missing_session(self, msg):
+        """Get the ID of a session needed by a TaskMessage or
+        TaskBatchMessage that this worker does not have, or None.
+        """
+        for task in cw.unbatch(msg):
+            if task.session is not None and task.session not in self.sessions:
+                return task.session
+
+    def _start_ready(self):
+        """Start as many backlogged messages as we can, in order.
+        """
+        while self.backlog:
+            msg = self.backlog[0]
+            tasks = cw.unbatch(msg)
+            if self._missing_function(msg) is not None or \
+                    self._missing_session(msg) is not None or \
+                    (not self.processes and self.running and
+                     _env_key(tasks[0]) != self.env.key):
+                break
+            self.backlog.popleft()
+            self.running += 1
+            batch = isinstance(msg, cw.TaskBatchMessage)
+
+            if not batch and msg.jobid in self.cancelled:
+                self._finish((_result_message(msg, False, CANCELLED),),
+                             False)
+            elif self.processes:
+                calls = [(_portable(task), self.func_blobs.get(task.func_id))
+                         for task in tasks]
+                future = self.executor.submit(run_serialized, calls,
+                                              self._env(tasks[0]))
+                future.add_done_callback(
+                    functools.partial(self._process_done, tasks, batch)
+                )
+            else:
                 try:
-                    with chdir(msg.cwd):
-                        with extend_path(msg.syspath):
-                            func = cw.func_deser(msg.func_blob)
-                            args = cw.slow_deser(msg.args_blob)
-                            kwargs = cw.slow_deser(msg.kwargs_blob)
-                            res = func(*args, **kwargs)
-                except:
-                    res = format_remote_exc()
-                    response = cw.ResultMessage(msg.jobid, False,
-                                                cw.slow_ser(res))
-                else:
-                    response = cw.ResultMessage(msg.jobid, True,
-                                                cw.slow_ser(res))
-                yield cw._sendmsg(conn, response)
+                    self.env.switch(*self._env(tasks[0]))
+                except OSError:
+                    # Say, its directory is missing here.
+                    error = format_remote_exc()
+                    self._finish(tuple(_result_message(task, False, error)
+                                       for task in tasks), batch)
+                    continue
+                calls = [self._prepare(task) for task in tasks]
+                self.executor.submit(self._run, calls, batch)
+
+    def receive(self, conn):
+        """Read tasks (and the functions they need) from the master.
+        """
+        while True:
+            msg = yield cw._readmsg(conn)
+            if msg is None:
+                print('connection to master closed')
+                self.connected = False
+                return
+
+            if isinstance(msg, cw.FunctionMessage):
+                self.func_blobs[msg.func_id] = bytes(msg.func_blob)
+                self.awaiting_functions.discard(msg.func_id)
+
+            elif isinstance(msg, cw.SessionMessage):
+                self.sessions[msg.session_id] = msg
+                self.awaiting_sessions.discard(msg.session_id)
 
+            elif isinstance(msg, cw.CancelMessage):
+                # Tasks that have not started yet are skipped. Running
+                # ones cannot be stopped, but their results are dropped.
+                self.cancelled[msg.jobid] = True
+
+            elif isinstance(msg, cw.WorkerDepartMessage):
+                # The master has let this worker go while it was idle
+                # (see `cw.DrainMessage`).
+                print('released by master')
+                return
+
+            else:
+                assert isinstance(msg, (cw.TaskMessage, cw.TaskBatchMessage))
+                self.backlog.append(msg)
+                func_id = self._missing_function(msg)
+                if func_id is not None and \
+                        func_id not in self.awaiting_functions:
+                    # Fetch the function from the master first.
+                    self.awaiting_functions.add(func_id)
+                    yield cw._sendmsg(conn,
+                                      cw.FunctionRequestMessage(func_id))
+                session = self._missing_session(msg)
+                if session is not None and \
+                        session not in self.awaiting_sessions:
+                    # We have dropped it since the master sent it.
+                    self.awaiting_sessions.add(session)
+                    yield cw._sendmsg(conn,
+                                      cw.SessionRequestMessage(session))
+
+            self._start_ready()
+
+    def send_results(self, conn):
+        """Send results back to the master as they finish.
+        """
+        while True:
+            yield bluelet.read(self.wakeup, 1024)
+            while self.results:
+                self.running -= 1
+                yield cw._sendmsg(conn,
+                                  self._drop_cancelled(self.results.popleft()))
+            self._start_ready()
+
+    def _drop_cancelled(self, msg):
+        """Replace the results of abandoned tasks in a ResultMessage or
+        ResultBatchMessage with errors, which are cheap to send.
+        """
+        results = []
+        for result in cw.unbatch(msg):
+            if self.cancelled.pop(result.jobid) is not None:
+                for path in cw.spilled(result.result_buffers):
+                    cw.store.unlink(path)
+                result = cw.ResultMessage(result.jobid, False,
+                                          *cw.ser(CANCELLED))
+            results.append(result)
+        if isinstance(msg, cw.ResultBatchMessage):
+            return cw.ResultBatchMessage(tuple(results))
+        return results[0]
+
+    def send_heartbeats(self, conn):
+        """Tell the master that this worker is alive, even while tasks
+        take a long time.
+        """
+        while True:
+            yield bluelet.sleep(self.heartbeat)
+            yield cw._sendmsg(conn, cw.HeartbeatMessage())
+
+    def communicate(self):
+        conn = yield bluelet.connect(self.host, self.port)
+        self.connected = True
+
+        yield cw._sendmsg(conn, cw.WorkerRegisterMessage(
+            self.credits, tuple(cw.codec.CODECS), self.heartbeat or None,
+            self.slots
+        ))
+
+        sender = self.send_results(conn)
+        yield bluelet.spawn(sender)
+        heart = None
+        if self.heartbeat:
+            heart = self.send_heartbeats(conn)
+            yield bluelet.spawn(heart)
+        try:
+            yield self.receive(conn)
         finally:
-            if connected:
+            if heart is not None:
+                yield bluelet.kill(heart)
+            yield bluelet.kill(sender)
+            if self.connected:
                 yield cw._sendmsg(conn, cw.WorkerDepartMessage())
 
     def run(self):
         amend_path()
+        if self.processes:
+            try:
+                signal.signal(signal.SIGTERM, _terminate)
+            except ValueError:
+                pass  # Not in the main thread, so not ours to handle.
         try:
             bluelet.run(self.communicate())
         except KeyboardInterrupt:
             pass
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+def fork_workers(count, run):
+    """Call `run` in `count` processes forked from this one, which then
+    exit, and wait for them all. Modules imported beforehand are shared
+    by every process and loaded only once. Terminating or interrupting
+    this process does the same to them.
+    """
+    pids = []
+    for i in range(count):
+        pid = os.fork()
+        if not pid:
+            status = 0
+            try:
+                run()
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        pids.append(pid)
+
+    def pass_on(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass  # Already gone.
+    signal.signal(signal.SIGTERM, pass_on)
+    signal.signal(signal.SIGINT, pass_on)
+
+    for pid in pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except OSError as exc:
+                if exc.errno != errno.EINTR:
+                    raise
 
 
 if __name__ == '__main__':
-    args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description='run a cluster worker')
+    parser.add_argument(
+        'host', nargs='?', default='localhost',
+        help='hostname of the master (default localhost)'
+    )
+    parser.add_argument(
+        '--port', metavar='N', type=int, default=cw.PORT,
+        help='port of the master (default {})'.format(cw.PORT)
+    )
+    parser.add_argument(
+        '--slurm', action='store_true', default=False,
+        help='find the master using Slurm'
+    )
+    parser.add_argument(
+        '--rendezvous', metavar='PATH', default=cw.slurm.RENDEZVOUS,
+        help='with --slurm, where the master announces its address '
+             '(default {})'.format(cw.slurm.RENDEZVOUS)
+    )
+    parser.add_argument(
+        '--wait', metavar='SECONDS', type=float, default=0,
+        help='with --slurm, how long to wait for the rendezvous file '
+             'before looking for the master with squeue (default 0)'
+    )
+    parser.add_argument(
+        '--relay', action='store_true', default=False,
+        help="connect through a relay on this node, which the node's "
+             'first Slurm task starts'
+    )
+    parser.add_argument(
+        '--slots', metavar='N', type=int, default=1,
+        help='tasks to run at once (default 1)'
+    )
+    parser.add_argument(
+        '--credits', metavar='N', type=int, default=None,
+        help='tasks to keep in flight at once (default {} more than the '
+             'number of slots)'.format(PREFETCH)
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--threads', dest='processes', action='store_false', default=False,
+        help='run tasks in a thread pool (the default)'
+    )
+    group.add_argument(
+        '--processes', dest='processes', action='store_true',
+        help='run tasks in a process pool'
+    )
+    parser.add_argument(
+        '--count', metavar='N', type=int, default=1,
+        help='worker processes to fork from this one (default 1)'
+    )
+    parser.add_argument(
+        '--preload', metavar='MODULE', default=[], action='append',
+        help='import a module before starting (and forking) the workers'
+    )
+    parser.add_argument(
+        '--heartbeat', metavar='SECONDS', type=float, default=HEARTBEAT,
+        help='interval between messages telling the master that the '
+             'worker is alive (default {:g}; 0 for none)'.format(HEARTBEAT)
+    )
+    args = parser.parse_args()
 
-    if args and args[0] == '--slurm':
-        host = cw.slurm.master_host()
-    elif args:
-        host = args[0]
-    else:
-        host = 'localhost'
+    host, port = args.host, args.port
+    if args.slurm:
+        host, port = cw.slurm.master_address(args.rendezvous, args.wait)
+    if args.relay:
+        host, port = cw.slurm.node_relay(host, port)
+    for name in args.preload:
+        importlib.import_module(name)
 
-    Worker(host).run()
+    def run():
+        Worker(host, port, credits=args.credits, slots=args.slots,
+               processes=args.processes, heartbeat=args.heartbeat).run()
+    if args.count > 1:
+        fork_workers(args.count, run)
+    else:
+        run()
@@ -25,10 +25,15 @@ def cli():
         '-W', dest='workers', action='store_false', default=True,
         help='do not start/stop workers'
     )
+    parser.add_argument(
+        '-p', '--preload', dest='preload', metavar='MODULE',
+        default=[], action='append',
+        help='module for the workers to import before they start'
+    )
     args = parser.parse_args()
 
     if args.action == 'start':
-        cw.mp.start(args.nworkers, args.master, args.workers)
+        cw.mp.start(args.nworkers, args.master, args.workers, args.preload)
     elif args.action == 'stop':
         cw.mp.stop(args.master, args.workers)
     else:
@@ -19,6 +19,7 @@ setup(name='cluster-workers',
 
       packages=['cw'],
       install_requires=['bluelet', 'cloud', 'futures'],
+      extras_require={'oob': ['cloudpickle']},
 
       classifiers=[
           'Topic :: System :: Networking',
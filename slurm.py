@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import print_function
 import argparse
+import cw.autoscale
 import cw.slurm
 
 DEFAULT_WORKERS = 32
@@ -11,11 +12,22 @@ def cli():
         description='start Python workers on a Slurm cluster'
     )
     parser.add_argument(
-        'action', metavar='start|stop', help='action'
+        'action', metavar='start|stop|autoscale', help='action'
     )
     parser.add_argument(
         '-n', dest='nworkers', metavar='N', type=int, default=DEFAULT_WORKERS,
-        help='number of workers to start (default {})'.format(DEFAULT_WORKERS)
+        help='number of workers to start, or the most to run when '
+             'autoscaling (default {})'.format(DEFAULT_WORKERS)
+    )
+    parser.add_argument(
+        '--min', dest='minimum', metavar='N', type=int, default=0,
+        help='when autoscaling, the fewest workers to run (default 0)'
+    )
+    parser.add_argument(
+        '--idle', metavar='SECONDS', type=float,
+        default=cw.autoscale.IDLE_AFTER,
+        help='when autoscaling, how long a worker may sit idle before it '
+             'is let go (default {:g})'.format(cw.autoscale.IDLE_AFTER)
     )
     parser.add_argument(
         '-M', dest='master', action='store_false', default=True,
@@ -37,6 +49,10 @@ def cli():
         '-i', '--isolated', dest='isolated', action='store_true',
         default=False, help='only one worker per node'
     )
+    parser.add_argument(
+        '-r', '--relays', dest='relays', action='store_true',
+        default=False, help='run a relay on each node for its workers'
+    )
     parser.add_argument(
         '--Xworkers', dest='worker_options', metavar='ARG',
         default=[], action='append',
@@ -56,11 +72,18 @@ def cli():
     if args.action == 'start':
         cw.slurm.start(args.nworkers, args.master, args.workers,
                        args.master_options, worker_options,
-                       args.docker_image, args.docker_args)
+                       args.docker_image, args.docker_args, args.relays)
     elif args.action == 'stop':
         cw.slurm.stop(args.master, args.workers)
+    elif args.action == 'autoscale':
+        host, port = cw.slurm.master_address()
+        launch = cw.autoscale.slurm_launcher(worker_options,
+                                             args.docker_image,
+                                             args.docker_args)
+        cw.autoscale.Autoscaler(launch, args.minimum, args.nworkers, host,
+                                port, idle_after=args.idle).run()
     else:
-        parser.error('action must be stop or start')
+        parser.error('action must be start, stop, or autoscale')
 
 
 if __name__ == '__main__':
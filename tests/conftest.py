@@ -0,0 +1,123 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS = os.path.join(ROOT, 'tests', 'stubs')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10.0):
+    end = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port), 0.5).close()
+            return
+        except socket.error:
+            if time.time() > end:
+                raise
+            time.sleep(0.05)
+
+
+class Cluster(object):
+    """Runs a master and workers on a free port, each in a subprocess.
+    """
+    def __init__(self, env=None):
+        self.port = free_port()
+        self.processes = []
+        self.env = dict(os.environ, **(env or {}))
+        path = self.env.get('PYTHONPATH')
+        self.env['PYTHONPATH'] = ROOT + (os.pathsep + path if path else '')
+
+    def spawn_script(self, *args):
+        proc = subprocess.Popen(
+            [sys.executable] + list(args),
+            cwd=ROOT, env=self.env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        )
+        self.processes.append(proc)
+        return proc
+
+    def spawn(self, module, *args):
+        return self.spawn_script('-m', module, *args)
+
+    def master(self, *args):
+        proc = self.spawn('cw.master', '--port', str(self.port), *args)
+        wait_for_port(self.port)
+        return proc
+
+    def worker(self, *args):
+        return self.spawn('cw.worker', 'localhost', '--port', str(self.port),
+                          *args)
+
+    def stop(self):
+        for proc in self.processes:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in self.processes:
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+@pytest.fixture
+def cluster():
+    """A master with one worker."""
+    cluster = Cluster()
+    cluster.master()
+    cluster.worker()
+    yield cluster
+    cluster.stop()
+
+
+@pytest.fixture
+def make_cluster():
+    """Start clusters with whatever masters and workers a test needs.
+    """
+    clusters = []
+
+    def make(env=None):
+        cluster = Cluster(env)
+        clusters.append(cluster)
+        return cluster
+    yield make
+    for cluster in clusters:
+        cluster.stop()
+
+
+@pytest.fixture
+def slurm(tmp_path, monkeypatch):
+    """Run "Slurm jobs" on this machine with the stubs in tests/stubs.
+    Yield the directory where they keep their state.
+    """
+    state = tmp_path / 'slurm'
+    state.mkdir()
+    monkeypatch.setenv('SLURM_STUB_STATE', str(state))
+    monkeypatch.setenv('PATH', os.pathsep.join([
+        STUBS, os.path.dirname(sys.executable), os.environ['PATH'],
+    ]))
+    path = os.environ.get('PYTHONPATH')
+    monkeypatch.setenv('PYTHONPATH',
+                       ROOT + (os.pathsep + path if path else ''))
+    yield state
+    if (state / 'jobs').exists():
+        for line in (state / 'jobs').read_text().splitlines():
+            try:
+                os.killpg(int(line.split()[0]), signal.SIGKILL)
+            except OSError:
+                pass
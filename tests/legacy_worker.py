@@ -0,0 +1,51 @@
+"""A worker that behaves like those from before the framed protocol: it
+registers and exchanges SENTINEL-delimited messages, and it expects each
+task to carry its function as a plain pickle. It exits with status 3 if
+a pickle arrives that Python 2 could not read.
+
+    python legacy_worker.py PORT
+"""
+import os
+import pickle
+import socket
+import sys
+
+import cw
+
+
+def _load(blob):
+    if cw._pickle_protocol(blob) > cw.LEGACY_PICKLE_PROTOCOL:
+        print('pickle protocol too new: {!r}'.format(bytes(blob[:2])))
+        sys.stdout.flush()
+        os._exit(3)
+    return pickle.loads(blob)
+
+
+def _messages(sock):
+    data = b''
+    while True:
+        while cw.SENTINEL not in data:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            data += chunk
+        text, data = data.split(cw.SENTINEL, 1)
+        yield cw._msg_deser(text)
+
+
+def main(port):
+    sock = socket.create_connection(('localhost', port))
+    sock.sendall(cw._msg_ser(cw.WorkerRegisterMessage()) + cw.SENTINEL)
+    for task in _messages(sock):
+        sys.path[:0] = [p for p in task.syspath if p not in sys.path]
+        os.chdir(task.cwd)
+        func = _load(task.func_id)  # The whole function blob.
+        args = _load(task.args_blob)
+        kwargs = _load(task.kwargs_blob)
+        result = cw.ResultMessage(task.jobid, True,
+                                  pickle.dumps(func(*args, **kwargs), 2))
+        sock.sendall(cw._msg_ser(result) + cw.SENTINEL)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]))
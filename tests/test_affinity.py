@@ -0,0 +1,27 @@
+import os
+
+import cw.client
+import cw.stats
+
+
+def pid(_):
+    return os.getpid()
+
+
+def test_affinity(make_cluster):
+    cluster = make_cluster()
+    cluster.master('--affinity-delay', '5')
+    cluster.worker()
+    cluster.worker()
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        # Wait until both workers have run something.
+        pids = set()
+        while len(pids) < 2:
+            pids.update(f.result(30) for f in
+                        [executor.submit(pid, n) for n in range(8)])
+        for key in ('a', 'b'):
+            func = cw.client.with_options(pid, affinity=key)
+            ran = set(executor.submit(func, n).result(30) for n in range(6))
+            assert len(ran) == 1
+    stats = cw.stats.query('localhost', cluster.port)['tasks']
+    assert stats['affinity_hits'] >= 10
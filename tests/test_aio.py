@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import cw.aio
+import pytest
+
+
+def square(n):
+    return n * n
+
+
+def nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 30))
+
+
+def test_submit(cluster):
+    async def main():
+        async with cw.aio.AsyncClusterClient('localhost',
+                                             cluster.port) as client:
+            futures = [await client.submit(square, n) for n in range(10)]
+            futures += await client.submit_many(
+                square, [((n,), {}) for n in range(10, 20)]
+            )
+            return [await future for future in futures]
+    assert run(main()) == [n * n for n in range(20)]
+
+
+def test_master_lost(cluster):
+    async def main():
+        client = cw.aio.AsyncClusterClient('localhost', cluster.port)
+        await client.connect()
+        future = await client.submit(nap, 10)
+        cluster.processes[0].terminate()  # The master.
+        with pytest.raises(ConnectionError):
+            await future
+        with pytest.raises(ConnectionError):
+            await client.submit(square, 2)
+        with pytest.raises(ConnectionError):
+            await client.submit_many(square, [((2,), {})])
+        await client.close()
+    run(main())
+
+
+def test_receive_error(cluster):
+    class Broken(Exception):
+        pass
+
+    def finish(result, load=True):
+        raise Broken()
+
+    async def main():
+        client = cw.aio.AsyncClusterClient('localhost', cluster.port)
+        await client.connect()
+        first = await client.submit(square, 2)
+        second = await client.submit(nap, 0.5)
+        client.jobs.finish = finish
+        for future in (first, second):
+            with pytest.raises(Broken):
+                await future
+        with pytest.raises(ConnectionError):
+            await client.submit(square, 2)
+        await client.close()
+    run(main())
@@ -0,0 +1,103 @@
+import time
+
+import cw.autoscale
+import cw.client
+import cw.stats
+
+from conftest import Cluster
+
+
+def nap(n, seconds):
+    time.sleep(seconds)
+    return n
+
+
+def _wait_for_workers(cluster, count, timeout=30.0):
+    deadline = time.time() + timeout
+    while len(cw.stats.query('localhost', cluster.port)['workers']) != count:
+        assert time.time() < deadline, 'expected {} workers'.format(count)
+        time.sleep(0.05)
+
+
+class Launcher(object):
+    """Starts workers as local processes instead of Slurm jobs."""
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.workers = []
+
+    def __call__(self, count):
+        for _ in range(count):
+            self.workers.append(self.cluster.worker())
+
+
+def _scaler(cluster, launch, **kwargs):
+    return cw.autoscale.Autoscaler(launch, host='localhost',
+                                   port=cluster.port, up_cooldown=0,
+                                   down_cooldown=0, **kwargs)
+
+
+def test_scale_up(make_cluster):
+    cluster = make_cluster()
+    cluster.master()
+    launch = Launcher(cluster)
+    scaler = _scaler(cluster, launch, maximum=3, backlog=4)
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        futures = [executor.submit(nap, n, 0.1) for n in range(8)]
+        deadline = time.time() + 10
+        while cw.stats.query('localhost', cluster.port)['tasks']['queued'] \
+                < 8:
+            assert time.time() < deadline
+            time.sleep(0.05)
+        assert scaler.step_once() == 2
+        # The two on their way count towards the maximum.
+        assert scaler.step_once() == 1
+        assert scaler.step_once() == 0
+        assert [f.result(30) for f in futures] == list(range(8))
+    assert len(launch.workers) == 3
+    _wait_for_workers(cluster, 3)
+
+
+def test_drain_idle(make_cluster):
+    cluster = make_cluster()
+    cluster.master()
+    launch = Launcher(cluster)
+    scaler = _scaler(cluster, launch, minimum=1, idle_after=0.2)
+    # Nothing is queued, but the minimum calls for a worker.
+    assert scaler.step_once() == 1
+    launch(1)
+    _wait_for_workers(cluster, 2)
+
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        # Keep one worker busy while the other sits idle.
+        busy = executor.submit(nap, 'done', 3)
+        deadline = time.time() + 10
+        while scaler.step_once() == 0:
+            assert time.time() < deadline, 'no worker was let go'
+            time.sleep(0.1)
+        gone = []
+        while not gone:
+            assert time.time() < deadline, 'the drained worker is still up'
+            time.sleep(0.05)
+            gone = [w for w in launch.workers if w.poll() is not None]
+        assert len(gone) == 1
+        assert gone[0].returncode == 0
+        assert busy.result(30) == 'done'
+
+        # The last worker stays, however long it is idle.
+        time.sleep(0.3)
+        for _ in range(3):
+            assert scaler.step_once() == 0
+        assert executor.submit(nap, 1, 0).result(30) == 1
+    _wait_for_workers(cluster, 1)
+
+
+def test_slurm_launcher(slurm, tmp_path):
+    path = str(tmp_path / 'rendezvous')
+    cluster = Cluster()
+    try:
+        cluster.master('--rendezvous', path)
+        launch = cw.autoscale.slurm_launcher(rendezvous=path)
+        launch(2)
+        _wait_for_workers(cluster, 2)
+    finally:
+        cluster.stop()
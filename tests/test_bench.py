@@ -0,0 +1,23 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_bench(tmp_path):
+    # Runs its own master and worker (on the default port).
+    out = str(tmp_path / 'bench.json')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    subprocess.check_call(
+        [sys.executable, '-m', 'cw.bench', '--workers', '1',
+         '--tasks', '20', '--sizes', '100', '--latency-samples', '5',
+         '--repeat', '1', '--output', out],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, timeout=120,
+    )
+    with open(out) as f:
+        results = json.load(f)
+    for key in ('serialization', 'throughput', 'batched', 'latency'):
+        assert results[key]
@@ -0,0 +1,62 @@
+import importlib
+import os
+import subprocess
+import sys
+
+import cw.cache
+import cw.client
+
+from conftest import ROOT
+
+
+def _write_module(path, body):
+    with open(str(path), 'w') as f:
+        f.write('def step(x):\n    return {}\n'.format(body))
+
+
+def test_edited_function_misses(cluster, tmp_path, monkeypatch):
+    # A module-level function pickles as just its name, so only its
+    # bytecode tells the versions apart.
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module_path = tmp_path / 'cached_module.py'
+    _write_module(module_path, 'x + 1')
+    import cached_module
+
+    cache = cw.cache.DiskCache(str(tmp_path / 'cache'))
+    with cw.client.ClusterExecutor('localhost', cluster.port,
+                                   cache=cache) as executor:
+        assert executor.submit(cached_module.step, 1).result() == 2
+        assert executor.submit(cached_module.step, 1).result() == 2
+        assert cache.stats().hits == 1
+
+        _write_module(module_path, 'x + 100')
+        os.utime(str(module_path), (0, 0))  # Skip the stale .pyc.
+        importlib.reload(cached_module)
+        executor.submit(cached_module.step, 1).result()
+        assert cache.stats().hits == 1
+        assert cache.stats().misses == 2
+
+
+def _outer():
+    def inner(x):
+        return x in {'a', 'b', 'c'}
+    return inner
+
+
+def test_func_key_stable_across_processes():
+    # Set constants iterate in an order that changes with the hash seed.
+    script = ('import sys; sys.path.insert(0, "tests"); '
+              'import test_cache, cw.cache; '
+              'print(cw.cache.func_key(b"id", test_cache._outer).hex())')
+    keys = set()
+    for seed in ('1', '2'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+        keys.add(subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=ROOT, env=env))
+    assert len(keys) == 1
+
+
+def test_func_key_without_code():
+    assert cw.cache.func_key(b'id', dict) == b'id'
+    assert cw.cache.func_key(b'id', _outer) != b'id'
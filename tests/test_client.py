@@ -0,0 +1,80 @@
+import itertools
+
+import cw
+import cw.client
+import pytest
+
+
+def square(n):
+    return n * n
+
+
+def test_map(cluster):
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        assert list(executor.map(square, range(10))) == \
+            [n * n for n in range(10)]
+        assert list(executor.map(square, range(10), chunksize=3)) == \
+            [n * n for n in range(10)]
+        assert list(executor.map(square, range(10), timeout=30)) == \
+            [n * n for n in range(10)]
+
+
+def test_map_unknown_keyword(cluster):
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        with pytest.raises(TypeError):
+            executor.map(square, range(10), chunk_size=3)
+
+
+def test_imap(cluster):
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        # An unbounded input, consumed a window at a time.
+        results = executor.imap(square, itertools.count(), window=4,
+                                chunksize=2)
+        assert list(itertools.islice(results, 10)) == \
+            [n * n for n in range(10)]
+        assert sorted(executor.imap_unordered(square, range(10), window=3)) \
+            == [n * n for n in range(10)]
+
+
+def divide(a, b=1):
+    return a // b
+
+
+def test_submit_many(cluster):
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        calls = [((n,), {'b': 2}) for n in range(6)] + [((1, 0), {})]
+        futures = executor.submit_many(divide, calls)
+        assert [f.result(30) for f in futures[:6]] == [0, 0, 1, 1, 2, 2]
+        # One failed call does not take the rest of its batch with it.
+        with pytest.raises(cw.client.RemoteException):
+            futures[6].result(30)
+
+
+def test_timings_and_profile(cluster):
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        future = executor.submit(
+            cw.client.with_options(square, timings=True), 3
+        )
+        assert future.result(30) == 9
+        assert future.timings.execute >= 0
+        assert future.timings.bytes_in > 0
+        assert executor.profile_stats() is None
+
+        func = cw.client.with_options(square, profile=True)
+        assert executor.submit(func, 4).result(30) == 16
+        stats = executor.profile_stats()
+        assert any(name == 'square' for _, _, name in stats.stats)
+
+
+def test_functions_pinned():
+    # The master may ask again for the function of any unfinished job.
+    client = cw.client.Client('localhost')
+    client.functions = cw.FunctionCache(size=1)
+    func_id, _ = cw.func_ser(square)
+    list(client._register(square, [1, 2]))
+    list(client._register(divide, []))
+    client._release(1)
+    assert client.functions.get(func_id) is not None
+    client._release(2)
+    list(client._register(divide, []))
+    assert client.functions.get(func_id) is None
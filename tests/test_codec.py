@@ -0,0 +1,36 @@
+import os
+
+import cw.client
+import cw.codec
+
+
+def test_compressor():
+    compressor = cw.codec.Compressor('zlib', threshold=1024)
+    data = b'abc' * 100000
+    packed = compressor.compress(data)
+    assert cw.codec.codec_name(packed) == 'zlib'
+    assert cw.codec.wire_size(packed) < len(data)
+    assert cw.codec.expand(packed) == data
+
+    # Too small, and incompressible.
+    assert compressor.compress(b'abc') == b'abc'
+    noise = os.urandom(200000)
+    assert compressor.compress(noise) is noise
+    assert cw.codec.expand(noise) is noise
+
+
+def echo(data):
+    return data
+
+
+def test_compressed_round_trip(cluster):
+    compressor = cw.codec.Compressor('zlib')
+    packed = []
+    compress = compressor.compress
+    compressor.compress = lambda buf: packed.append(compress(buf)) or \
+        packed[-1]
+    data = bytearray(b'abc' * 100000)
+    with cw.client.ClusterExecutor('localhost', cluster.port,
+                                   compression=compressor) as executor:
+        assert executor.submit(echo, data).result(30) == data
+    assert any(cw.codec.codec_name(buf) == 'zlib' for buf in packed)
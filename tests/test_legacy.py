@@ -0,0 +1,120 @@
+import os
+import pickle
+
+import cw
+import cw.client
+import cw.master
+import pytest
+
+from conftest import ROOT
+
+TESTS = os.path.join(ROOT, 'tests')
+
+
+def square(n):
+    return n * n
+
+
+class Opaque(object):
+    """Pickles by reference to this module, which the master (whose
+    search path lacks the tests) cannot import.
+    """
+
+
+def _protocol(blob):
+    return cw._pickle_protocol(blob)
+
+
+def test_untag_repickles():
+    for serializer in ('pickle', 'cloudpickle'):
+        blob = cw.dumps({'a': (1, 2.0, b'x')}, serializer)
+        untagged = cw.untag(blob)
+        assert _protocol(untagged) <= cw.LEGACY_PICKLE_PROTOCOL
+        assert pickle.loads(untagged) == {'a': (1, 2.0, b'x')}
+
+
+def test_untag_closure():
+    offset = 3
+    untagged = cw.untag(cw.dumps(lambda x: x + offset, 'cloudpickle'))
+    assert _protocol(untagged) <= cw.LEGACY_PICKLE_PROTOCOL
+    assert pickle.loads(untagged)(1) == 4
+
+
+class Array(object):
+    """Pickles its data out-of-band when it can, like a NumPy array."""
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return Array, (pickle.PickleBuffer(self.data),)
+        return Array, (bytes(self.data),)
+
+
+@pytest.mark.skipif(not cw.OOB_AVAILABLE, reason='no out-of-band pickling')
+def test_untag_buffers():
+    data = bytearray(b'x' * cw.OOB_THRESHOLD)
+    blob, buffers = cw.ser(Array(data))
+    assert buffers
+    untagged = cw.untag(blob, buffers)
+    assert _protocol(untagged) <= cw.LEGACY_PICKLE_PROTOCOL
+    assert bytes(pickle.loads(untagged).data) == bytes(data)
+
+
+def test_untag_reference():
+    # Globals from modules the master has not loaded stay references.
+    blob = cw.dumps(square, 'pickle').replace(b'test_legacy',
+                                              b'nonexistent')
+    untagged = cw.untag(blob)
+    assert _protocol(untagged) <= cw.LEGACY_PICKLE_PROTOCOL
+    assert b'nonexistent' in untagged
+    with pytest.raises(ImportError):
+        pickle.loads(untagged)
+
+
+def test_untag_marshal():
+    untagged = cw.untag(cw.dumps([1, 'a'], 'marshal'))
+    assert _protocol(untagged) <= cw.LEGACY_PICKLE_PROTOCOL
+    assert pickle.loads(untagged) == [1, 'a']
+
+
+def test_untag_unconvertible():
+    blob = cw.dumps(Opaque(), 'pickle').replace(b'test_legacy',
+                                                b'nonexistent')
+    with pytest.raises(cw.Unconvertible):
+        cw.untag(blob)
+
+
+def test_result_for_legacy_client():
+    master = cw.master.Master(spill_after=None)
+    blob, buffers = cw.ser({'value': 1})
+    result = master._result_to_legacy(
+        cw.ResultMessage(7, True, blob, buffers)
+    )
+    assert result.success
+    assert _protocol(result.result_blob) <= cw.LEGACY_PICKLE_PROTOCOL
+    assert pickle.loads(result.result_blob) == {'value': 1}
+
+    blob = cw.dumps(Opaque(), 'pickle').replace(b'test_legacy',
+                                                b'nonexistent')
+    result = master._result_to_legacy(cw.ResultMessage(7, True, blob))
+    assert not result.success
+    assert 'legacy client' in pickle.loads(result.result_blob)
+
+
+def test_legacy_worker(make_cluster):
+    cluster = make_cluster()
+    cluster.master()
+    worker = cluster.spawn_script(os.path.join(TESTS, 'legacy_worker.py'),
+                                  str(cluster.port))
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        futures = [executor.submit(square, n) for n in range(10)]
+        assert [f.result(30) for f in futures] == [n * n for n in range(10)]
+
+        # The master cannot load this to pickle it again.
+        future = executor.submit(square, Opaque())
+        with pytest.raises(cw.client.RemoteException) as info:
+            future.result(30)
+        assert 'legacy worker' in str(info.value)
+        assert executor.submit(square, 3).result(30) == 9
+    assert worker.poll() is None, worker.stdout.read()
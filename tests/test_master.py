@@ -0,0 +1,148 @@
+import cw
+import cw.master
+import cw.sched
+
+
+class FakeWorker(object):
+    """Stands in for a worker's connection."""
+    cw_protocol = cw.PROTOCOL_FRAMED
+
+    def __init__(self, name, credits=1, slots=None):
+        self.addr = (name, 1)
+        self.cw_credits = credits
+        self.cw_slots = slots or credits
+
+
+def _register(master, *workers):
+    for worker in workers:
+        master.workers[worker] = 0
+        master._add_credit(worker, worker.cw_credits)
+
+
+def test_turn_order():
+    master = cw.master.Master(spill_after=None)
+    a, b, c = FakeWorker('a'), FakeWorker('b'), FakeWorker('c')
+    _register(master, a, b, c)
+    assert master._any_worker() is a
+    master._take_credit(a)
+    assert master._any_worker() is b
+    master._take_credit(b)
+    master._add_credit(a)
+    assert list(master.ready_workers) == [c, a]
+    assert list(master.free_workers) == [c, a]
+
+
+def test_prefetched_worker_not_free():
+    # A worker with a prefetch credit stays ready once its only slot is
+    # taken, but other workers with free slots come first.
+    master = cw.master.Master(spill_after=None)
+    a = FakeWorker('a', credits=2, slots=1)
+    b = FakeWorker('b', credits=2, slots=1)
+    _register(master, a, b)
+    master._take_credit(a)
+    assert a in master.ready_workers
+    assert a not in master.free_workers
+    assert master._any_worker() is b
+    master._take_credit(b)
+    assert list(master.free_workers) == []
+    assert master._any_worker() is a
+
+
+def test_lost_worker_leaves_lines():
+    master = cw.master.Master(spill_after=None)
+    a, b = FakeWorker('a'), FakeWorker('b')
+    _register(master, a, b)
+    for _ in master._lose_worker(a, 'departed'):
+        pass
+    assert list(master.ready_workers) == [b]
+    assert list(master.free_workers) == [b]
+
+
+def test_relay_loses_credits():
+    master = cw.master.Master(spill_after=None)
+    relay = FakeWorker('relay', credits=4)
+    _register(master, relay)
+    master._take_credit(relay)
+    master._add_credit(relay, -4)
+    assert relay not in master.ready_workers
+    assert relay not in master.free_workers
+    master._add_credit(relay, 2)
+    assert list(master.ready_workers) == [relay]
+
+
+def test_retry_elsewhere():
+    # A task that timed out goes to another worker, even though the one
+    # it hung on still has a prefetch credit and is first in line.
+    master = cw.master.Master(spill_after=None)
+    client = FakeWorker('client')
+    master.connections.add(client)
+    a = FakeWorker('a', credits=2, slots=1)
+    b = FakeWorker('b', credits=2, slots=1)
+    _register(master, a, b)
+
+    task = cw.TaskMessage(1, b'f', b'', b'', '.', [])
+    master.stats.queued([task], client)
+    master.queued_tasks.push(task, client)
+    msg, _, worker = master._next_work()
+    assert worker is a
+    master._take_credit(a)
+    master.active_tasks[1] = (task, client, a, 0.0, 1)
+    master._take_credit(b)
+    master._add_credit(b)
+    assert list(master.ready_workers) == [a, b]
+
+    for _ in master._retry(1, 'timed out'):
+        pass
+    msg, _, worker = master._next_work()
+    assert msg.jobid == 1
+    assert worker is b
+
+
+def test_forget_client_weight():
+    scheduler = cw.sched.FairScheduler()
+    master = cw.master.Master(scheduler, spill_after=None)
+    client = FakeWorker('client')
+    session = master.communicate(client)
+    next(session)  # Waiting for a message.
+    session.send(cw.ClientRegisterMessage(3))
+    assert scheduler.weights == {client: 3}
+
+    # Hang up: the next read finds the connection closed.
+    try:
+        while True:
+            session.send(None)
+    except StopIteration:
+        pass
+    assert client not in master.connections
+    assert scheduler.weights == {}
+
+
+def test_drop_sessions():
+    master = cw.master.Master(spill_after=None)
+    a, b, worker = FakeWorker('a'), FakeWorker('b'), FakeWorker('worker')
+    _register(master, worker)
+    master.clients.update([a, b])
+    a.cw_sessions = {b's', b't'}
+    b.cw_sessions = {b't'}
+    worker.cw_sessions = {b's', b't'}
+    master.sessions = {b's': 's', b't': 't'}
+    master.awaiting_sessions[b'u'] = {worker}
+    # b still uses t.
+    master._drop_sessions(a)
+    assert master.sessions == {b't': 't'}
+    assert worker.cw_sessions == {b't'}
+    master._drop_sessions(worker)
+    assert master.awaiting_sessions == {}
+
+
+def test_drop_waiting():
+    master = cw.master.Master(spill_after=None)
+    a, b = FakeWorker('a'), FakeWorker('b')
+    task = cw.TaskMessage(1, b'f', b'', b'', '.', [])
+    master.awaiting_functions[b'f'] = [(task, a), (task._replace(jobid=2), b)]
+    master.awaiting_functions[b'g'] = [(task, a)]
+    # Only b is left waiting for f, so it is asked for it.
+    assert len(list(master._drop_waiting(a))) == 1
+    assert master.awaiting_functions == {b'f': [(task._replace(jobid=2), b)]}
+    assert list(master._drop_waiting(b)) == []
+    assert master.awaiting_functions == {}
@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+import cw.mp
+import pytest
+
+from conftest import Cluster
+
+
+@pytest.fixture
+def pidfile(tmp_path, monkeypatch):
+    path = str(tmp_path / 'pids')
+    monkeypatch.setattr(cw.mp, 'PIDFILE', path)
+    return path
+
+
+def test_stop_from_elsewhere(pidfile):
+    # As if another process had run `start`.
+    cluster = Cluster()
+    master = cluster.master()
+    cw.mp._write_pids([('master', master.pid)])
+    try:
+        cw.mp.stop(workers=False)
+        assert master.wait(5) is not None
+    finally:
+        cluster.stop()
+    assert cw.mp._read_pids() == []
+
+
+def test_stop_skips_reused_pid(pidfile):
+    # The master exited and its pid went to something else.
+    other = subprocess.Popen([sys.executable, '-c',
+                              'import time; time.sleep(60)'])
+    cw.mp._write_pids([('master', other.pid), ('workers', other.pid)])
+    try:
+        cw.mp.stop()
+        assert other.poll() is None
+    finally:
+        other.kill()
+        other.wait()
+    assert cw.mp._read_pids() == []
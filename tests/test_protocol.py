@@ -0,0 +1,74 @@
+import cw
+import struct
+
+
+def _py2_unmarshal(data):
+    """Read marshal data the way Python 2.7 does, which knows only the
+    type codes of marshal versions 0 to 2. Anything newer is an error.
+    """
+    data = bytes(data)
+    pos = [0]
+
+    def take(n):
+        out = data[pos[0]:pos[0] + n]
+        assert len(out) == n, 'truncated'
+        pos[0] += n
+        return out
+
+    def length():
+        return struct.unpack('<i', take(4))[0]
+
+    def read():
+        code = take(1)
+        if code == b'N':
+            return None
+        if code == b'T':
+            return True
+        if code == b'F':
+            return False
+        if code == b'i':
+            return length()
+        if code == b'g':
+            return struct.unpack('<d', take(8))[0]
+        if code in (b's', b't'):
+            return take(length())
+        if code == b'u':
+            return take(length()).decode('utf8')
+        if code in (b'(', b'['):
+            return tuple(read() for i in range(length()))
+        raise AssertionError('code {!r} is unknown to Python 2'.format(code))
+
+    out = read()
+    assert pos[0] == len(data), 'trailing data'
+    return out
+
+
+def test_legacy_task_readable_by_py2():
+    task = cw.TaskMessage(7, b'\x80\x02blob', b'args', b'kwargs',
+                          '/home/user', ['/lib', '/site'], 3,
+                          session=b'x' * 20)
+    typename, vals = _py2_unmarshal(cw._msg_ser(task))
+    assert typename == 'TaskMessage'
+    assert vals == (7, b'\x80\x02blob', b'args', b'kwargs', '/home/user',
+                    ('/lib', '/site'))
+
+
+def test_legacy_result_readable_by_py2():
+    result = cw.ResultMessage(7, True, memoryview(b'result'), (),
+                              (0.1, 0.2))
+    typename, vals = _py2_unmarshal(cw._msg_ser(result))
+    assert typename == 'ResultMessage'
+    assert vals == (7, True, b'result')
+
+
+def test_legacy_message_from_py2():
+    # What Python 2's marshal writes for a result: the type name is a
+    # byte string.
+    text = (b'(\x02\x00\x00\x00s\x0d\x00\x00\x00ResultMessage'
+            b'(\x03\x00\x00\x00i\x07\x00\x00\x00Ts\x02\x00\x00\x00ok')
+    assert cw._msg_deser(text) == cw.ResultMessage(7, True, b'ok')
+
+
+def test_legacy_register_roundtrip():
+    msg = cw.WorkerRegisterMessage()
+    assert cw._msg_deser(cw._msg_ser(msg)) == msg
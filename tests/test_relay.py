@@ -0,0 +1,26 @@
+import cw.client
+import cw.stats
+
+from conftest import free_port, wait_for_port
+
+
+def square(n):
+    return n * n
+
+
+def test_relay(make_cluster):
+    cluster = make_cluster()
+    cluster.master()
+    relay_port = free_port()
+    cluster.spawn('cw.master', '--relay', 'localhost:{}'.format(cluster.port),
+                  '--port', str(relay_port))
+    wait_for_port(relay_port)
+    for _ in range(2):
+        cluster.spawn('cw.worker', 'localhost', '--port', str(relay_port))
+
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        futures = [executor.submit(square, n) for n in range(20)]
+        assert [f.result(30) for f in futures] == [n * n for n in range(20)]
+    # The master sees the relay as its one worker.
+    assert len(cw.stats.query('localhost', cluster.port)['workers']) == 1
+    assert len(cw.stats.query('localhost', relay_port)['workers']) == 2
@@ -0,0 +1,53 @@
+import cw
+import cw.sched
+
+
+def _task(jobid):
+    return cw.TaskMessage(jobid, b'f', b'x' * 100, b'', '.', [])
+
+
+def test_spill_rotates(tmp_path):
+    # Keep the backlog from ever emptying while its file is read back.
+    size = cw.sched.queued_size(_task(0))
+    sched = cw.sched.SpillingScheduler(
+        cw.sched.FIFOScheduler(), size, str(tmp_path), rotate_after=2000
+    )
+    client = object()
+    jobids = iter(range(10000))
+    for _ in range(10):
+        sched.push(_task(next(jobids)), client)
+
+    popped = []
+    closed = []
+    for _ in range(200):
+        spills = sched.files[client]
+        assert len(spills) <= 2
+        if len(spills) == 2:
+            closed.append(spills[0])
+        msg, _ = sched.pop()
+        popped.append(msg.jobid)
+        sched.push(_task(next(jobids)), client)
+    assert popped == list(range(200))
+    assert closed and all(spill.writer.closed for spill in closed[:-1])
+    assert len(sched) == 10
+
+
+def test_fair_weights():
+    sched = cw.sched.FairScheduler()
+    a, b = object(), object()
+    sched.set_weight(a, 2)
+    for jobid in range(4):
+        sched.push(_task(jobid), a)
+        sched.push(_task(10 + jobid), b)
+    order = [sched.pop()[1] for _ in range(8)]
+    assert order == [a, a, b, a, a, b, b, b]
+    assert len(sched) == 0
+
+
+def test_priority_order():
+    sched = cw.sched.PriorityScheduler()
+    client = object()
+    for jobid, priority in enumerate([0, 5, 0, 5]):
+        sched.push(_task(jobid)._replace(priority=priority), client)
+    sched.push_front(_task(9), client)
+    assert [sched.pop()[0].jobid for _ in range(5)] == [1, 3, 9, 0, 2]
@@ -0,0 +1,36 @@
+import glob
+import os
+import pickle
+
+import cw
+import cw.client
+import cw.shm
+import cw.store
+import pytest
+
+
+def doubled(data):
+    # Results this large come back through shared memory too.
+    return pickle.PickleBuffer(bytes(data) * 2)
+
+
+def _segments():
+    return set(glob.glob(os.path.join(cw.shm.SHM_DIR,
+                                      cw.store.PREFIX + '*')))
+
+
+@pytest.mark.skipif(not cw.OOB_AVAILABLE, reason='no out-of-band pickling')
+def test_shared_memory(cluster, monkeypatch):
+    shared = []
+    share = cw.shm.share
+    monkeypatch.setattr(cw.shm, 'share',
+                        lambda buf: shared.append(share(buf)) or shared[-1])
+    before = _segments()
+    data = bytearray(b'x' * (2 * cw.shm.THRESHOLD))
+    with cw.client.ClusterExecutor('localhost', cluster.port,
+                                   shared_memory=True) as executor:
+        result = executor.submit(doubled, pickle.PickleBuffer(data)).result(30)
+        assert bytes(result) == bytes(data) * 2
+    assert len(shared) == 1
+    # Every segment was unlinked once read.
+    assert _segments() - before == set()
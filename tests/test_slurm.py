@@ -0,0 +1,63 @@
+import os
+
+import cw
+import cw.client
+import cw.slurm
+
+from conftest import Cluster, free_port
+
+
+def square(n):
+    return n * n
+
+
+def test_read_rendezvous(tmp_path, monkeypatch):
+    monkeypatch.setattr(cw.slurm, 'RENDEZVOUS_POLL', 0.05)
+    path = str(tmp_path / 'rendezvous')
+    assert cw.slurm.read_rendezvous(path) is None
+    cw.slurm.write_rendezvous(path, 'node1', 1234, 'abc')
+    assert cw.slurm.read_rendezvous(path) == ('node1', 1234, 'abc')
+    assert cw.slurm.read_rendezvous(path, token='abc') == \
+        ('node1', 1234, 'abc')
+    assert cw.slurm.read_rendezvous(path, 0.2, token='xyz') is None
+    assert cw.slurm.master_address(path) == ('node1', 1234)
+
+
+def test_discovery_past_stale_file(tmp_path):
+    # A file left by an earlier run points at a master that is gone.
+    path = str(tmp_path / 'rendezvous')
+    cw.slurm.write_rendezvous(path, 'localhost', free_port(), 'stale')
+
+    cluster = Cluster()
+    try:
+        cluster.spawn('cw.master', '--port', str(cluster.port),
+                      '--rendezvous', path, '--token', 'fresh')
+        found = cw.slurm.read_rendezvous(path, 30, token='fresh')
+        assert found is not None
+        assert found[1:] == (cluster.port, 'fresh')
+        host, port = cw.slurm.master_address(path)
+        assert port == cluster.port
+
+        cluster.spawn('cw.worker', '--slurm', '--rendezvous', path)
+        with cw.client.ClusterExecutor(host, port) as executor:
+            assert executor.submit(square, 4).result(30) == 16
+    finally:
+        cluster.stop()
+
+
+def test_start_and_stop(slurm, tmp_path):
+    path = str(tmp_path / 'rendezvous')
+    cw.slurm.write_rendezvous(path, 'localhost', free_port(), 'stale')
+    cw.slurm.start(2, rendezvous=path)
+    host, port = cw.slurm.master_address(path)
+    assert port == cw.PORT
+    # The workers found the master through the file, not squeue.
+    assert not (slurm / 'squeue.calls').exists()
+    with cw.client.ClusterExecutor(host, port) as executor:
+        futures = [executor.submit(square, n) for n in range(8)]
+        assert [f.result(30) for f in futures] == [n * n for n in range(8)]
+
+    cw.slurm.stop(rendezvous=path)
+    assert not os.path.exists(path)
+    assert cw.slurm._get_jobids(cw.slurm.JOB_WORKERS) == []
+    assert cw.slurm._get_jobid(cw.slurm.JOB_MASTER) is None
@@ -0,0 +1,30 @@
+import os
+import time
+
+import cw.client
+import cw.stats
+
+
+def nap(seconds, marker=None):
+    # With a marker, only the first run is slow.
+    if marker is not None and not os.path.exists(marker):
+        open(marker, 'w').close()
+        time.sleep(seconds)
+    return seconds
+
+
+def test_straggler_copied(make_cluster, tmp_path):
+    cluster = make_cluster()
+    cluster.master('--speculate-after', '3')
+    cluster.worker()
+    cluster.worker()
+    fast = cw.client.with_options(nap, speculative=True)
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        for _ in range(20):  # Enough run times to judge by.
+            executor.submit(fast, 0.05).result(30)
+        start = time.time()
+        future = executor.submit(fast, 30, str(tmp_path / 'slow'))
+        assert future.result(20) == 30
+        assert time.time() - start < 20
+    assert cw.stats.query('localhost', cluster.port)['tasks']['speculated'] \
+        == 1
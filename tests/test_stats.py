@@ -0,0 +1,28 @@
+import cw.client
+import cw.stats
+
+
+def square(n):
+    return n * n
+
+
+def test_stats(cluster, tmp_path):
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        assert list(executor.map(square, range(5))) == \
+            [n * n for n in range(5)]
+    stats = cw.stats.query('localhost', cluster.port)
+    assert stats['tasks']['received'] == 5
+    assert stats['tasks']['completed'] == 5
+    assert stats['tasks']['queued'] == 0
+    assert len(stats['workers']) == 1
+    assert stats['latency']['total']['count'] == 5
+
+    text = cw.stats.prometheus(stats)
+    assert 'cw_tasks_completed_total 5\n' in text
+    assert 'cw_workers 1\n' in text
+    assert 'cw_task_total_seconds_bucket{le="+Inf"} 5\n' in text
+
+    path = str(tmp_path / 'cw.prom')
+    cw.stats.write_metrics(path, stats)
+    with open(path) as f:
+        assert f.read() == text
@@ -0,0 +1,76 @@
+import os
+import pickle
+
+import cw
+import cw.client
+import cw.store
+import pytest
+
+
+def test_store_refs(tmp_path):
+    store = cw.store.Store(str(tmp_path), threshold=10)
+    assert store.put(b'small') is None
+    path = store.put(b'x' * 100)
+    assert store.put(b'x' * 100) == path
+    assert bytes(cw.store.attach(path)) == b'x' * 100
+    store.release(path)
+    assert os.path.exists(path)
+    store.release(path)
+    assert not os.path.exists(path)
+
+
+def test_unlink_only_store_files(tmp_path):
+    other = tmp_path / 'precious'
+    other.write_bytes(b'data')
+    cw.store.unlink(str(other))
+    assert other.exists()
+
+
+def size(data):
+    return memoryview(data).nbytes
+
+
+@pytest.mark.skipif(not cw.OOB_AVAILABLE, reason='no out-of-band pickling')
+def test_store_round_trip(cluster, tmp_path):
+    store = cw.store.Store(str(tmp_path), threshold=1024)
+    stored = []
+    put = store.put
+    store.put = lambda buf: stored.append(put(buf)) or stored[-1]
+    data = bytearray(b'x' * 100000)
+    with cw.client.ClusterExecutor('localhost', cluster.port,
+                                   shared_memory=False,
+                                   store=store) as executor:
+        buf = pickle.PickleBuffer(data)
+        futures = [executor.submit(size, buf) for _ in range(3)]
+        assert [f.result(30) for f in futures] == [len(data)] * 3
+    stored = [path for path in stored if path is not None]
+    assert len(stored) == 3 and len(set(stored)) == 1
+    assert os.listdir(str(tmp_path)) == []
+
+
+def repeat(data, times):
+    return data * times
+
+
+def test_store_blobs(cluster, tmp_path, monkeypatch):
+    # Plain bytes are pickled in-band, so the blobs themselves are big.
+    store = cw.store.Store(str(tmp_path), threshold=1024)
+    stored = []
+    put = store.put
+    store.put = lambda buf: stored.append(put(buf)) or stored[-1]
+    attached = []
+    attach = cw.store.attach
+    monkeypatch.setattr(cw.store, 'attach',
+                        lambda path: attached.append(path) or attach(path))
+    with cw.client.ClusterExecutor('localhost', cluster.port,
+                                   shared_memory=False,
+                                   store=store) as executor:
+        assert executor.submit(repeat, b'x' * 100000, 1).result(30) == \
+            b'x' * 100000
+        assert executor.submit(repeat, b'y', 100000).result(30) == \
+            b'y' * 100000
+    stored = [path for path in stored if path is not None]
+    assert len(stored) == 1  # The first job's arguments.
+    assert len(attached) == 2  # Both results.
+    assert all(os.path.dirname(path) == str(tmp_path) for path in attached)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+
+import cw
+import cw.client
+import cw.worker
+import pytest
+
+
+def pid_after(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+@pytest.mark.parametrize('pool', ['--threads', '--processes'])
+def test_slots(make_cluster, pool):
+    cluster = make_cluster()
+    cluster.master()
+    cluster.worker('--slots', '3', pool)
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        executor.submit(pid_after, 0).result(30)  # Wait for the worker.
+        start = time.time()
+        pids = [f.result(30)
+                for f in [executor.submit(pid_after, 1) for _ in range(3)]]
+        assert time.time() - start < 2.5
+    assert len(set(pids)) == (3 if pool == '--processes' else 1)
+
+
+def _children(pid):
+    with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'),
+                    reason='needs procfs')
+def test_terminate_stops_pool(make_cluster):
+    cluster = make_cluster()
+    cluster.master()
+    worker = cluster.worker('--slots', '2', '--processes')
+    executor = cw.client.ClusterExecutor('localhost', cluster.port)
+    try:
+        executor.submit(pid_after, 0).result(30)
+        pool = _children(worker.pid)
+        assert pool
+        executor.submit(pid_after, 30)
+        time.sleep(0.5)
+        worker.terminate()
+        worker.wait(10)
+        deadline = time.time() + 10
+        while any(os.path.exists('/proc/{}'.format(pid)) for pid in pool):
+            assert time.time() < deadline, 'pool processes still running'
+            time.sleep(0.05)
+    finally:
+        # Nothing is left to run the long task.
+        executor.shutdown(wait=False)
+
+
+def cwd():
+    return os.getcwd()
+
+
+def test_session_cwd(cluster, tmp_path, monkeypatch):
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        monkeypatch.chdir(str(first))
+        assert executor.submit(cwd).result(30) == str(first)
+        monkeypatch.chdir(str(second))
+        assert executor.submit(cwd).result(30) == str(second)
+        monkeypatch.chdir(str(first))
+        assert executor.submit(cwd).result(30) == str(first)
+
+
+@pytest.mark.parametrize('pool', ['--threads', '--processes'])
+def test_missing_cwd(make_cluster, tmp_path, monkeypatch, pool):
+    # A task whose directory the worker cannot enter fails on its own.
+    cluster = make_cluster()
+    cluster.master()
+    worker = cluster.worker(pool)
+    missing = str(tmp_path / 'missing')
+    executor = cw.client.ClusterExecutor('localhost', cluster.port)
+    try:
+        monkeypatch.setattr(os, 'getcwd', lambda: missing)
+        future = executor.submit(cwd)
+        with pytest.raises(cw.client.RemoteException) as info:
+            future.result(30)
+        assert missing in str(info.value)
+
+        monkeypatch.undo()
+        assert executor.submit(cwd).result(30) == os.getcwd()
+        assert worker.poll() is None
+    finally:
+        executor.shutdown(wait=False)
+
+
+def leave():
+    sys.exit(3)
+
+
+@pytest.mark.parametrize('pool', ['--threads', '--processes'])
+def test_task_exits(make_cluster, pool):
+    # Only the task fails, not the worker.
+    cluster = make_cluster()
+    cluster.master()
+    worker = cluster.worker(pool)
+    with cw.client.ClusterExecutor('localhost', cluster.port) as executor:
+        with pytest.raises(cw.client.RemoteException) as info:
+            executor.submit(leave).result(30)
+        assert 'SystemExit' in str(info.value)
+        assert executor.submit(cwd).result(30) == os.getcwd()
+    assert worker.poll() is None
+
+
+def test_session_asked_again(monkeypatch):
+    # A worker that has dropped a session asks the master for it again
+    # and holds the task that needs it until it arrives.
+    monkeypatch.setattr(cw, '_readmsg', lambda conn: 'read')
+    monkeypatch.setattr(cw, '_sendmsg', lambda conn, msg: msg)
+    worker = cw.worker.Worker()
+    try:
+        worker.sessions = cw.LRUCache(1)
+        func_id, worker.func_blobs[func_id] = cw.func_ser(cwd)
+        here = os.getcwd()
+        first, second = (cw.SessionMessage(cw.session_id(path, sys.path),
+                                           path, list(sys.path))
+                         for path in (here, os.path.dirname(here)))
+        receive = worker.receive(None)
+        assert next(receive) == 'read'
+        assert receive.send(first) == 'read'
+        assert receive.send(second) == 'read'  # The first is dropped.
+        args_blob, _ = cw.ser(())
+        kwargs_blob, _ = cw.ser({})
+        task = cw.TaskMessage(1, func_id, args_blob, kwargs_blob, None, None,
+                              session=first.session_id)
+        assert receive.send(task) == \
+            cw.SessionRequestMessage(first.session_id)
+        assert list(worker.backlog) == [task]
+        assert next(receive) == 'read'
+        assert receive.send(first) == 'read'
+        assert not worker.backlog
+        assert worker.running == 1
+    finally:
+        worker.executor.shutdown()